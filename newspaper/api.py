@@ -68,12 +68,14 @@ def hot():
         return None
 
 
-def fulltext(html, language='en'):
+def fulltext(html, language='en', encoding=None):
     """Takes article HTML string input and outputs the fulltext
-    Input string is decoded via UnicodeDammit if needed
+    Bytes are parsed as `encoding` or the charset their <meta> tags
+    declare, and decoded via UnicodeDammit only if neither is known.
+    The cleaner and stopwords of `language` are shared between calls
     """
-    from .cleaners import DocumentCleaner
     from .configuration import Configuration
+    from .context import get_context
     from .extractors import ContentExtractor
     from .outputformatters import OutputFormatter
 
@@ -81,13 +83,32 @@ def fulltext(html, language='en'):
     config.language = language
 
     extractor = ContentExtractor(config)
-    document_cleaner = DocumentCleaner(config)
+    document_cleaner = get_context(config).document_cleaner
     output_formatter = OutputFormatter(config)
 
-    doc = config.get_parser().fromstring(html)
-    doc = document_cleaner.clean(doc)
+    doc = config.get_parser().fromstring(html, encoding)
+    index = config.get_parser().build_index(doc)
+    doc = document_cleaner.clean(doc, index)
 
-    top_node = extractor.calculate_best_node(doc)
+    top_node = extractor.calculate_best_node(doc, index)
     top_node = extractor.post_cleanup(top_node)
     text, article_html = output_formatter.get_formatted(top_node)
     return text
+
+
+def fulltext_many(docs, language='en', workers=None, chunksize=16,
+                  ordered=True, encoding=None):
+    """Takes an iterable of article HTML, as str or bytes, or of paths of
+    html files, as `os.PathLike` or str, and extracts each fulltext like
+    `fulltext` on a pool of `workers` processes. Iterate over the
+    returned batch for (index, text) pairs, text is None for docs which
+    failed. Its `stats()` hold the throughput in docs/sec
+
+    >>> batch = fulltext_many(pathlib.Path('archive').glob('*.html'))
+    >>> for index, text in batch:
+    ...     save(index, text)
+    >>> batch.stats()['docs_per_sec']
+    """
+    from .mprocessing import FulltextBatch
+    return FulltextBatch(docs, language, workers, chunksize, ordered,
+                         encoding)
@@ -5,13 +5,15 @@ __license__ = 'MIT'
 __copyright__ = 'Copyright 2014, Lucas Ou-Yang'
 
 import logging
+import random
 import requests
 
+from . import instrument
 from . import network
 from . import urls
 
-from .cleaners import DocumentCleaner
 from .configuration import Configuration
+from .context import get_context
 from .extractors import ContentExtractor
 from .outputformatters import OutputFormatter
 from .utils import (URLHelper, RawHelper, extend_config)
@@ -39,7 +41,8 @@ class Article(object):
         self.config = config or Configuration()
         self.config = extend_config(self.config, kwargs)
 
-        self.extractor = ContentExtractor(self.config)
+        # made on first use, see the `extractor` property
+        self._extractor = None
 
         if source_url == '':
             scheme = urls.get_scheme(url)
@@ -58,8 +61,11 @@ class Article(object):
         # Body text from this article
         self.text = ''
 
-        # This article's unchanged and raw HTML
-        self.html = ''
+        # This article's unchanged and raw HTML, see the `html` property
+        self._html = ''
+        # Undecoded html bytes as downloaded and their charset, if known
+        self.raw_html = None
+        self.html_encoding = None
 
         # The HTML of this article's main node (most important part)
         self.article_html = ''
@@ -93,9 +99,13 @@ class Article(object):
         recursion_counter (currently 1) stops refreshes that are potentially
         infinite
         """
+        encoding = None
         if input_html is None:
+            timed = instrument.stage_timer(self.config.stage_hook, self.url)
             try:
-                html = network.get_html_2XX_only(self.url, self.config)
+                html, encoding = timed('download',
+                                       network.get_raw_html_2XX_only,
+                                       self.url, self.config)
             except requests.exceptions.RequestException as e:
                 self.download_state = ArticleDownloadState.FAILED_RESPONSE
                 self.download_exception_msg = str(e)
@@ -105,12 +115,61 @@ class Article(object):
         else:
             html = input_html
 
-        self.set_html(html)
+        self.set_html(html, encoding)
+
+    async def adownload(self, input_html=None, session=None):
+        """Coroutine counterpart of `download`, lets thousands of articles
+        be fetched concurrently on one event loop. Without an aiohttp
+        `session` the event loop's `network.get_async_session()` is used
+        """
+        encoding = None
+        if input_html is None:
+            try:
+                html, encoding = await network.async_get_raw_html_2XX_only(
+                    self.url, self.config, session=session)
+            except requests.exceptions.RequestException as e:
+                self.download_state = ArticleDownloadState.FAILED_RESPONSE
+                self.download_exception_msg = str(e)
+                log.debug('Download failed on URL %s because of %s' %
+                          (self.url, self.download_exception_msg))
+                return
+        else:
+            html = input_html
+
+        self.set_html(html, encoding)
 
     def parse(self):
+        """Extracts the article's text. Each stage is reported to
+        `config.stage_hook` if set, and `config.profile_sample_rate` of
+        the parses run under cProfile, see instrument.py
+        """
         self.throw_if_not_downloaded_verbose()
 
-        self.doc = self.config.get_parser().fromstring(self.html)
+        timed = instrument.stage_timer(self.config.stage_hook, self.url)
+        rate = self.config.profile_sample_rate
+        if rate and random.random() < rate:
+            text, profile = instrument.profiled(self._parse, timed)
+            name = getattr(self, 'link_hash', None) or \
+                self.get_parse_candidate().link_hash
+            try:
+                path = instrument.write_profile(profile, name,
+                                                self.config.profile_dir)
+            except OSError as e:
+                log.warning('Could not write the profile of parsing %s: %s'
+                            % (self.url, e))
+            else:
+                log.debug('Profile of parsing %s written to %s' %
+                          (self.url, path))
+            return text
+        return self._parse(timed)
+
+    def _parse(self, timed):
+        parser = self.config.get_parser()
+        if self.raw_html is not None:
+            self.doc = timed('fromstring', parser.fromstring,
+                             self.raw_html, self.html_encoding)
+        else:
+            self.doc = timed('fromstring', parser.fromstring, self.html)
 
         if self.doc is None:
             # `parse` call failed, return nothing
@@ -120,29 +179,48 @@ class Article(object):
         parse_candidate = self.get_parse_candidate()
         self.link_hash = parse_candidate.link_hash  # MD5
 
-        document_cleaner = DocumentCleaner(self.config)
+        document_cleaner = get_context(self.config).document_cleaner
         output_formatter = OutputFormatter(self.config)
 
         # Before any computations on the body, clean DOM object
-        doc = document_cleaner.clean(self.doc)
+        index = timed('index', parser.build_index, self.doc)
+        doc = timed('clean', document_cleaner.clean, self.doc, index)
 
         text = ''
-        top_node = self.extractor.calculate_best_node(doc)
+        top_node = timed('best_node', self.extractor.calculate_best_node,
+                         doc, index)
         if top_node is not None:
-            top_node = self.extractor.post_cleanup(top_node)
+            top_node = timed('post_cleanup', self.extractor.post_cleanup,
+                             top_node)
 
-            text, article_html = output_formatter.get_formatted(
-                top_node)
+            text, article_html = timed('format',
+                                       output_formatter.get_formatted,
+                                       top_node)
 
         self.is_parsed = True
         return text
 
 
 
+    @property
+    def extractor(self):
+        """The article's `ContentExtractor`, only made once the article
+        is parsed so that listing articles does not pay for it
+        """
+        if self._extractor is None:
+            self._extractor = ContentExtractor(self.config)
+        return self._extractor
+
+    @extractor.setter
+    def extractor(self, extractor):
+        self._extractor = extractor
+
     def get_parse_candidate(self):
         """A parse candidate is a wrapper object holding a link hash of this
         article and a final_url of the article
         """
+        if self.raw_html is not None:
+            return RawHelper.get_parsing_candidate(self.url, self.raw_html)
         if self.html:
             return RawHelper.get_parsing_candidate(self.url, self.html)
         return URLHelper.get_parsing_candidate(self.url)
@@ -152,15 +230,41 @@ class Article(object):
         if text:
             self.text = text
 
-    def set_html(self, html):
-        """Encode HTML before setting it
+    @property
+    def html(self):
+        """The html as text, html set as bytes is decoded on first access
+        """
+        if self._html is None:
+            timed = instrument.stage_timer(self.config.stage_hook, self.url)
+            self._html = timed('decode',
+                               self.config.get_parser().get_unicode_html,
+                               self.raw_html, self.html_encoding)
+        return self._html
+
+    @html.setter
+    def html(self, html):
+        self._html = html
+        self.raw_html = None
+        self.html_encoding = None
+
+    def set_html(self, html, encoding=None):
+        """Sets the html, bytes are kept undecoded along with `encoding`
+        (their charset, if known) until they are parsed or `html` is read
         """
         if html:
             if isinstance(html, bytes):
-                html = self.config.get_parser().get_unicode_html(html)
-            self.html = html
+                self._html = None
+                self.raw_html = html
+                self.html_encoding = encoding
+            else:
+                self.html = html
             self.download_state = ArticleDownloadState.SUCCESS
 
+    def has_html(self):
+        """Whether html was set, without decoding it
+        """
+        return self.raw_html is not None or bool(self._html)
+
     def set_article_html(self, article_html):
         """Sets the HTML of just the article's `top_node`
         """
@@ -168,6 +272,24 @@ class Article(object):
             self.article_html = article_html
 
 
+    def is_valid_url(self):
+        """Whether the url looks like it points to a news article
+        """
+        return urls.valid_url(self.url)
+
+    def is_valid_body(self):
+        """Whether the parsed text is long enough to be an article body,
+        at least `config.MIN_WORD_COUNT` words and `config.MIN_SENT_COUNT`
+        sentences
+        """
+        if not self.is_parsed or not self.text:
+            return False
+        if len(self.text.split()) < self.config.MIN_WORD_COUNT:
+            return False
+        if len(self.text.split('.')) < self.config.MIN_SENT_COUNT:
+            return False
+        return True
+
     def throw_if_not_downloaded_verbose(self):
         """Parse ArticleDownloadState -> log readable status
         -> maybe throw ArticleException
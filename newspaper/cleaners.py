@@ -3,9 +3,16 @@
 Holds the code for cleaning out unwanted tags from the lxml
 dom xpath.
 """
-import copy
+import re
+from collections import OrderedDict
+
+from lxml.html.defs import block_tags
+
 from .utils import ReplaceSequence
 
+# attribute values whose matching removal rules are remembered
+RULE_MATCHES_SIZE = 50000
+
 
 class DocumentCleaner(object):
 
@@ -29,13 +36,6 @@ class DocumentCleaner(object):
             "|konafilter|KonaFilter|breadcrumbs|^fn$|wp-caption-text"
             "|legende|ajoutVideo|timestamp|js_replies"
         )
-        self.regexp_namespace = "http://exslt.org/regular-expressions"
-        self.nauthy_ids_re = ("//*[re:test(@id, '%s', 'i')]" %
-                              self.remove_nodes_re)
-        self.nauthy_classes_re = ("//*[re:test(@class, '%s', 'i')]" %
-                                  self.remove_nodes_re)
-        self.nauthy_names_re = ("//*[re:test(@name, '%s', 'i')]" %
-                                self.remove_nodes_re)
         self.div_to_p_re = r"<(a|blockquote|dl|div|img|ol|p|pre|table|ul)"
         self.caption_re = "^caption$"
         self.google_re = " google "
@@ -47,195 +47,324 @@ class DocumentCleaner(object):
             .create("\n", "\n\n")\
             .append("\t")\
             .append("^\\s+$")
-        self.contains_article = './/article|.//*[@id="article"]|.//*[@itemprop="articleBody"]'
+        # (attribute, regex, whether nodes containing an article are kept)
+        # in the order they apply: `remove_nodes_re` on id, class and name,
+        # then each of the other patterns on id and class
+        self.removal_rules = [
+            (attr, re.compile(self.remove_nodes_re, re.I), True)
+            for attr in ['id', 'class', 'name']]
+        for pattern in [self.caption_re, self.google_re, self.entries_re,
+                        self.facebook_re, self.facebook_braodcasting_re,
+                        self.twitter_re]:
+            self.removal_rules.extend(
+                (attr, re.compile(pattern, re.I), False)
+                for attr in ['id', 'class'])
+        self.article_markers = ('descendant-or-self::article|'
+                                'descendant-or-self::*[@id="article"]|'
+                                'descendant-or-self::*[@itemprop="articleBody"]')
+        # attribute values seen before -> numbers of the rules they match,
+        # class names in particular repeat a lot within and across pages.
+        # Shared by the threads using this cleaner without a lock, see
+        # `ExtractionContext`
+        self.rule_matches = {}
 
-    def clean(self, doc_to_clean):
-        """Remove chunks of the DOM as specified
+    def clean(self, doc_to_clean, index=None):
+        """Remove chunks of the DOM as specified. `index` is the parser's
+        `DocumentIndex` of the document, built here if not given
         """
-        doc_to_clean = self.clean_body_classes(doc_to_clean)
-        doc_to_clean = self.clean_article_tags(doc_to_clean)
-        doc_to_clean = self.clean_em_tags(doc_to_clean)
-        doc_to_clean = self.remove_drop_caps(doc_to_clean)
-        doc_to_clean = self.remove_scripts_styles(doc_to_clean)
-        doc_to_clean = self.clean_bad_tags(doc_to_clean)
-        doc_to_clean = self.remove_nodes_regex(doc_to_clean, self.caption_re)
-        doc_to_clean = self.remove_nodes_regex(doc_to_clean, self.google_re)
-        doc_to_clean = self.remove_nodes_regex(doc_to_clean, self.entries_re)
-        doc_to_clean = self.remove_nodes_regex(doc_to_clean, self.facebook_re)
-        doc_to_clean = self.remove_nodes_regex(doc_to_clean,
-                                               self.facebook_braodcasting_re)
-        doc_to_clean = self.remove_nodes_regex(doc_to_clean, self.twitter_re)
-        doc_to_clean = self.clean_para_spans(doc_to_clean)
-        doc_to_clean = self.div_to_para(doc_to_clean, 'div')
-        doc_to_clean = self.div_to_para(doc_to_clean, 'span')
+        if index is None:
+            index = self.parser.build_index(doc_to_clean)
+        doc_to_clean = self.clean_body_classes(doc_to_clean, index)
+        doc_to_clean = self.clean_article_tags(doc_to_clean, index)
+        doc_to_clean = self.clean_em_tags(doc_to_clean, index)
+        doc_to_clean = self.remove_drop_caps(doc_to_clean, index)
+        doc_to_clean = self.remove_scripts_styles(doc_to_clean, index)
+        doc_to_clean = self.remove_bad_nodes(doc_to_clean, index)
+        doc_to_clean = self.clean_para_spans(doc_to_clean, index)
+        doc_to_clean = self.div_to_para(doc_to_clean, 'div', index)
+        doc_to_clean = self.div_to_para(doc_to_clean, 'span', index)
         return doc_to_clean
 
-    def clean_body_classes(self, doc):
+    def get_index(self, doc, index):
+        if index is None:
+            return self.parser.build_index(doc)
+        return index
+
+    def clean_body_classes(self, doc, index=None):
         """Removes the `class` attribute from the <body> tag because
         if there is a bad match, the entire DOM will be empty!
         """
-        elements = self.parser.getElementsByTag(doc, tag="body")
+        elements = self.get_index(doc, index).elements('body')
         if elements:
             self.parser.delAttribute(elements[0], attr="class")
         return doc
 
-    def clean_article_tags(self, doc):
-        articles = self.parser.getElementsByTag(doc, tag='article')
+    def clean_article_tags(self, doc, index=None):
+        articles = self.get_index(doc, index).elements('article')
         for article in articles:
             for attr in ['id', 'name', 'class']:
                 self.parser.delAttribute(article, attr=attr)
         return doc
 
-    def clean_em_tags(self, doc):
-        ems = self.parser.getElementsByTag(doc, tag='em')
+    def clean_em_tags(self, doc, index=None):
+        index = self.get_index(doc, index)
+        ems = index.elements('em')
         for node in ems:
             images = self.parser.getElementsByTag(node, tag='img')
             if len(images) == 0:
-                self.parser.drop_tag(node)
+                index.drop_tag(node)
         return doc
 
-    def remove_drop_caps(self, doc):
-        items = self.parser.css_select(doc, 'span[class~=dropcap], '
-                                       'span[class~=drop_cap]')
+    def remove_drop_caps(self, doc, index=None):
+        index = self.get_index(doc, index)
+        items = index.with_token('class', 'dropcap', 'drop_cap')
         for item in items:
-            self.parser.drop_tag(item)
+            if item.tag == 'span':
+                index.drop_tag(item)
         return doc
 
-    def remove_scripts_styles(self, doc):
+    def remove_scripts_styles(self, doc, index=None):
+        index = self.get_index(doc, index)
         # remove scripts
-        scripts = self.parser.getElementsByTag(doc, tag='script')
+        scripts = index.elements('script')
         for item in scripts:
-            self.parser.remove(item)
+            index.remove(item)
         # remove styles
-        styles = self.parser.getElementsByTag(doc, tag='style')
+        styles = index.elements('style')
         for item in styles:
-            self.parser.remove(item)
+            index.remove(item)
         # remove comments
-        comments = self.parser.getComments(doc)
+        comments = index.get_comments()
         for item in comments:
-            self.parser.remove(item)
+            index.remove(item)
 
         return doc
 
-    def clean_bad_tags(self, doc):
-        # ids
-        naughty_list = self.parser.xpath_re(doc, self.nauthy_ids_re)
-        for node in naughty_list:
-            if not node.xpath(self.contains_article):
-                self.parser.remove(node)
-        # class
-        naughty_classes = self.parser.xpath_re(doc, self.nauthy_classes_re)
-        for node in naughty_classes:
-            if not node.xpath(self.contains_article):
-                self.parser.remove(node)
-        # name
-        naughty_names = self.parser.xpath_re(doc, self.nauthy_names_re)
-        for node in naughty_names:
-            if not node.xpath(self.contains_article):
-                self.parser.remove(node)
-        return doc
+    def remove_bad_nodes(self, doc, index=None):
+        """Applies the `removal_rules` one after the other, in one pass
+        over the indexed attributes instead of one XPath scan per rule.
+
+        A rule removes a node when its attribute matches, unless the rule
+        keeps nodes containing an article and the node still contains one
+        when that rule's turn comes. Whether it does is worked out bottom
+        up: a node is removed by the first rule it qualifies for, so an
+        article under a node survives up to the first rule which removes
+        a node between the two.
+        """
+        index = self.get_index(doc, index)
+        rules = self.removal_rules
+        never = len(rules)
+        no_article = -1
+
+        matched = {}
+        for attr in index.ATTRIBUTES:
+            for node in index.with_attribute(attr):
+                numbers = self.matching_rules(attr, node.get(attr))
+                if numbers:
+                    matched.setdefault(node, []).extend(numbers)
+        if not matched:
+            return doc
+        articles = set(self.parser.xpath_re(doc, self.article_markers))
+
+        # the matched nodes and articles as a tree of their own, each
+        # hanging from its closest ancestor among them
+        nodes = sorted(set(matched).union(articles), key=index.position.get)
+        parents = {}
+        for node in nodes:
+            for ancestor in node.iterancestors():
+                if ancestor in matched or ancestor in articles:
+                    parents[node] = ancestor
+                    break
 
-    def remove_nodes_regex(self, doc, pattern):
-        for selector in ['id', 'class']:
-            reg = "//*[re:test(@%s, '%s', 'i')]" % (selector, pattern)
-            naughty_list = self.parser.xpath_re(doc, reg)
-            for node in naughty_list:
-                self.parser.remove(node)
+        # bottom up: the rule removing each node, and for the articles
+        # under it the last rule before which they are all still there
+        removed_by = {}
+        article_until = {}
+        for node in reversed(nodes):
+            inner = article_until.get(node, no_article)
+            removed_by[node] = never
+            if node in matched and node.getparent() is not None:
+                for number in sorted(matched[node]):
+                    if not rules[number][2] or inner < number:
+                        removed_by[node] = number
+                        break
+            parent = parents.get(node)
+            if parent is not None:
+                here = never if node in articles else no_article
+                expiry = min(removed_by[node], max(here, inner))
+                if expiry > article_until.get(parent, no_article):
+                    article_until[parent] = expiry
+
+        # top down: a node removed along with an ancestor is not removed
+        # on its own
+        ancestor_removed_by = {}
+        removals = []
+        for position, node in enumerate(nodes):
+            parent = parents.get(node)
+            if parent is None:
+                ancestor_removed_by[node] = never
+            else:
+                ancestor_removed_by[node] = min(ancestor_removed_by[parent],
+                                                removed_by[parent])
+            if removed_by[node] < ancestor_removed_by[node]:
+                removals.append((removed_by[node], position, node))
+
+        for _, _, node in sorted(removals, key=lambda r: r[:2]):
+            index.remove(node)
         return doc
 
-    def clean_para_spans(self, doc):
-        spans = self.parser.css_select(doc, 'p span')
+    def matching_rules(self, attr, value):
+        """Numbers of the `removal_rules` on `attr` that `value` matches
+        """
+        key = (attr, value)
+        numbers = self.rule_matches.get(key)
+        if numbers is None:
+            if len(self.rule_matches) >= RULE_MATCHES_SIZE:
+                self.rule_matches.clear()
+            numbers = self.rule_matches[key] = tuple(
+                number for number, (rule_attr, regex, _)
+                in enumerate(self.removal_rules)
+                if rule_attr == attr and regex.search(value))
+        return numbers
+
+    def clean_para_spans(self, doc, index=None):
+        index = self.get_index(doc, index)
+        spans = [span for span in index.elements('span')
+                 if any(p.tag == 'p' for p in span.iterancestors())]
         for item in spans:
-            self.parser.drop_tag(item)
+            index.drop_tag(item)
         return doc
 
-    def get_flushed_buffer(self, replacement_text, doc):
-        return self.parser.textToPara(replacement_text)
+    def get_flushed_buffer(self, replacement, doc):
+        """The element parsing the buffered text and links as html would
+        give, a <span>, or a <div> when a link holds a block level tag.
+        It is filled by `fill_flushed_buffer` once the links have been
+        taken out of the tree
+        """
+        for node in replacement:
+            if not isinstance(node, str) and any(
+                    child.tag in block_tags for child in node.iter()):
+                return self.parser.createElement(tag='div')
+        return self.parser.createElement(tag='span')
+
+    def fill_flushed_buffer(self, buffer, replacement):
+        last = None
+        text = []
+        for node in replacement:
+            if isinstance(node, str):
+                text.append(node)
+                continue
+            text.append(' ')
+            if last is None:
+                # html parsers drop the whitespace a document starts with
+                buffer.text = ''.join(text).lstrip(' ') or None
+            else:
+                last.tail = ''.join(text)
+            self.parser.appendChild(buffer, node)
+            last = node
+            text = [' ']
+        if last is None:
+            buffer.text = ''.join(text).lstrip(' ') or None
+        else:
+            last.tail = ''.join(text)
 
     def replace_walk_left_right(self, kid, kid_text,
-                                replacement_text, nodes_to_remove):
+                                replacement, nodes_to_remove):
         kid_text_node = kid
         replace_text = self.tablines_replacements.replaceAll(kid_text)
         if len(replace_text) > 1:
             prev_node = self.parser.previousSibling(kid_text_node)
             while prev_node is not None \
                     and self.parser.getTag(prev_node) == "a" \
-                    and self.parser.getAttribute(
-                        prev_node, 'grv-usedalready') != 'yes':
-                outer = " " + self.parser.outerHtml(prev_node) + " "
-                replacement_text.append(outer)
-                nodes_to_remove.append(prev_node)
-                self.parser.setAttribute(prev_node, attr='grv-usedalready',
-                                         value='yes')
+                    and prev_node not in nodes_to_remove:
+                replacement.append(prev_node)
+                nodes_to_remove[prev_node] = None
                 prev_node = self.parser.previousSibling(prev_node)
 
-            replacement_text.append(replace_text)
+            replacement.append(replace_text)
             next_node = self.parser.nextSibling(kid_text_node)
             while next_node is not None \
                     and self.parser.getTag(next_node) == "a" \
-                    and self.parser.getAttribute(
-                        next_node, 'grv-usedalready') != 'yes':
-                outer = " " + self.parser.outerHtml(next_node) + " "
-                replacement_text.append(outer)
-                nodes_to_remove.append(next_node)
-                self.parser.setAttribute(next_node, attr='grv-usedalready',
-                                         value='yes')
+                    and next_node not in nodes_to_remove:
+                replacement.append(next_node)
+                nodes_to_remove[next_node] = None
                 next_node = self.parser.nextSibling(next_node)
 
-    def get_replacement_nodes(self, doc, div):
-        replacement_text = []
+    def get_replacement_nodes(self, doc, div, moved=None):
+        """Runs of text and the links next to them become new <span>s,
+        the links are moved into them, added to `moved`, and leave an
+        empty <a> behind
+        """
+        replacement = []
+        buffers = []
         nodes_to_return = []
-        nodes_to_remove = []
+        # links in the order they were taken, an ordered set
+        nodes_to_remove = OrderedDict()
         kids = self.parser.childNodesWithText(div)
         for kid in kids:
             # The node is a <p> and already has some replacement text
-            if self.parser.getTag(kid) == 'p' and len(replacement_text) > 0:
-                new_node = self.get_flushed_buffer(
-                    ''.join(replacement_text), doc)
+            if self.parser.getTag(kid) == 'p' and len(replacement) > 0:
+                new_node = self.get_flushed_buffer(replacement, doc)
+                buffers.append((new_node, replacement))
                 nodes_to_return.append(new_node)
-                replacement_text = []
+                replacement = []
                 nodes_to_return.append(kid)
             # The node is a text node
             elif self.parser.isTextNode(kid):
                 kid_text = self.parser.getText(kid)
-                self.replace_walk_left_right(kid, kid_text, replacement_text,
+                self.replace_walk_left_right(kid, kid_text, replacement,
                                              nodes_to_remove)
             else:
                 nodes_to_return.append(kid)
 
         # flush out anything still remaining
-        if(len(replacement_text) > 0):
-            new_node = self.get_flushed_buffer(''.join(replacement_text), doc)
+        if(len(replacement) > 0):
+            new_node = self.get_flushed_buffer(replacement, doc)
+            buffers.append((new_node, replacement))
             nodes_to_return.append(new_node)
-            replacement_text = []
+            replacement = []
 
         for n in nodes_to_remove:
-            self.parser.remove(n)
+            self.parser.detach(n)
+        if moved is not None:
+            moved.extend(nodes_to_remove)
+        for new_node, replacement in buffers:
+            self.fill_flushed_buffer(new_node, replacement)
 
-        return nodes_to_return
+        return [self.parser.createElement(tag='a')
+                if n in nodes_to_remove else n for n in nodes_to_return]
 
     def replace_with_para(self, doc, div):
         self.parser.replaceTag(div, 'p')
 
-    def div_to_para(self, doc, dom_type):
+    def div_to_para(self, doc, dom_type, index=None):
         bad_divs = 0
         else_divs = 0
-        divs = self.parser.getElementsByTag(doc, tag=dom_type)
+        index = self.get_index(doc, index)
+        divs = index.elements(dom_type)
         tags = ['a', 'blockquote', 'dl', 'div', 'img', 'ol', 'p',
                 'pre', 'table', 'ul']
+        # the links moved into a new <span> are left as they are
+        moved = set()
         for div in divs:
-            items = self.parser.getElementsByTags(div, tags)
-            if div is not None and len(items) == 0:
+            if div in moved:
+                continue
+            items = next(div.iterdescendants(*tags), None)
+            if div is not None and items is None:
                 self.replace_with_para(doc, div)
                 bad_divs += 1
             elif div is not None:
-                replace_nodes = self.get_replacement_nodes(doc, div)
-                replace_nodes = [n for n in replace_nodes if n is not None]
-                attrib = copy.deepcopy(div.attrib)
+                links = []
+                replace_nodes = self.get_replacement_nodes(doc, div, links)
+                for link in links:
+                    moved.update(link.iterdescendants(dom_type))
+                attrib = dict(div.attrib)
                 div.clear()
-                for i, node in enumerate(replace_nodes):
-                    div.insert(i, node)
+                for node in replace_nodes:
+                    div.append(node)
                 for name, value in attrib.items():
                     div.set(name, value)
                 else_divs += 1
+        # elements were renamed and created
+        index.invalidate()
         return doc
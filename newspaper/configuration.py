@@ -34,6 +34,7 @@ class Configuration(object):
         self.MAX_AUTHORS = 10  # num strings in list
         self.MAX_SUMMARY = 5000  # num of chars
         self.MAX_SUMMARY_SENT = 5  # num of sentences
+        self.MAX_HTML_BYTES = 5 * 1024 * 1024  # num of bytes downloaded
 
         # max number of urls we cache for each news source
         self.MAX_FILE_MEMO = 20000
@@ -45,6 +46,14 @@ class Configuration(object):
         self.fetch_images = True
         self.image_dimension_ration = 16 / 9.0
 
+        # Revalidate source homepages, categories and feeds against an
+        # on-disk cache with ETag / Last-Modified conditional requests
+        self.use_http_cache = True
+        # num of responses kept in the on-disk http cache
+        self.MAX_HTTP_CACHE_ENTRIES = 2000
+        # num of parsed docs of unchanged source pages kept in memory
+        self.MAX_CACHED_DOCS = 256
+
         # Follow meta refresh redirect when downloading
         self.follow_meta_refresh = False
 
@@ -69,10 +78,62 @@ class Configuration(object):
         self.proxies = {}
         self.number_threads = 10
 
+        # Stream response bodies, dropping binary payloads (pdf, video,
+        # ..) unread and cutting html off after MAX_HTML_BYTES
+        self.stream_downloads = True
+
+        # Retries of failed GETs, with jittered exponential backoff or
+        # the wait a 429 / 503 Retry-After header asks for
+        self.request_retries = 2
+        self.retry_backoff_seconds = 0.5
+        self.max_retry_wait_seconds = 30
+
+        # Stop sending requests to a host after this many consecutive
+        # failures, probe it again after the cooldown
+        self.breaker_failure_threshold = 5
+        self.breaker_cooldown_seconds = 60
+
+        # Keep-alive connections kept open per host, shared by every
+        # download made with this config. Never fewer than
+        # `number_threads`, or concurrent requests to one host would block
+        self.pool_maxsize = 10
+        # Hosts whose sessions are kept open, the least recently used
+        # ones are closed past it
+        self.max_sessions = 100
+
+        # Keep the cookies a host sets for its later requests. Off, every
+        # request starts with an empty cookie jar
+        self.persist_cookies = False
+
+        # Max concurrent requests of the asyncio download engine
+        self.async_connections = 100
+
+        # Worker processes `Source.parse_articles` parses with, 1 parses
+        # in this process, and the number of articles sent to a worker
+        # at a time
+        self.parse_processes = 1
+        self.parse_chunksize = 8
+
+        # Called as stage_hook(url, stage, seconds, nodes, size) after
+        # each stage of downloading and parsing an article, e.g. with an
+        # `instrument.StageStats`. None adds no timing at all
+        self.stage_hook = None
+
+        # Fraction of `Article.parse` calls run under cProfile, their
+        # collapsed stacks are written to `profile_dir` (default
+        # ~/.newspaper_scraper/profiles)
+        self.profile_sample_rate = 0.0
+        self.profile_dir = None
+
         self.verbose = False  # for debugging
 
+        # Deprecated, no longer used: threads are not joined with a
+        # timeout since downloads run on the shared executor
         self.thread_timeout_seconds = 1
 
+        # Min seconds between two requests to the same host in a NewsPool
+        self.host_delay_seconds = 0
+
         # Set this to False if you want to recompute the categories
         # *every* time you build a `Source` object
         # TODO: Actually make this work
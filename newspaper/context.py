@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+Extraction state which is the same for every article of a language lives
+in this file. It is made once and shared by every article, `fulltext`
+call and thread instead of being rebuilt per article.
+"""
+__title__ = 'newspaper'
+__author__ = 'Lucas Ou-Yang'
+__license__ = 'MIT'
+__copyright__ = 'Copyright 2014, Lucas Ou-Yang'
+
+import logging
+from threading import Lock
+
+from .cleaners import DocumentCleaner
+
+log = logging.getLogger(__name__)
+
+
+class ExtractionContext(object):
+    """What extracting an article of `language` shares with every other
+    parse: the stopwords instance, the document cleaner with its compiled
+    removal rules and the lxml cleaner behind `Parser.clean_article_html`.
+    All of it is read only, except the cleaner's `rule_matches` memo,
+    which every parse on every thread fills on purpose so class names
+    are matched once per process. Its races are harmless: an entry is a
+    pure function of its key, and a lost or repeated insert only costs
+    a recomputation. State of one parse, scores and text figures, stays
+    on the extractor and formatter of that parse. Use `get_context`
+    rather than making one directly.
+    """
+    def __init__(self, config, language, stopwords_class):
+        self.language = language
+        self.stopwords_class = stopwords_class
+        self.parser = config.get_parser()
+        self.stopwords = stopwords_class(language=language)
+        self.document_cleaner = DocumentCleaner(config)
+        self.article_cleaner = self.parser.get_article_cleaner()
+
+
+_contexts = {}
+_contexts_lock = Lock()
+
+
+def get_context(config, language=None, stopwords_class=None):
+    """The shared `ExtractionContext` of `config`'s parser for `language`,
+    the config's language by default, made on first use
+    """
+    language = language or config.language
+    if stopwords_class is None:
+        if language == config.language:
+            stopwords_class = config.stopwords_class
+        else:
+            stopwords_class = config.get_stopwords_class(language)
+    key = (config.get_parser(), stopwords_class, language)
+    context = _contexts.get(key)
+    if context is None:
+        with _contexts_lock:
+            context = _contexts.get(key)
+            if context is None:
+                log.debug('Making the extraction context for %s' % language)
+                context = ExtractionContext(config, language,
+                                            stopwords_class)
+                _contexts[key] = context
+    return context
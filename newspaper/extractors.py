@@ -21,6 +21,7 @@ from tldextract import tldextract
 from urllib.parse import urljoin, urlparse, urlunparse
 
 from . import urls
+from .context import get_context
 from .utils import StringReplacement, StringSplitter
 
 log = logging.getLogger(__name__)
@@ -57,6 +58,15 @@ class ContentExtractor(object):
         self.parser = self.config.get_parser()
         self.language = config.language
         self.stopwords_class = config.stopwords_class
+        # counts the stopwords of every node, see `get_stopwords`
+        self.stopwords = None
+        # text figures of the document being extracted, see
+        # `get_text_stats`
+        self.text_stats = None
+        # scores and counts of decent nodes below, of the nodes
+        # `calculate_best_node` scored last
+        self.scores = {}
+        self.node_counts = {}
 
     def update_language(self, meta_lang):
         """Required to be called before the extraction process in some
@@ -67,6 +77,8 @@ class ContentExtractor(object):
             self.language = meta_lang
             self.stopwords_class = \
                 self.config.get_stopwords_class(meta_lang)
+            self.stopwords = None
+            self.text_stats = None
 
     def get_authors(self, doc):
         """Fetch the authors of the article, return as a list
@@ -762,9 +774,32 @@ class ContentExtractor(object):
                 tags.append(tag)
         return set(tags)
 
-    def calculate_best_node(self, doc):
+    def get_stopwords(self):
+        """The one `stopwords_class` instance counting stopwords for the
+        extractor's language, borrowed from the shared extraction context
+        """
+        if self.stopwords is None:
+            self.stopwords = get_context(
+                self.config, self.language, self.stopwords_class).stopwords
+        return self.stopwords
+
+    def get_text_stats(self):
+        """The `TextStats` heuristics read text figures from, elements
+        missing from it are added when first asked about
+        """
+        if self.text_stats is None:
+            self.text_stats = self.parser.build_text_stats(
+                self.get_stopwords())
+        return self.text_stats
+
+    def calculate_best_node(self, doc, index=None):
         top_node = None
-        nodes_to_check = self.nodes_to_check(doc)
+        nodes_to_check = self.nodes_to_check(doc, index)
+        self.text_stats = self.parser.build_text_stats(
+            self.get_stopwords(), doc)
+        stats = self.text_stats
+        self.scores = {}
+        self.node_counts = {}
         starting_boost = float(1.0)
         cnt = 0
         i = 0
@@ -772,11 +807,8 @@ class ContentExtractor(object):
         nodes_with_text = []
 
         for node in nodes_to_check:
-            text_node = self.parser.getText(node)
-            word_stats = self.stopwords_class(language=self.language). \
-                get_stopword_count(text_node)
             high_link_density = self.is_highlink_density(node)
-            if word_stats.get_stopword_count() > 2 and not high_link_density:
+            if stats.stopword_count(node) > 2 and not high_link_density:
                 nodes_with_text.append(node)
 
         nodes_number = len(nodes_with_text)
@@ -800,10 +832,7 @@ class ContentExtractor(object):
                     if negscore > 40:
                         boost_score = float(5)
 
-            text_node = self.parser.getText(node)
-            word_stats = self.stopwords_class(language=self.language). \
-                get_stopword_count(text_node)
-            upscore = int(word_stats.get_stopword_count() + boost_score)
+            upscore = int(stats.stopword_count(node) + boost_score)
 
             parent_node = self.parser.getParent(node)
             self.update_score(parent_node, upscore)
@@ -853,10 +882,9 @@ class ContentExtractor(object):
             if current_node_tag == para:
                 if steps_away >= max_stepsaway_from_node:
                     return False
-                paragraph_text = self.parser.getText(current_node)
-                word_stats = self.stopwords_class(language=self.language). \
-                    get_stopword_count(paragraph_text)
-                if word_stats.get_stopword_count() > minimum_stopword_count:
+                stopword_count = self.get_text_stats().stopword_count(
+                    current_node)
+                if stopword_count > minimum_stopword_count:
                     return True
                 steps_away += 1
         return False
@@ -878,12 +906,17 @@ class ContentExtractor(object):
             self, current_sibling, baseline_score_siblings_para):
         """Adds any siblings that may have a decent score to this node
         """
+        stats = self.get_text_stats()
         if current_sibling.tag == 'p' and \
-                        len(self.parser.getText(current_sibling)) > 0:
+                        stats.word_count(current_sibling) > 0:
             e0 = current_sibling
             if e0.tail:
                 e0 = copy.deepcopy(e0)
                 e0.tail = ''
+                # the copy is scored as the sibling is
+                for node, node_copy in zip(current_sibling.iter(), e0.iter()):
+                    if node in self.scores:
+                        self.scores[node_copy] = self.scores[node]
             return [e0]
         else:
             potential_paragraphs = self.parser.getElementsByTag(
@@ -893,18 +926,16 @@ class ContentExtractor(object):
             else:
                 ps = []
                 for first_paragraph in potential_paragraphs:
-                    text = self.parser.getText(first_paragraph)
-                    if len(text) > 0:
-                        word_stats = self.stopwords_class(
-                            language=self.language). \
-                            get_stopword_count(text)
-                        paragraph_score = word_stats.get_stopword_count()
+                    if stats.word_count(first_paragraph) > 0:
+                        paragraph_score = stats.stopword_count(
+                            first_paragraph)
                         sibling_baseline_score = float(.30)
                         high_link_density = self.is_highlink_density(
                             first_paragraph)
                         score = float(baseline_score_siblings_para *
                                       sibling_baseline_score)
                         if score < paragraph_score and not high_link_density:
+                            text = self.parser.getText(first_paragraph)
                             p = self.parser.createElement(
                                 tag='p', text=text, tail=None)
                             ps.append(p)
@@ -923,15 +954,14 @@ class ContentExtractor(object):
         paragraphs_number = 0
         paragraphs_score = 0
         nodes_to_check = self.parser.getElementsByTag(top_node, tag='p')
+        stats = self.get_text_stats()
 
         for node in nodes_to_check:
-            text_node = self.parser.getText(node)
-            word_stats = self.stopwords_class(language=self.language). \
-                get_stopword_count(text_node)
+            stopword_count = stats.stopword_count(node)
             high_link_density = self.is_highlink_density(node)
-            if word_stats.get_stopword_count() > 2 and not high_link_density:
+            if stopword_count > 2 and not high_link_density:
                 paragraphs_number += 1
-                paragraphs_score += word_stats.get_stopword_count()
+                paragraphs_score += stopword_count
 
         if paragraphs_number > 0:
             base = paragraphs_score / paragraphs_number
@@ -939,50 +969,36 @@ class ContentExtractor(object):
         return base
 
     def update_score(self, node, add_to_score):
-        """Adds a score to the gravityScore Attribute we put on divs
-        we'll get the current score then add the score we're passing
-        in to the current.
+        """Adds a score to the one kept for the node in `scores`,
+        the DOM is left as it is
         """
-        current_score = 0
-        score_string = self.parser.getAttribute(node, 'gravityScore')
-        if score_string:
-            current_score = float(score_string)
-
-        new_score = current_score + add_to_score
-        self.parser.setAttribute(node, "gravityScore", str(new_score))
+        current_score = self.scores.get(node, 0)
+        self.scores[node] = float(current_score + add_to_score)
 
     def update_node_count(self, node, add_to_count):
         """Stores how many decent nodes are under a parent node
         """
-        current_score = 0
-        count_string = self.parser.getAttribute(node, 'gravityNodes')
-        if count_string:
-            current_score = int(count_string)
-
-        new_score = current_score + add_to_count
-        self.parser.setAttribute(node, "gravityNodes", str(new_score))
+        current_count = self.node_counts.get(node, 0)
+        self.node_counts[node] = current_count + add_to_count
 
     def is_highlink_density(self, e):
         """Checks the density of links within a node, if there is a high
         link to text ratio, then the text is less likely to be relevant
         """
-        links = self.parser.getElementsByTag(e, tag='a')
+        stats = self.get_text_stats()
+        links = stats.link_count(e)
         if not links:
             return False
 
-        text = self.parser.getText(e)
-        words = [word for word in text.split() if word.isalnum()]
-        if not words:
+        words_number = float(stats.alnum_word_count(e))
+        if not words_number:
             return True
-        words_number = float(len(words))
-        sb = []
-        for link in links:
-            sb.append(self.parser.getText(link))
-
-        link_text = ''.join(sb)
-        link_words = link_text.split()
-        num_link_words = float(len(link_words))
-        num_links = float(len(links))
+        # the texts of the links are joined without spaces, so the last
+        # and first words of two links with text count as one
+        link_words = stats.link_word_count(e) - max(
+            stats.links_with_text_count(e) - 1, 0)
+        num_link_words = float(link_words)
+        num_links = float(links)
         link_divisor = float(num_link_words / words_number)
         score = float(link_divisor * num_links)
         if score >= 1.0:
@@ -991,23 +1007,23 @@ class ContentExtractor(object):
         # return True if score > 1.0 else False
 
     def get_score(self, node):
-        """Returns the gravityScore as an integer from this node
+        """Returns the score of this node, 0 if it has none
         """
         return self.get_node_gravity_score(node) or 0
 
     def get_node_gravity_score(self, node):
-        gravity_score = self.parser.getAttribute(node, 'gravityScore')
-        if not gravity_score:
-            return None
-        return float(gravity_score)
+        return self.scores.get(node)
 
-    def nodes_to_check(self, doc):
+    def nodes_to_check(self, doc, index=None):
         """Returns a list of nodes we want to search
         on like paragraphs and tables
         """
         nodes_to_check = []
         for tag in ['p', 'pre', 'td']:
-            items = self.parser.getElementsByTag(doc, tag=tag)
+            if index is not None:
+                items = index.elements(tag)
+            else:
+                items = self.parser.getElementsByTag(doc, tag=tag)
             nodes_to_check += items
         return nodes_to_check
 
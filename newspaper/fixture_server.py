@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for the web, so downloads can be benchmarked and tested
+deterministically on a machine with no network. Pages are served from a
+WARC archive recorded with `network.RecordingTransport`, from a directory
+of html files, or generated on the fly. Latency, errors and throughput
+limits can be injected.
+"""
+__title__ = 'newspaper'
+__author__ = 'Lucas Ou-Yang'
+__license__ = 'MIT'
+__copyright__ = 'Copyright 2014, Lucas Ou-Yang'
+
+import logging
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from .network import read_warc
+
+log = logging.getLogger(__name__)
+
+
+class FixtureServer(object):
+    """Serves GET requests on a free localhost port. Requests may be sent
+    directly (`server.url('/a.html')`) or, to replay a whole crawl, with
+    the server set as the http proxy:
+    `config.proxies = {'http': server.base_url}`.
+
+    Pages are looked up in `archive` by full url, then in `directory`
+    by path, then generated with `page_bytes` bytes if it is set.
+    Anything else is a 404.
+
+    `latency` (+ up to `jitter`) seconds are waited before each reply,
+    `error_rate` of the replies are 503s and bodies are sent at most
+    `bytes_per_second` fast. Randomness is seeded by `seed`.
+    """
+    def __init__(self, archive=None, directory=None, page_bytes=None,
+                 latency=0, jitter=0, error_rate=0, bytes_per_second=None,
+                 seed=0):
+        self.records = {}
+        if archive:
+            for record in read_warc(archive):
+                self.records[record['url']] = record
+        self.directory = directory
+        self.page_bytes = page_bytes
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.bytes_per_second = bytes_per_second
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.requests_served = 0
+        self.server = None
+        self.base_url = None
+
+    def start(self):
+        fixture = self
+
+        class Handler(FixtureHandler):
+            server_fixture = fixture
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_port
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def url(self, path):
+        return self.base_url + '/' + path.lstrip('/')
+
+    def urls(self):
+        """Urls of every page in `directory`
+        """
+        if not self.directory:
+            return []
+        return [self.url(name) for name in sorted(os.listdir(self.directory))]
+
+    def _roll(self):
+        """Returns (seconds to wait, whether to fail) for one request
+        """
+        with self.random_lock:
+            self.requests_served += 1
+            wait = self.latency + self.random.uniform(0, self.jitter)
+            fail = self.random.random() < self.error_rate
+        return wait, fail
+
+    def lookup(self, url):
+        """Returns (status, headers, body) for a requested url
+        """
+        record = self.records.get(url)
+        if record is not None:
+            return record['status'], record['headers'], record['content']
+
+        path = urlsplit(url).path.lstrip('/')
+        if self.directory and path:
+            file_path = os.path.join(self.directory, path)
+            if os.path.isfile(file_path):
+                with open(file_path, 'rb') as f:
+                    body = f.read()
+                return 200, {'Content-Type': 'text/html; charset=utf-8'}, body
+
+        if self.page_bytes:
+            return 200, {'Content-Type': 'text/html; charset=utf-8'}, \
+                generate_page(url, self.page_bytes)
+        return 404, {'Content-Type': 'text/html'}, b'<html>not found</html>'
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_fixture = None
+
+    def do_GET(self):
+        fixture = self.server_fixture
+        url = self.path
+        if not urlsplit(url).scheme:
+            # sent directly rather than through the server as a proxy
+            url = fixture.base_url + self.path
+
+        wait, fail = fixture._roll()
+        if wait:
+            time.sleep(wait)
+        if fail:
+            status, headers, body = 503, {}, b''
+        else:
+            status, headers, body = fixture.lookup(url)
+
+        self.send_response(status)
+        for key, value in headers.items():
+            if key.lower() not in ('content-length', 'content-encoding',
+                                   'transfer-encoding', 'connection'):
+                self.send_header(key, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self._write_body(body, fixture.bytes_per_second)
+
+    def _write_body(self, body, bytes_per_second):
+        if not bytes_per_second:
+            self.wfile.write(body)
+            return
+        # 10 writes a second at the throughput limit
+        chunk_size = max(1, int(bytes_per_second / 10))
+        for i in range(0, len(body), chunk_size):
+            chunk = body[i:i + chunk_size]
+            self.wfile.write(chunk)
+            time.sleep(len(chunk) / float(bytes_per_second))
+
+    def log_message(self, *args):
+        pass
+
+
+def generate_page(url, size):
+    """Deterministic html article page of about `size` bytes for `url`
+    """
+    rand = random.Random(url)
+    words = ['the', 'storm', 'news', 'city', 'of', 'and', 'report', 'said',
+             'a', 'on', 'officials', 'in', 'weather', 'week', 'to', 'travel']
+    head = ('<html><head><title>%s</title></head><body><article>' %
+            url).encode('utf-8')
+    tail = b'</article></body></html>'
+    paragraphs = []
+    length = len(head) + len(tail)
+    while length < size:
+        para = '<p>%s.</p>' % ' '.join(rand.choice(words) for _ in range(60))
+        paragraphs.append(para.encode('utf-8'))
+        length += len(paragraphs[-1])
+    return head + b''.join(paragraphs) + tail
@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in timing of the stages an article goes through. Set
+`config.stage_hook` to a callable and it is called after every stage as
+
+    hook(url, stage, seconds, nodes, size)
+
+with the stage's name (one of `STAGES`), its duration, the number of DOM
+nodes it returned and the byte size of the html or text it worked on.
+Figures which don't apply to a stage are None. `StageStats` is such a
+hook, it keeps per domain histograms of every stage.
+
+`config.profile_sample_rate` runs that fraction of `Article.parse` calls
+under cProfile and writes their collapsed stacks, the input of
+flamegraph.pl and speedscope, to `config.profile_dir`.
+
+Both are off by default and cost one None check per parse then. Hooks
+only see the parses of their own process, with `parse_processes` above 1
+they are copied into each worker.
+"""
+__title__ = 'newspaper'
+__author__ = 'Lucas Ou-Yang'
+__license__ = 'MIT'
+__copyright__ = 'Copyright 2014, Lucas Ou-Yang'
+
+import bisect
+import cProfile
+import json
+import logging
+import os
+import pstats
+import time
+from threading import Lock
+
+import lxml.etree
+
+from . import urls
+from .parsers import DocumentIndex
+from .settings import PROFILE_DIRECTORY
+
+log = logging.getLogger(__name__)
+
+STAGES = ('download', 'decode', 'fromstring', 'index', 'clean',
+          'best_node', 'post_cleanup', 'format', 'nlp')
+
+
+def untimed(stage, func, *args):
+    return func(*args)
+
+
+def byte_size(html):
+    if isinstance(html, str):
+        return len(html.encode('utf-8'))
+    return len(html)
+
+
+def measure(args, result):
+    """(nodes, size) of a stage called with `args` which returned `result`.
+    The size is the one of the html or text returned, that of the html
+    the stage was given if it returned a doc
+    """
+    nodes = size = None
+    if isinstance(result, DocumentIndex):
+        nodes = len(result.position)
+    elif isinstance(result, lxml.etree._Element):
+        nodes = sum(1 for _ in result.iter())
+    elif isinstance(result, (str, bytes)):
+        size = byte_size(result)
+    elif isinstance(result, tuple) and result and \
+            isinstance(result[0], (str, bytes)):
+        # (html, encoding) of a download, (text, html) of the formatter
+        size = byte_size(result[0])
+    if size is None and args and isinstance(args[0], (str, bytes)):
+        size = byte_size(args[0])
+    return nodes, size
+
+
+class StageTimer(object):
+    """Runs the stages of the article at `url` and reports each to `hook`
+    """
+    def __init__(self, hook, url):
+        self.hook = hook
+        self.url = url
+
+    def __call__(self, stage, func, *args):
+        ts = time.perf_counter()
+        result = func(*args)
+        seconds = time.perf_counter() - ts
+        nodes, size = measure(args, result)
+        try:
+            self.hook(self.url, stage, seconds, nodes, size)
+        except Exception as e:
+            log.debug('Stage hook failed on %s %s with %r' %
+                      (stage, self.url, e))
+        return result
+
+
+def stage_timer(hook, url):
+    """A `timed(stage, func, *args)` callable returning `func(*args)`,
+    which times it for `hook` if there is one
+    """
+    if hook is None:
+        return untimed
+    return StageTimer(hook, url)
+
+
+class StageStats(object):
+    """A `stage_hook` which keeps, per domain and stage, the count and
+    total of durations, nodes and sizes and a histogram of durations
+
+    >>> stats = StageStats()
+    >>> config.stage_hook = stats
+    >>> ...
+    >>> stats.dump('stages.json')
+    """
+    # upper bounds of the histogram buckets, in msec
+    BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)
+
+    def __init__(self):
+        self.lock = Lock()
+        self.domains = {}
+
+    def __getstate__(self):
+        with self.lock:
+            return {'domains': self.domains}
+
+    def __setstate__(self, state):
+        self.lock = Lock()
+        self.domains = state['domains']
+
+    def __call__(self, url, stage, seconds, nodes, size):
+        domain = urls.get_domain(url) or ''
+        bucket = bisect.bisect_left(self.BUCKETS, seconds * 1000.0)
+        with self.lock:
+            stages = self.domains.setdefault(domain, {})
+            s = stages.get(stage)
+            if s is None:
+                s = stages[stage] = {
+                    'count': 0, 'seconds': 0.0, 'max_seconds': 0.0,
+                    'nodes': 0, 'bytes': 0,
+                    'histogram': [0] * (len(self.BUCKETS) + 1)}
+            s['count'] += 1
+            s['seconds'] += seconds
+            s['max_seconds'] = max(s['max_seconds'], seconds)
+            s['nodes'] += nodes or 0
+            s['bytes'] += size or 0
+            s['histogram'][bucket] += 1
+
+    def histogram_labels(self):
+        return ['<=%dms' % b for b in self.BUCKETS] + \
+            ['>%dms' % self.BUCKETS[-1]]
+
+    def stats(self):
+        """Returns {domain: {stage: figures}}, histograms are keyed by
+        bucket label
+        """
+        labels = self.histogram_labels()
+        with self.lock:
+            return {domain: {stage: dict(s, histogram=dict(
+                             zip(labels, s['histogram'])))
+                             for stage, s in stages.items()}
+                    for domain, stages in self.domains.items()}
+
+    def dump(self, path=None):
+        """Writes `stats()` as JSON to `path`, returns the JSON if there
+        is no path
+        """
+        data = json.dumps(self.stats(), indent=2, sort_keys=True)
+        if path is None:
+            return data
+        with open(path, 'w') as f:
+            f.write(data)
+
+
+def func_name(func):
+    filename, line, name = func
+    if filename == '~':
+        return name  # builtins, e.g. <method 'iter' of 'lxml...'>
+    return '%s:%s' % (os.path.basename(filename), name)
+
+
+def collapsed_stacks(profile, max_depth=64, min_seconds=1e-5):
+    """Turns a cProfile `profile` into collapsed stacks, one
+    'caller;callee;... microseconds' line per call path. cProfile only
+    records caller -> callee edges, so a function's self time is split
+    among the paths leading to it in proportion to their time. Paths
+    taking less than `min_seconds` in all are left out
+    """
+    stats = pstats.Stats(profile).stats
+    children = {}
+    for func, (_, _, _, _, callers) in stats.items():
+        for caller, (_, _, _, cumulative) in callers.items():
+            children.setdefault(caller, []).append((func, cumulative))
+    roots = [func for func, (_, _, _, _, callers) in stats.items()
+             if not callers]
+    lines = {}
+
+    def walk(func, path, share):
+        _, _, self_time, cumulative, _ = stats[func]
+        path = path + (func_name(func),)
+        micros = int(self_time * share * 1e6)
+        if micros:
+            key = ';'.join(path)
+            lines[key] = lines.get(key, 0) + micros
+        if len(path) >= max_depth:
+            return
+        for child, edge_time in children.get(func, ()):
+            child_cumulative = stats[child][3]
+            if child in on_path or not child_cumulative or \
+                    share * edge_time < min_seconds:
+                continue
+            on_path.add(child)
+            walk(child, path, share * edge_time / child_cumulative)
+            on_path.discard(child)
+
+    for root in roots:
+        on_path = set([root])
+        walk(root, (), 1.0)
+    return ['%s %d' % (stack, micros) for stack, micros in
+            sorted(lines.items())]
+
+
+def write_profile(profile, name, profile_dir=None):
+    """Writes the collapsed stacks of `profile` to `name`.collapsed in
+    `profile_dir`, returns the file's path
+    """
+    profile_dir = profile_dir or PROFILE_DIRECTORY
+    os.makedirs(profile_dir, exist_ok=True)
+    path = os.path.join(profile_dir, '%s.collapsed' % name)
+    with open(path, 'w') as f:
+        f.write('\n'.join(collapsed_stacks(profile)) + '\n')
+    return path
+
+
+def profiled(func, *args):
+    """Runs `func(*args)` under cProfile, returns (result, profile)
+    """
+    profile = cProfile.Profile()
+    result = profile.runcall(func, *args)
+    return result, profile
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+"""
+Anything that runs across processes in this library must be abstracted
+in this file, the same way threading lives in mthreading.py. Parsing is
+cpu bound, so it only scales past one core in separate processes.
+"""
+__title__ = 'newspaper'
+__author__ = 'Lucas Ou-Yang'
+__license__ = 'MIT'
+__copyright__ = 'Copyright 2014, Lucas Ou-Yang'
+
+import collections
+import itertools
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from . import nlp
+from .article import Article
+from .configuration import Configuration
+from .context import get_context
+
+log = logging.getLogger(__name__)
+
+
+def warm_worker(language='en'):
+    """Process initializer, makes the extraction context of `language`
+    and loads the sentence tokenizer once so no parse in this worker
+    pays for them
+    """
+    config = Configuration()
+    config.language = language
+    get_context(config)
+    try:
+        nlp.load_stopwords(language)
+    except IOError:
+        log.debug('No nlp stopwords for language %s' % language)
+    try:
+        import nltk.data
+        nltk.data.load('tokenizers/punkt/english.pickle')
+    except (ImportError, LookupError):
+        log.debug('No nltk sentence tokenizer to preload')
+
+
+def parse_html(url, html, config, encoding=None):
+    """Parses one article in a worker, `html` may be undecoded bytes of
+    charset `encoding`. Returns a compact dict of what was extracted,
+    lxml trees never cross the process boundary
+    """
+    article = Article(url, config=config)
+    article.set_html(html, encoding)
+    try:
+        text = article.parse()
+    except Exception as e:
+        log.debug('Parsing %s failed with %r' % (url, e))
+        return {'url': url, 'error': repr(e)}
+    return {'url': url,
+            'text': text or '',
+            'link_hash': getattr(article, 'link_hash', None),
+            'is_parsed': article.is_parsed}
+
+
+def _parse_job(job):
+    return parse_html(*job)
+
+
+def parse_many(jobs, processes=None, chunksize=1, language='en'):
+    """Parses (url, html, config, encoding) `jobs` on `processes` worker
+    processes (default: one per cpu), `chunksize` jobs are sent to a
+    worker at a time. Yields the `parse_html` results in `jobs` order
+    """
+    processes = processes or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=processes,
+                             initializer=warm_worker,
+                             initargs=(language,)) as executor:
+        for result in executor.map(_parse_job, jobs, chunksize=chunksize):
+            yield result
+
+
+def is_path(doc):
+    """True if `doc` is an `os.PathLike`, or a str naming an existing
+    file rather than holding html
+    """
+    if isinstance(doc, os.PathLike):
+        return True
+    return isinstance(doc, str) and '<' not in doc and os.path.isfile(doc)
+
+
+def fulltext_chunk(chunk, language='en', encoding=None):
+    """Runs `api.fulltext` on each (index, doc) of `chunk` in a worker.
+    A doc is html as str or bytes, or the path of an html file, read
+    here so the parent never loads it. Returns a list of (index, text),
+    text is None if the doc could not be read or parsed
+    """
+    from .api import fulltext
+    results = []
+    for index, doc in chunk:
+        try:
+            if is_path(doc):
+                with open(doc, 'rb') as f:
+                    doc = f.read()
+            text = fulltext(doc, language, encoding)
+        except Exception as e:
+            log.debug('fulltext of doc %d failed with %r' % (index, e))
+            text = None
+        results.append((index, text))
+    return results
+
+
+class FulltextBatch(object):
+    """Iterating over a batch extracts the fulltext of every doc of
+    `docs` on `workers` processes (default: one per cpu) and yields
+    (index, text) pairs, in `docs` order unless `ordered` is False, in
+    which case each chunk is yielded as soon as it is done. `chunksize`
+    docs are sent to a worker at a time and at most `window` chunks
+    (default 2 per worker) are in flight, so `docs` can be a generator
+    over millions of pages without being read ahead.
+
+    `stats()` reports the docs done so far and their docs/sec, it is
+    also logged once the batch is exhausted.
+    """
+    def __init__(self, docs, language='en', workers=None, chunksize=16,
+                 ordered=True, encoding=None, window=None):
+        self.docs = docs
+        self.language = language
+        self.workers = workers or os.cpu_count() or 1
+        self.chunksize = chunksize
+        self.ordered = ordered
+        self.encoding = encoding
+        self.window = window or 2 * self.workers
+        self.done = 0
+        self.failed = 0
+        self.started = None
+        self.finished = None
+
+    def stats(self):
+        """Returns a dict with the 'docs' and 'failed' counts so far, the
+        'seconds' spent and the resulting 'docs_per_sec'
+        """
+        if self.started is None:
+            seconds = 0.0
+        else:
+            seconds = (self.finished or time.time()) - self.started
+        return {'docs': self.done,
+                'failed': self.failed,
+                'seconds': seconds,
+                'docs_per_sec': self.done / seconds if seconds else 0.0}
+
+    def _chunks(self):
+        docs = enumerate(self.docs)
+        while True:
+            chunk = list(itertools.islice(docs, self.chunksize))
+            if not chunk:
+                return
+            yield chunk
+
+    def _count(self, results):
+        self.done += len(results)
+        self.failed += sum(1 for _, text in results if text is None)
+        return results
+
+    def __iter__(self):
+        self.started = time.time()
+        self.finished = None
+        self.done = 0
+        self.failed = 0
+        chunks = self._chunks()
+        pending = collections.deque()
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 initializer=warm_worker,
+                                 initargs=(self.language,)) as executor:
+            def submit(n):
+                for chunk in itertools.islice(chunks, n):
+                    pending.append(executor.submit(
+                        fulltext_chunk, chunk, self.language,
+                        self.encoding))
+            try:
+                submit(self.window)
+                while pending:
+                    if self.ordered:
+                        future = pending.popleft()
+                    else:
+                        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                        future = done.pop()
+                        pending.remove(future)
+                    submit(1)
+                    for result in self._count(future.result()):
+                        yield result
+            finally:
+                for future in pending:
+                    future.cancel()
+        self.finished = time.time()
+        stats = self.stats()
+        log.info('fulltext of %d docs (%d failed) in %2.2f sec, '
+                 '%2.2f docs/sec' % (stats['docs'], stats['failed'],
+                                     stats['seconds'],
+                                     stats['docs_per_sec']))
@@ -9,50 +9,410 @@ __author__ = 'Lucas Ou-Yang'
 __license__ = 'MIT'
 __copyright__ = 'Copyright 2014, Lucas Ou-Yang'
 
+import logging
 import queue
-import traceback
-from threading import Thread
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from threading import Condition, Event, Lock, Thread, local
 
+from . import urls
 from .configuration import Configuration
 
+log = logging.getLogger(__name__)
 
-class Worker(Thread):
+# `executor` is the `Executor` owning the current thread, if any
+_worker = local()
+
+
+class DeadlineExceeded(TimeoutError):
+    """The task had not started running by its deadline
     """
-    Thread executing tasks from a given tasks queue.
+
+
+class Executor(object):
+    """Long-lived thread pool shared by the whole process. Worker threads
+    are started on demand, up to `max_workers`, and then kept, so
+    downloads stop paying for thread creation on every call.
+
+    `submit` returns a `concurrent.futures.Future`: callers can cancel
+    it and get the task's result or exception from it. A task given a
+    `deadline` (seconds) which has not started by then is skipped and
+    its future raises `DeadlineExceeded`.
+
+    A task submitted from one of the executor's own workers, like a
+    `multithread_request` made inside a submitted task, is queued like
+    any other while the pool has a thread for it. Once every thread is
+    busy or spoken for it runs inline in that worker instead: queueing
+    it behind the task waiting for it could leave every worker blocked
+    on work that never gets a thread.
     """
-    def __init__(self, tasks, timeout_seconds):
-        Thread.__init__(self)
-        self.tasks = tasks
-        self.timeout = timeout_seconds
-        self.daemon = True
-        self.start()
-
-    def run(self):
-        while True:
+    def __init__(self, max_workers=64):
+        self.max_workers = max_workers
+        self.lock = Lock()
+        self.workers = 0
+        self.busy = 0
+        self.queued = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.expired = 0
+        self.pool = ThreadPoolExecutor(max_workers=max_workers,
+                                       thread_name_prefix='newspaper',
+                                       initializer=self._worker_started)
+
+    def _worker_started(self):
+        _worker.executor = self
+        with self.lock:
+            self.workers += 1
+
+    def submit(self, func, *args, deadline=None, **kargs):
+        expires_at = None if deadline is None \
+            else time.monotonic() + deadline
+
+        def run():
+            with self.lock:
+                self.queued -= 1
+                if expires_at is not None and time.monotonic() > expires_at:
+                    self.expired += 1
+                    raise DeadlineExceeded(
+                        'Task %r missed its %ss deadline' % (func, deadline))
+                self.busy += 1
             try:
-                func, args, kargs = self.tasks.get(timeout=self.timeout)
-            except queue.Empty:
-                # Extra thread allocated, no job, exit gracefully
-                break
+                result = func(*args, **kargs)
+            except BaseException:
+                with self.lock:
+                    self.failed += 1
+                raise
+            else:
+                with self.lock:
+                    self.completed += 1
+                return result
+            finally:
+                with self.lock:
+                    self.busy -= 1
+
+        with self.lock:
+            self.queued += 1
+            saturated = self.busy + self.queued > self.max_workers
+        if saturated and getattr(_worker, 'executor', None) is self:
+            future = Future()
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(run())
+            except BaseException as e:
+                future.set_exception(e)
+            return future
+        future = self.pool.submit(run)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        if future.cancelled():
+            with self.lock:
+                self.queued -= 1
+                self.cancelled += 1
+
+    def map(self, func, iterable, deadline=None):
+        """Submits `func(item)` for every item, returns the futures in
+        the order of `iterable`
+        """
+        return [self.submit(func, item, deadline=deadline)
+                for item in iterable]
+
+    def stats(self):
+        """Returns a dict of utilization counters
+        """
+        with self.lock:
+            return {
+                'max_workers': self.max_workers,
+                'workers': self.workers,
+                'busy': self.busy,
+                'queued': self.queued,
+                'completed': self.completed,
+                'failed': self.failed,
+                'cancelled': self.cancelled,
+                'expired': self.expired,
+                'utilization': float(self.busy) / self.max_workers,
+            }
+
+    def shutdown(self, wait=True):
+        self.pool.shutdown(wait=wait)
+
+
+_executor = None
+_executor_lock = Lock()
+
+
+def get_executor():
+    """Returns the process-wide executor, created on first use
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = Executor()
+    return _executor
+
+
+def configure_executor(max_workers):
+    """Replaces the process-wide executor with one of `max_workers`
+    threads, tasks already submitted to the old one still complete
+    """
+    global _executor
+    with _executor_lock:
+        old, _executor = _executor, Executor(max_workers)
+    if old is not None:
+        old.shutdown(wait=False)
+    return _executor
+
+
+class HostScheduler(object):
+    """Thread pool which pulls tasks queued for many hosts at once while
+    being polite to each of them: at most `per_host` tasks of one host run
+    at the same time, and a host's tasks start at least `host_delay`
+    seconds apart. `num_threads` is the global concurrency budget. Hosts
+    are served round-robin so one slow domain never holds up the rest.
+    `clock` returns the current time in seconds, `time.monotonic` by
+    default.
+    """
+    def __init__(self, num_threads, per_host=1, host_delay=0,
+                 clock=time.monotonic):
+        self.per_host = max(1, per_host)
+        self.host_delay = host_delay
+        self.clock = clock
+        self.cond = Condition()
+        self.queues = OrderedDict()  # host -> deque of queued tasks
+        self.running = {}  # host -> number of tasks in flight
+        self.last_start = {}  # host -> time its last task started
+        self.unfinished = 0
+        self.closed = False
+        for _ in range(max(1, num_threads)):
+            worker = Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+
+    def add_task(self, host, func, *args, **kargs):
+        with self.cond:
+            self.queues.setdefault(host, deque()).append((func, args, kargs))
+            self.unfinished += 1
+            self.cond.notify()
+
+    def queue_depth(self):
+        """Number of tasks queued and not yet started, over all hosts
+        """
+        with self.cond:
+            return sum(len(q) for q in self.queues.values())
+
+    def in_flight(self):
+        """Returns a {host: number of running tasks} dict
+        """
+        with self.cond:
+            return {h: n for h, n in self.running.items() if n}
+
+    def wait_completion(self):
+        """Blocks until every queued task has run, then stops the workers
+        """
+        with self.cond:
+            while self.unfinished:
+                self.cond.wait()
+            self.closed = True
+            self.cond.notify_all()
+
+    def _next_task(self):
+        """Pops the next task allowed to start now, returns
+        (host, task, None) or (None, None, seconds to wait for one)
+        """
+        now = self.clock()
+        wait = None
+        for host, tasks in self.queues.items():
+            if not tasks or self.running.get(host, 0) >= self.per_host:
+                continue
+            last_start = self.last_start.get(host)
+            if last_start is not None and last_start + self.host_delay > now:
+                ready_in = last_start + self.host_delay - now
+                wait = ready_in if wait is None else min(wait, ready_in)
+                continue
+            task = tasks.popleft()
+            self.running[host] = self.running.get(host, 0) + 1
+            self.last_start[host] = now
+            # round-robin, this host goes to the back of the line
+            self.queues.move_to_end(host)
+            return host, task, None
+        return None, None, wait
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while True:
+                    if self.closed:
+                        return
+                    host, task, wait = self._next_task()
+                    if task is not None:
+                        break
+                    self.cond.wait(wait)
+            func, args, kargs = task
             try:
                 func(*args, **kargs)
             except Exception:
-                traceback.print_exc()
+                log.exception('Task of host %s failed' % host)
+            with self.cond:
+                self.running[host] -= 1
+                self.unfinished -= 1
+                self.cond.notify_all()
 
-            self.tasks.task_done()
 
+class Pipeline(object):
+    """Runs items through a chain of stages, each on its own threads, so
+    e.g. downloads (network bound) and parsing (cpu bound) overlap.
+    Stages are connected by bounded queues: a stage which falls behind
+    blocks the ones feeding it instead of letting items pile up.
 
-class ThreadPool:
-    def __init__(self, num_threads, timeout_seconds):
-        self.tasks = queue.Queue(num_threads)
-        for _ in range(num_threads):
-            Worker(self.tasks, timeout_seconds)
+    A stage is a function called with the item, it works on the item in
+    place. An item whose stage raises is dropped and recorded in
+    `self.errors` as (stage name, item, exception).
 
-    def add_task(self, func, *args, **kargs):
-        self.tasks.put((func, args, kargs))
+    >>> pipeline = Pipeline()
+    >>> pipeline.add_stage('download', download, workers=10)
+    >>> pipeline.add_stage('parse', parse, workers=2)
+    >>> pipeline.run(articles, sink=save)
+    """
+    _done = object()
 
-    def wait_completion(self):
-        self.tasks.join()
+    def __init__(self, queue_size=None):
+        self.queue_size = queue_size
+        self.stages = []
+        self.errors = []
+        self.lock = Lock()
+        self.processed = {}
+        self.failed = {}
+        self.queues = []
+
+    def add_stage(self, name, func, workers=1, queue_size=None):
+        """Appends a stage run by `workers` threads, at most `queue_size`
+        items (default 2 * workers) wait in front of it
+        """
+        workers = max(1, workers)
+        queue_size = queue_size or self.queue_size or 2 * workers
+        self.stages.append((name, func, workers, queue_size))
+        self.processed[name] = 0
+        self.failed[name] = 0
+        return self
+
+    def stats(self):
+        """Returns {stage name: {'processed', 'failed', 'queued'}}
+        """
+        with self.lock:
+            return {name: {'processed': self.processed[name],
+                           'failed': self.failed[name],
+                           'queued': self.queues[i].qsize()
+                           if self.queues else 0}
+                    for i, (name, _, _, _) in enumerate(self.stages)}
+
+    def run(self, items, sink=None):
+        """Pushes `items` through every stage, calls `sink(item)` on each
+        item as soon as it leaves the last one. Returns the number of
+        items which made it through
+        """
+        count = 0
+        for item in self.iter(items):
+            if sink is not None:
+                sink(item)
+            count += 1
+        return count
+
+    def iter(self, items):
+        """Like `run`, but yields finished items. Closing the generator
+        early stops the pipeline. If iterating `items` raises, the items
+        before went through and the exception is raised here
+        """
+        if not self.stages:
+            raise ValueError('Pipeline has no stages')
+        stopped = Event()
+        # the exception `items` raised, re-raised here once the items
+        # before it went through
+        feed_error = []
+        with self.lock:
+            for name, _, _, _ in self.stages:
+                self.processed[name] = 0
+                self.failed[name] = 0
+        self.queues = [queue.Queue(size) for _, _, _, size in self.stages]
+        self.queues.append(queue.Queue(self.stages[-1][2]))
+        # workers of each stage still running
+        remaining = [workers for _, _, workers, _ in self.stages]
+
+        def put(i, item):
+            while not stopped.is_set():
+                try:
+                    self.queues[i].put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        def feed():
+            try:
+                for item in items:
+                    if stopped.is_set():
+                        return
+                    put(0, item)
+            except Exception as e:
+                feed_error.append(e)
+            finally:
+                for _ in range(self.stages[0][2]):
+                    put(0, self._done)
+
+        def work(i):
+            name, func, _, _ = self.stages[i]
+            while True:
+                try:
+                    item = self.queues[i].get(timeout=0.1)
+                except queue.Empty:
+                    if stopped.is_set():
+                        return
+                    continue
+                if item is self._done:
+                    break
+                try:
+                    func(item)
+                except Exception as e:
+                    log.debug('Pipeline stage %s failed on %r: %s' %
+                              (name, item, e))
+                    with self.lock:
+                        self.failed[name] += 1
+                        self.errors.append((name, item, e))
+                    continue
+                with self.lock:
+                    self.processed[name] += 1
+                put(i + 1, item)
+            with self.lock:
+                remaining[i] -= 1
+                last = remaining[i] == 0
+            if last:
+                # the next stage's workers each get told to finish
+                downstream = self.stages[i + 1][2] \
+                    if i + 1 < len(self.stages) else 1
+                for _ in range(downstream):
+                    put(i + 1, self._done)
+
+        threads = [Thread(target=feed)]
+        for i, (_, _, workers, _) in enumerate(self.stages):
+            threads.extend(Thread(target=work, args=(i,))
+                           for _ in range(workers))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        output = self.queues[-1]
+        try:
+            while True:
+                item = output.get()
+                if item is self._done:
+                    break
+                yield item
+        finally:
+            stopped.set()
+        if feed_error:
+            raise feed_error[0]
 
 
 class NewsPool(object):
@@ -95,14 +455,27 @@ class NewsPool(object):
                   'objects before .join(..)')
             raise
         self.pool.wait_completion()
+        for paper in self.papers:
+            if hasattr(paper, 'articles'):
+                paper.finish_download_articles()
         self.papers = []
         self.pool = None
 
-    def set(self, paper_list, threads_per_source=1):
+    def set(self, paper_list, threads_per_source=1, max_threads=None):
+        """Queues the download of every article of every paper (articles
+        may also be passed in directly). At most `threads_per_source`
+        downloads run against one host at once, and at most `max_threads`
+        in total, by default `threads_per_source * len(paper_list)`.
+        Progress can be watched via `self.pool.queue_depth()` and
+        `self.pool.in_flight()`.
+        """
         self.papers = paper_list
-        num_threads = threads_per_source * len(self.papers)
-        timeout = self.config.thread_timeout_seconds
-        self.pool = ThreadPool(num_threads, timeout)
+        num_threads = max_threads or threads_per_source * len(self.papers)
+        self.pool = HostScheduler(num_threads, per_host=threads_per_source,
+                                  host_delay=self.config.host_delay_seconds)
 
         for paper in self.papers:
-            self.pool.add_task(paper.download_articles)
+            articles = getattr(paper, 'articles', [paper])
+            for article in articles:
+                host = urls.get_domain(article.url)
+                self.pool.add_task(host, article.download)
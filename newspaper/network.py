@@ -8,18 +8,76 @@ __author__ = 'Lucas Ou-Yang'
 __license__ = 'MIT'
 __copyright__ = 'Copyright 2014, Lucas Ou-Yang'
 
+import asyncio
+import codecs
+import gzip
+import hashlib
+import io
+import itertools
+import json
 import logging
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+
 import requests
+from requests.adapters import HTTPAdapter
 
 from .configuration import Configuration
-from .mthreading import ThreadPool
-from .settings import cj
+from .mthreading import get_executor
+from .settings import HTTP_CACHE_DIRECTORY
 
 log = logging.getLogger(__name__)
 
 
 FAIL_ENCODING = 'ISO-8859-1'
 
+# Responses of these content types are dropped before their body is read
+BINARY_CONTENT_TYPES = (
+    'image/', 'video/', 'audio/', 'font/', 'application/pdf',
+    'application/octet-stream', 'application/zip', 'application/gzip',
+    'application/x-gzip', 'application/x-tar', 'application/x-rar',
+    'application/x-7z', 'application/msword', 'application/vnd.',
+    'application/x-shockwave-flash', 'application/mp4', 'application/ogg')
+
+# Magic numbers of binary files which are served as text/html
+BINARY_SIGNATURES = (
+    b'%PDF-', b'PK\x03\x04', b'\x1f\x8b', b'\x89PNG', b'GIF8',
+    b'\xff\xd8\xff', b'ID3', b'OggS', b'fLaC')
+# text whose encoding puts NUL bytes in every character: UTF-32 and
+# UTF-16 byte order marks, and '<' of a UTF-16 page without a BOM
+WIDE_TEXT_SIGNATURES = (
+    codecs.BOM_UTF32_LE, codecs.BOM_UTF32_BE, codecs.BOM_UTF16_LE,
+    codecs.BOM_UTF16_BE, b'<\x00', b'\x00<')
+
+
+class SkippedContent(requests.exceptions.RequestException):
+    """The response was dropped because its payload is not html
+    """
+
+
+class NotInArchive(requests.exceptions.RequestException):
+    """A `ReplayTransport` has no response recorded for the url, retrying
+    would not change that
+    """
+
+
+# Keep-alive sessions, one per (scheme, host, pool size, cookie
+# persistence), shared by every download in the process so connections
+# are reused. Least recently used first
+_sessions = OrderedDict()
+_sessions_lock = threading.Lock()
+
 
 def get_request_kwargs(timeout, useragent, proxies, headers):
     """This Wrapper method exists b/c some values in req_kwargs dict
@@ -27,41 +85,641 @@ def get_request_kwargs(timeout, useragent, proxies, headers):
     """
     return {
         'headers': headers if headers else {'User-Agent': useragent},
-        'cookies': cj(),
         'timeout': timeout,
         'allow_redirects': True,
         'proxies': proxies
     }
 
 
-def get_html(url, config=None, response=None):
+def get_session(url, config=None):
+    """Returns the pooled, keep-alive session which owns the host of
+    `url`. Sessions are created lazily and live until `close_sessions()`,
+    or until `config.max_sessions` hosts were used more recently, which
+    closes them. Unless `config.persist_cookies`, the session's jar
+    refuses every cookie: a request only sees the cookies set during
+    its own redirects
+    """
+    config = config or Configuration()
+    split = urlsplit(url)
+    maxsize = max(config.pool_maxsize, config.number_threads)
+    key = (split.scheme, split.netloc, maxsize, config.persist_cookies)
+    evicted = []
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is not None:
+            _sessions.move_to_end(key)
+            return session
+
+        session = requests.Session()
+        if not config.persist_cookies:
+            session.cookies.set_policy(
+                DefaultCookiePolicy(allowed_domains=[]))
+        # the session only talks to one host, one pool is enough
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=maxsize)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _sessions[key] = session
+        while len(_sessions) > max(1, config.max_sessions):
+            evicted.append(_sessions.popitem(last=False)[1])
+    # requests still running on an evicted session finish, its
+    # connections are dropped instead of going back to the pool
+    for old in evicted:
+        old.close()
+    return session
+
+
+def close_sessions():
+    """Closes every pooled session and drops their open connections
+    """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+class HTTPCache(object):
+    """On-disk cache of responses keyed by URL. Cached pages are
+    revalidated with `If-None-Match` / `If-Modified-Since`, a 304 reply
+    is answered with the stored body. The lxml docs parsed from unchanged
+    bodies are also kept in memory so they need not be parsed again.
+
+    An entry is a JSON file of metadata next to a file of the raw body.
+    Past `config.MAX_HTTP_CACHE_ENTRIES` the least recently used entries
+    are deleted.
+    """
+    # The only headers we need to rebuild a response from disk
+    KEEP_HEADERS = ('content-type', 'etag', 'last-modified')
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.docs = OrderedDict()  # url -> (body digest, doc)
+        self.lock = threading.Lock()
+        self.entries = None  # entries on disk, counted on the first save
+
+    def _paths(self, url):
+        """(metadata path, body path) of the entry of `url`
+        """
+        path = os.path.join(self.directory,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest())
+        return path + '.json', path + '.body'
+
+    def load(self, url):
+        meta_path, body_path = self._paths(url)
+        try:
+            with open(meta_path, encoding='utf-8') as f:
+                entry = json.load(f)
+            with open(body_path, 'rb') as f:
+                content = f.read()
+        except (OSError, ValueError):
+            return None
+        if hashlib.sha1(content).hexdigest() != entry.get('digest'):
+            # the body of a save which is still being written
+            return None
+        entry['content'] = content
+        return entry
+
+    def _write(self, path, data):
+        # write then rename, concurrent readers never see half a file
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def save(self, url, response, config):
+        meta_path, body_path = self._paths(url)
+        is_new = not os.path.exists(meta_path)
+        entry = {
+            'url': response.url,
+            'headers': {k: response.headers[k] for k in self.KEEP_HEADERS
+                        if k in response.headers},
+            'digest': hashlib.sha1(response.content).hexdigest(),
+        }
+        self._write(body_path, response.content)
+        self._write(meta_path, json.dumps(entry).encode('utf-8'))
+        if is_new:
+            self.prune(config.MAX_HTTP_CACHE_ENTRIES)
+
+    def prune(self, max_entries):
+        """Deletes the least recently used entries once there are more
+        than `max_entries`, down to three quarters of it
+        """
+        with self.lock:
+            if self.entries is not None:
+                self.entries += 1
+                if self.entries <= max_entries:
+                    return
+            metas = [os.path.join(self.directory, name)
+                     for name in os.listdir(self.directory)
+                     if name.endswith('.json')]
+            self.entries = len(metas)
+            if self.entries <= max_entries:
+                return
+
+            def last_used(path):
+                try:
+                    return os.path.getmtime(path)
+                except OSError:
+                    return 0
+
+            metas.sort(key=last_used)
+            stale = metas[:len(metas) - max(1, max_entries * 3 // 4)]
+            for meta_path in stale:
+                for path in (meta_path, meta_path[:-5] + '.body'):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            self.entries -= len(stale)
+
+    def get(self, url, fetch, headers, config):
+        """GET `url` as a conditional request if we have a cached copy of
+        it, `fetch(headers)` sends the request and returns the response
+        """
+        entry = self.load(url)
+        if entry is not None:
+            headers = dict(headers)
+            if 'etag' in entry['headers']:
+                headers['If-None-Match'] = entry['headers']['etag']
+            if 'last-modified' in entry['headers']:
+                headers['If-Modified-Since'] = \
+                    entry['headers']['last-modified']
+
+        response = fetch(headers)
+        if response.status_code == 304 and entry is not None:
+            log.debug('Not modified, using cached body of %s' % url)
+            try:
+                os.utime(self._paths(url)[0])
+            except OSError:
+                pass
+            return self._to_response(entry, response)
+        if response.ok and ('etag' in response.headers or
+                            'last-modified' in response.headers):
+            self.save(url, response, config)
+        return response
+
+    @staticmethod
+    def _to_response(entry, not_modified):
+        response = requests.models.Response()
+        response.status_code = 200
+        response.reason = 'OK'
+        response.url = entry['url']
+        response.headers = requests.structures.CaseInsensitiveDict(
+            entry['headers'])
+        # a 304 may carry fresher validators than the stored ones
+        for key in ('etag', 'last-modified'):
+            if key in not_modified.headers:
+                response.headers[key] = not_modified.headers[key]
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers)
+        response._content = entry['content']
+        response.from_cache = True
+        return response
+
+    def fromstring(self, url, html, config):
+        """Parses `html` fetched from `url`, reusing the doc parsed from
+        the same body the last time the page was seen
+        """
+        if not html:
+            return config.get_parser().fromstring(html)
+        data = html.encode('utf-8', 'replace') \
+            if isinstance(html, str) else html
+        digest = hashlib.sha1(data).digest()
+        with self.lock:
+            cached = self.docs.get(url)
+            if cached is not None and cached[0] == digest:
+                self.docs.move_to_end(url)
+                return cached[1]
+
+        doc = config.get_parser().fromstring(html)
+        if doc is not None:
+            with self.lock:
+                self.docs[url] = (digest, doc)
+                self.docs.move_to_end(url)
+                while len(self.docs) > config.MAX_CACHED_DOCS:
+                    self.docs.popitem(last=False)
+        return doc
+
+    def clear(self):
+        with self.lock:
+            self.docs.clear()
+            self.entries = None
+        for name in os.listdir(self.directory):
+            os.remove(os.path.join(self.directory, name))
+
+
+http_cache = HTTPCache(HTTP_CACHE_DIRECTORY)
+
+
+class Transport(object):
+    """Turns a GET into a fully read `requests.Response`. The default
+    transport sends it over the network, swap it with `set_transport`
+    to record or replay downloads.
+    `send(headers)` performs the live request for the given headers.
+    """
+    def fetch(self, url, headers, send):
+        return send(headers)
+
+    async def afetch(self, url, headers, send):
+        return await send(headers)
+
+
+class RecordingTransport(Transport):
+    """Sends requests over the network and appends every response to a
+    WARC archive at `path` (gzipped if it ends in .gz). The http cache
+    sits below the transport, so a page revalidated with a 304 is
+    recorded as the full response the cache answers with
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def record(self, url, response):
+        with self.lock:
+            opener = gzip.open if self.path.endswith('.gz') else open
+            with opener(self.path, 'ab') as f:
+                f.write(warc_record(url, response))
+
+    def fetch(self, url, headers, send):
+        response = send(headers)
+        self.record(url, response)
+        return response
+
+    async def afetch(self, url, headers, send):
+        response = await send(headers)
+        self.record(url, response)
+        return response
+
+
+class ReplayTransport(Transport):
+    """Answers requests from a WARC archive written by a
+    `RecordingTransport`, the network and the http cache are never
+    touched. URLs missing from the archive fail with `NotInArchive`,
+    which is neither retried nor counted by the circuit breaker, and
+    recorded responses are final whatever their status.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.responses = {}
+        for record in read_warc(path):
+            self.responses[record['url']] = record
+
+    def fetch(self, url, headers, send):
+        record = self.responses.get(url)
+        if record is None:
+            raise NotInArchive('Not in replay archive: %s' % url)
+        response = requests.models.Response()
+        response.status_code = record['status']
+        response.reason = record['reason']
+        response.url = record['final_url']
+        response.headers = requests.structures.CaseInsensitiveDict(
+            record['headers'])
+        response.encoding = requests.utils.get_encoding_from_headers(
+            response.headers)
+        response._content = record['content']
+        response.replayed = True
+        return response
+
+    async def afetch(self, url, headers, send):
+        return self.fetch(url, headers, send)
+
+
+# Headers which describe the wire encoding of a body we store decoded
+_HOP_HEADERS = ('content-encoding', 'transfer-encoding', 'content-length',
+                'connection', 'keep-alive')
+
+
+def warc_record(url, response):
+    """Serializes a response as a WARC/1.0 `response` record
+    """
+    lines = ['HTTP/1.1 %d %s' % (response.status_code, response.reason or '')]
+    for key, value in response.headers.items():
+        if key.lower() not in _HOP_HEADERS:
+            lines.append('%s: %s' % (key, value))
+    lines.append('Content-Length: %d' % len(response.content))
+    block = ('\r\n'.join(lines) + '\r\n\r\n').encode('iso-8859-1') + \
+        response.content
+
+    warc_headers = [
+        'WARC/1.0',
+        'WARC-Type: response',
+        'WARC-Record-ID: <urn:uuid:%s>' % uuid.uuid4(),
+        'WARC-Date: %s' % datetime.now(timezone.utc).strftime(
+            '%Y-%m-%dT%H:%M:%SZ'),
+        'WARC-Target-URI: %s' % url,
+        'WARC-Final-URI: %s' % response.url,
+        'Content-Type: application/http; msgtype=response',
+        'Content-Length: %d' % len(block),
+    ]
+    return ('\r\n'.join(warc_headers) + '\r\n\r\n').encode('utf-8') + \
+        block + b'\r\n\r\n'
+
+
+def read_warc(path):
+    """Yields the `response` records of a WARC archive as dicts
+    """
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as f:
+        while True:
+            line = f.readline()
+            if not line:
+                return
+            if not line.startswith(b'WARC/'):
+                continue
+            warc_headers = _read_header_lines(f)
+            block = f.read(int(warc_headers['content-length']))
+            if warc_headers.get('warc-type') != 'response':
+                continue
+            url = warc_headers['warc-target-uri']
+            http = io.BytesIO(block)
+            status_line = http.readline().decode('iso-8859-1').split(' ', 2)
+            headers = _read_header_lines(http, lower=False)
+            yield {
+                'url': url,
+                'final_url': warc_headers.get('warc-final-uri', url),
+                'status': int(status_line[1]),
+                'reason': status_line[2].strip() if len(status_line) > 2
+                else '',
+                'headers': headers,
+                'content': http.read(),
+            }
+
+
+def _read_header_lines(f, lower=True):
+    headers = {}
+    for line in iter(f.readline, b''):
+        line = line.decode('iso-8859-1').strip()
+        if not line:
+            break
+        key, _, value = line.partition(':')
+        headers[key.strip().lower() if lower else key.strip()] = \
+            value.strip()
+    return headers
+
+
+transport = Transport()
+
+
+def set_transport(new_transport=None):
+    """Routes every download through `new_transport`, None restores
+    the live network
+    """
+    global transport
+    transport = new_transport or Transport()
+
+
+def session_get(url, config=None, use_cache=False):
+    """GET `url` through the pooled session of its host. With `use_cache`
+    the request is revalidated against the http cache, see `HTTPCache`
+    """
+    config = config or Configuration()
+    session = get_session(url, config)
+    kwargs = get_request_kwargs(
+        config.request_timeout, config.browser_user_agent,
+        config.proxies, config.headers)
+    kwargs['stream'] = config.stream_downloads
+
+    def send(headers):
+        response = session.get(url, **dict(kwargs, headers=headers))
+        if config.stream_downloads:
+            read_body(url, response, config)
+        return response
+
+    def cached_send(headers):
+        if use_cache and config.use_http_cache:
+            return http_cache.get(url, send, headers, config)
+        return send(headers)
+
+    return transport.fetch(url, kwargs['headers'], cached_send)
+
+
+def check_content_type(url, headers):
+    """Raises `SkippedContent` if the response headers announce a
+    binary payload we would not be able to extract anything from
+    """
+    content_type = (headers.get('content-type') or '').lower()
+    if content_type.startswith(BINARY_CONTENT_TYPES):
+        raise SkippedContent('Skipped %s payload: %s' % (
+            content_type.split(';')[0], url))
+
+
+def is_wide_charset(charset):
+    """True for the UTF-16 and UTF-32 encodings, whose text is full of
+    NUL bytes
+    """
+    try:
+        name = codecs.lookup(charset).name
+    except (LookupError, TypeError):
+        return False
+    return name.startswith(('utf-16', 'utf-32'))
+
+
+def check_first_chunk(url, chunk, headers=None):
+    """Mislinked media files often claim to be text/html, sniff the
+    first bytes of the body before reading any further. NUL bytes only
+    mark a binary payload when neither a byte order mark nor the
+    charset of `headers` says the text is UTF-16 or UTF-32
+    """
+    if chunk.startswith(BINARY_SIGNATURES):
+        raise SkippedContent('Skipped binary payload: %s' % url)
+    if chunk.startswith(WIDE_TEXT_SIGNATURES) or (
+            headers is not None and is_wide_charset(
+                requests.utils.get_encoding_from_headers(headers))):
+        return
+    if b'\x00' in chunk[:1024]:
+        raise SkippedContent('Skipped binary payload: %s' % url)
+
+
+def read_body(url, response, config=None):
+    """Reads the body of a `stream=True` response, at most
+    `config.MAX_HTML_BYTES` of it. Binary payloads are dropped
+    without being downloaded.
+    """
+    config = config or Configuration()
+    max_bytes = config.MAX_HTML_BYTES
+    try:
+        check_content_type(url, response.headers)
+        length = response.headers.get('content-length')
+        if length and length.isdigit() and int(length) > max_bytes:
+            log.debug('Reading %d of %s bytes of %s' %
+                      (max_bytes, length, url))
+
+        chunks = []
+        size = 0
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            if not chunks:
+                check_first_chunk(url, chunk, response.headers)
+            chunks.append(chunk)
+            size += len(chunk)
+            if size >= max_bytes:
+                log.debug('Truncated the body of %s at %d bytes' %
+                          (url, max_bytes))
+                break
+        response._content = b''.join(chunks)[:max_bytes]
+        response._content_consumed = True
+    finally:
+        response.close()
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    """Refused to send a request to a host which keeps failing
+    """
+
+
+class CircuitBreaker(object):
+    """Per-host circuit breaker. After `breaker_failure_threshold`
+    consecutive failures a host is not sent any request for
+    `breaker_cooldown_seconds`, after which a single probe request is let
+    through. A success closes the circuit again, a failure reopens it.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.failures = {}
+        self.opened_at = {}
+
+    def allow(self, host, config):
+        with self.lock:
+            opened_at = self.opened_at.get(host)
+            if opened_at is None:
+                return True
+            now = time.monotonic()
+            if now - opened_at < config.breaker_cooldown_seconds:
+                return False
+            # half-open, this request probes the host while others wait
+            self.opened_at[host] = now
+            return True
+
+    def record_success(self, host):
+        with self.lock:
+            self.failures.pop(host, None)
+            self.opened_at.pop(host, None)
+
+    def record_failure(self, host, config):
+        with self.lock:
+            failures = self.failures.get(host, 0) + 1
+            self.failures[host] = failures
+            if failures >= config.breaker_failure_threshold:
+                if host not in self.opened_at:
+                    log.warning('%d failures in a row, pausing requests '
+                                'to %s' % (failures, host))
+                self.opened_at[host] = time.monotonic()
+
+    def reset(self):
+        with self.lock:
+            self.failures.clear()
+            self.opened_at.clear()
+
+
+circuit_breaker = CircuitBreaker()
+
+# Transient statuses worth retrying an idempotent GET for
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def retry_wait(attempt, response, config):
+    """Seconds to wait before retry number `attempt + 1`: what the server
+    asked for in Retry-After, or jittered exponential backoff
+    """
+    max_wait = config.max_retry_wait_seconds
+    retry_after = response.headers.get('retry-after') \
+        if response is not None else None
+    if retry_after:
+        try:
+            wait = float(retry_after)
+        except ValueError:
+            try:
+                wait = parsedate_to_datetime(retry_after).timestamp() - \
+                    time.time()
+            except (TypeError, ValueError):
+                wait = None
+        if wait is not None:
+            return min(max(wait, 0), max_wait)
+    backoff = config.retry_backoff_seconds * (2 ** attempt)
+    return random.uniform(0, min(backoff, max_wait))
+
+
+def _retry_or_finish(url, attempt, response, error, config):
+    """Feeds one attempt to the circuit breaker, returns the seconds to
+    wait before retrying or None when the attempt is final
+    """
+    host = urlsplit(url).netloc
+    if isinstance(error, (SkippedContent, NotInArchive)):
+        return None
+    if getattr(response, 'replayed', False):
+        # replaying a recorded 429/5xx again would answer the same
+        return None
+    if error is None and response.status_code not in RETRY_STATUSES:
+        circuit_breaker.record_success(host)
+        return None
+    circuit_breaker.record_failure(host, config)
+    if attempt >= config.request_retries:
+        return None
+    wait = retry_wait(attempt, response, config)
+    log.debug('Retrying %s in %.2fs (attempt %d)' % (url, wait, attempt + 1))
+    return wait
+
+
+def _check_circuit(url, config):
+    host = urlsplit(url).netloc
+    if not circuit_breaker.allow(host, config):
+        raise CircuitOpen('Circuit open for %s, skipped: %s' % (host, url))
+
+
+def retrying_get(url, config=None, use_cache=False):
+    """`session_get` with up to `config.request_retries` retries on
+    network errors and transient 429/5xx statuses. Returns the last
+    response, or raises the last network error.
+    """
+    config = config or Configuration()
+    attempt = 0
+    while True:
+        _check_circuit(url, config)
+        response, error = None, None
+        try:
+            response = session_get(url, config, use_cache)
+        except requests.exceptions.RequestException as e:
+            error = e
+        wait = _retry_or_finish(url, attempt, response, error, config)
+        if wait is None:
+            if error is not None:
+                raise error
+            return response
+        time.sleep(wait)
+        attempt += 1
+
+
+def parse_cached(url, html, config=None):
+    """Parses the html of a source page, reusing the previous doc if the
+    page was not modified since
+    """
+    config = config or Configuration()
+    if config.use_http_cache:
+        return http_cache.fromstring(url, html, config)
+    return config.get_parser().fromstring(html)
+
+
+def get_html(url, config=None, response=None, use_cache=False):
     """HTTP response code agnostic
     """
     try:
-        return get_html_2XX_only(url, config, response)
+        return get_html_2XX_only(url, config, response, use_cache)
     except requests.exceptions.RequestException as e:
         log.debug('get_html() error. %s on URL: %s' % (e, url))
         return ''
 
 
-def get_html_2XX_only(url, config=None, response=None):
+def get_html_2XX_only(url, config=None, response=None, use_cache=False):
     """Consolidated logic for http requests from newspaper. We handle error cases:
     - Attempt to find encoding of the html by using HTTP header. Fallback to
       'ISO-8859-1' if not provided.
     - Error out if a non 2XX HTTP response code is returned.
     """
     config = config or Configuration()
-    useragent = config.browser_user_agent
-    timeout = config.request_timeout
-    proxies = config.proxies
-    headers = config.headers
 
     if response is not None:
         return _get_html_from_response(response)
 
     try:
-        response = requests.get(
-            url=url, **get_request_kwargs(timeout, useragent, proxies, headers))
+        response = retrying_get(url, config, use_cache)
     except requests.exceptions.RequestException as e:
         log.debug('get_html_2XX_only() error. %s on URL: %s' % (e, url))
         return ''
@@ -75,6 +733,43 @@ def get_html_2XX_only(url, config=None, response=None):
     return html
 
 
+def get_raw_html_2XX_only(url, config=None, response=None, use_cache=False):
+    """Like `get_html_2XX_only`, but returns the undecoded body bytes and
+    the charset of the Content-Type header (None if it has none), so the
+    parser can decode them as it parses
+    """
+    config = config or Configuration()
+
+    if response is not None:
+        return response.content or b'', get_charset(response)
+
+    try:
+        response = retrying_get(url, config, use_cache)
+    except requests.exceptions.RequestException as e:
+        log.debug('get_raw_html_2XX_only() error. %s on URL: %s' % (e, url))
+        return b'', None
+
+    if config.http_success_only:
+        # fail if HTTP sends a non 2XX response
+        response.raise_for_status()
+
+    return response.content or b'', get_charset(response)
+
+
+def get_charset(response):
+    """Charset of the response's Content-Type header, None when missing.
+    Like `_get_html_from_response`, ISO-8859-1 is taken for unknown: it
+    is what servers send by default, often for pages which are really
+    utf-8, so the html's <meta> charset or detection decides instead
+    """
+    if 'charset' not in response.headers.get('content-type', ''):
+        return None
+    charset = requests.utils.get_encoding_from_headers(response.headers)
+    if charset and charset.upper() == FAIL_ENCODING:
+        return None
+    return charset
+
+
 def _get_html_from_response(response):
     if response.encoding != FAIL_ENCODING:
         # return response as a unicode string
@@ -96,43 +791,300 @@ class MRequest(object):
     If this is the case, we still want to report the url which has failed
     so (perhaps) we can try again later.
     """
-    def __init__(self, url, config=None):
+    def __init__(self, url, config=None, use_cache=False, index=None):
         self.url = url
-        self.config = config
-        config = config or Configuration()
+        # Position of the url in the list it was requested with
+        self.index = index
+        self.use_cache = use_cache
+        self.config = config or Configuration()
+        config = self.config
         self.useragent = config.browser_user_agent
         self.timeout = config.request_timeout
         self.proxies = config.proxies
         self.headers = config.headers
         self.resp = None
+        # The exception which failed this request, if any
+        self.error = None
 
     def send(self):
         try:
-            self.resp = requests.get(self.url, **get_request_kwargs(
-                self.timeout, self.useragent, self.proxies, self.headers))
+            self.resp = retrying_get(self.url, self.config, self.use_cache)
+            if self.config.http_success_only:
+                self.resp.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            self.error = e
+            log.critical('[REQUEST FAILED] ' + str(e))
+
+    async def asend(self, session):
+        """Coroutine counterpart of `send`, `session` is an aiohttp
+        session from `new_async_session`
+        """
+        try:
+            self.resp = await async_retrying_get(
+                self.url, self.config, session)
             if self.config.http_success_only:
                 self.resp.raise_for_status()
         except requests.exceptions.RequestException as e:
+            self.error = e
             log.critical('[REQUEST FAILED] ' + str(e))
 
 
-def multithread_request(urls, config=None):
+def multithread_request(urls, config=None, num_threads=None,
+                        use_cache=False):
     """Request multiple urls via mthreading, order of urls & requests is stable
     returns same requests but with response variables filled.
     """
     config = config or Configuration()
-    num_threads = config.number_threads
-    timeout = config.thread_timeout_seconds
+    num_threads = num_threads or config.number_threads
+    urls = list(urls)
+    m_requests = [None] * len(urls)
+    for req in multithread_request_iter(urls, config, num_threads,
+                                        window=num_threads,
+                                        use_cache=use_cache):
+        m_requests[req.index] = req
+    return m_requests
 
-    pool = ThreadPool(num_threads, timeout)
 
-    m_requests = []
-    for url in urls:
-        m_requests.append(MRequest(url, config))
+def multithread_request_iter(urls, config=None, num_threads=None,
+                             window=None, use_cache=False):
+    """Like `multithread_request`, but yields each request as soon as it
+    completes, so its response can be used while the rest download.
+    `req.index` is the position of `req.url` in `urls`. At most `window`
+    requests (default num_threads) are in flight, waiting to be consumed
+    or being consumed at once, so memory stays flat however many urls
+    there are.
 
-    for req in m_requests:
-        pool.add_task(req.send)
+    Requests run on the process-wide `mthreading.get_executor()`, if the
+    generator is closed early the requests not yet started are cancelled.
+    """
+    config = config or Configuration()
+    num_threads = num_threads or config.number_threads
+    window = window or num_threads
+    executor = get_executor()
+    urls = enumerate(urls)
+    done = queue.Queue()
+    futures = set()
 
-    pool.wait_completion()
-    return m_requests
+    def submit(index, url):
+        req = MRequest(url, config, use_cache, index)
+        future = executor.submit(req.send)
+        futures.add(future)
+        future.add_done_callback(lambda f: done.put((f, req)))
+
+    def finish(future, req):
+        # anything `send` did not catch itself is reported on the request
+        if not future.cancelled() and future.exception() is not None:
+            req.error = future.exception()
+            log.critical('[REQUEST FAILED] %r' % req.error)
+        return req
+
+    try:
+        for index, url in itertools.islice(urls, window):
+            submit(index, url)
+        while futures:
+            future, req = done.get()
+            futures.discard(future)
+            yield finish(future, req)
+            # only now, the request just consumed counted in the window
+            for index, url in itertools.islice(urls, 1):
+                submit(index, url)
+    finally:
+        for future in futures:
+            future.cancel()
 
+
+def _import_aiohttp():
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError('The asyncio download engine requires aiohttp, '
+                          'install it with `pip install aiohttp`')
+    return aiohttp
+
+
+def new_async_session(config=None):
+    """Returns an aiohttp session for the asyncio download engine, use it
+    as an `async with` context manager and share it between requests
+    """
+    aiohttp = _import_aiohttp()
+    config = config or Configuration()
+    connector = aiohttp.TCPConnector(limit=config.async_connections)
+    if config.persist_cookies:
+        return aiohttp.ClientSession(connector=connector)
+    return aiohttp.ClientSession(connector=connector,
+                                 cookie_jar=aiohttp.DummyCookieJar())
+
+
+# event loop -> the session shared by requests made without one on it
+_async_sessions = weakref.WeakKeyDictionary()
+
+
+def get_async_session(config=None):
+    """Returns the session shared by every request made without one on
+    the running event loop, like `Article.adownload()`, created on first
+    use. `await close_async_session()` closes it before the loop ends
+    """
+    loop = asyncio.get_running_loop()
+    session = _async_sessions.get(loop)
+    if session is None or session.closed:
+        session = _async_sessions[loop] = new_async_session(config)
+    return session
+
+
+async def close_async_session():
+    """Closes the running event loop's shared session, if it has one
+    """
+    session = _async_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+def _to_requests_response(resp, content):
+    """Wraps an aiohttp response in a `requests.Response` so the rest of
+    the library can treat both download engines the same
+    """
+    response = requests.models.Response()
+    response.status_code = resp.status
+    response.reason = resp.reason
+    response.url = str(resp.url)
+    response.headers = requests.structures.CaseInsensitiveDict(resp.headers)
+    response.encoding = requests.utils.get_encoding_from_headers(
+        response.headers)
+    response._content = content
+    return response
+
+
+async def async_get(url, config=None, session=None):
+    """GET `url` on the running event loop. Network errors are raised as
+    the `requests.exceptions` equivalent
+    """
+    config = config or Configuration()
+    headers = config.headers or {'User-Agent': config.browser_user_agent}
+
+    if session is None:
+        session = get_async_session(config)
+
+    async def send(headers):
+        return await _async_send(url, headers, config, session)
+
+    return await transport.afetch(url, headers, send)
+
+
+async def _async_send(url, headers, config, session):
+    aiohttp = _import_aiohttp()
+    proxy = config.proxies.get(urlsplit(url).scheme)
+    timeout = aiohttp.ClientTimeout(total=config.request_timeout)
+    try:
+        async with session.get(url, headers=headers, proxy=proxy,
+                               timeout=timeout,
+                               allow_redirects=True) as resp:
+            if config.stream_downloads:
+                content = await _async_read_body(url, resp, config)
+            else:
+                content = await resp.read()
+    except asyncio.TimeoutError as e:
+        raise requests.exceptions.Timeout(
+            'Request timed out after %ss: %s' % (config.request_timeout, url)
+        ) from e
+    except aiohttp.ClientError as e:
+        raise requests.exceptions.ConnectionError(
+            '%s: %s' % (e, url)) from e
+    return _to_requests_response(resp, content)
+
+
+async def _async_read_body(url, resp, config):
+    """Coroutine counterpart of `read_body`
+    """
+    check_content_type(url, resp.headers)
+    max_bytes = config.MAX_HTML_BYTES
+    chunks = []
+    size = 0
+    async for chunk in resp.content.iter_chunked(64 * 1024):
+        if not chunks:
+            check_first_chunk(url, chunk, resp.headers)
+        chunks.append(chunk)
+        size += len(chunk)
+        if size >= max_bytes:
+            log.debug('Truncated the body of %s at %d bytes' %
+                      (url, max_bytes))
+            break
+    return b''.join(chunks)[:max_bytes]
+
+
+async def async_retrying_get(url, config=None, session=None):
+    """Coroutine counterpart of `retrying_get`
+    """
+    config = config or Configuration()
+    attempt = 0
+    while True:
+        _check_circuit(url, config)
+        response, error = None, None
+        try:
+            response = await async_get(url, config, session)
+        except requests.exceptions.RequestException as e:
+            error = e
+        wait = _retry_or_finish(url, attempt, response, error, config)
+        if wait is None:
+            if error is not None:
+                raise error
+            return response
+        await asyncio.sleep(wait)
+        attempt += 1
+
+
+async def async_get_html_2XX_only(url, config=None, session=None):
+    """Coroutine counterpart of `get_html_2XX_only`
+    """
+    config = config or Configuration()
+    try:
+        response = await async_retrying_get(url, config, session)
+    except requests.exceptions.RequestException as e:
+        log.debug('async_get_html_2XX_only() error. %s on URL: %s' % (e, url))
+        return ''
+
+    html = _get_html_from_response(response)
+
+    if config.http_success_only:
+        # fail if HTTP sends a non 2XX response
+        response.raise_for_status()
+
+    return html
+
+
+async def async_get_raw_html_2XX_only(url, config=None, session=None):
+    """Coroutine counterpart of `get_raw_html_2XX_only`
+    """
+    config = config or Configuration()
+    try:
+        response = await async_retrying_get(url, config, session)
+    except requests.exceptions.RequestException as e:
+        log.debug('async_get_raw_html_2XX_only() error. %s on URL: %s' %
+                  (e, url))
+        return b'', None
+
+    if config.http_success_only:
+        # fail if HTTP sends a non 2XX response
+        response.raise_for_status()
+
+    return response.content or b'', get_charset(response)
+
+
+async def async_request(urls, config=None, session=None):
+    """Request multiple urls concurrently on one thread via asyncio, order
+    of urls & requests is stable. Same contract as `multithread_request`,
+    at most `config.async_connections` requests are in flight at once.
+    """
+    config = config or Configuration()
+    if session is None:
+        async with new_async_session(config) as session:
+            return await async_request(urls, config, session)
+
+    semaphore = asyncio.Semaphore(config.async_connections)
+
+    async def send(req):
+        async with semaphore:
+            await req.asend(session)
+
+    m_requests = [MRequest(url, config) for url in urls]
+    await asyncio.gather(*[send(req) for req in m_requests])
+    return m_requests
@@ -10,6 +10,9 @@ __copyright__ = 'Copyright 2014, Lucas Ou-Yang'
 from html import unescape
 import logging
 
+import lxml.etree
+
+from .context import get_context
 from .text import innerTrim
 
 
@@ -45,8 +48,6 @@ class OutputFormatter(object):
         self.top_node = top_node
         html, text = '', ''
 
-        self.remove_negativescores_nodes()
-
         if self.config.keep_article_html:
             html = self.convert_to_html()
 
@@ -77,7 +78,10 @@ class OutputFormatter(object):
         return '\n\n'.join(txts)
 
     def convert_to_html(self):
-        cleaned_node = self.parser.clean_article_html(self.get_top_node())
+        context = get_context(self.config, self.language,
+                              self.stopwords_class)
+        cleaned_node = self.parser.clean_article_html(
+            self.get_top_node(), context.article_cleaner)
         return self.parser.nodeToString(cleaned_node)
 
     def add_newline_to_br(self):
@@ -98,18 +102,6 @@ class OutputFormatter(object):
         """
         self.parser.stripTags(self.get_top_node(), 'a')
 
-    def remove_negativescores_nodes(self):
-        """If there are elements inside our top node that have a
-        negative gravity score, let's give em the boot.
-        """
-        gravity_items = self.parser.css_select(
-            self.top_node, "*[gravityScore]")
-        for item in gravity_items:
-            score = self.parser.getAttribute(item, 'gravityScore')
-            score = float(score) if score else 0
-            if score < 1:
-                item.getparent().remove(item)
-
     def replace_with_text(self):
         """
         Replace common tags with just text so we don't have any crazy
@@ -122,20 +114,29 @@ class OutputFormatter(object):
 
     def remove_empty_tags(self):
         """It's common in top_node to exit tags that are filled with data
-        within properties but not within the tags themselves, delete them
+        within properties but not within the tags themselves, delete them.
+
+        Tags holding an <object> or <embed> used to be spared, but a
+        textless <object> or <embed> goes too, so having text is all that
+        decides. Whether a tag has any follows from its children in one
+        bottom-up walk, removing a textless tag only moves its tail.
         """
-        all_nodes = self.parser.getElementsByTags(
-            self.get_top_node(), ['*'])
-        all_nodes.reverse()
-        for el in all_nodes:
-            tag = self.parser.getTag(el)
-            text = self.parser.getText(el)
-            if (tag != 'br' or text != '\\r') \
-                    and not text \
-                    and len(self.parser.getElementsByTag(
-                        el, tag='object')) == 0 \
-                    and len(self.parser.getElementsByTag(
-                        el, tag='embed')) == 0:
+        top_node = self.get_top_node()
+        with_text = set()
+        removed = []
+        for _, el in lxml.etree.iterwalk(top_node, events=('end',)):
+            if el.text and el.text.strip() or any(
+                    child in with_text or child.tail and child.tail.strip()
+                    for child in el):
+                with_text.add(el)
+            elif el is not top_node:
+                removed.append(el)
+
+        # the tags under a removed tag go with it, the rest are removed
+        # last first, as a walk back from the end of the tree would
+        removed_set = set(removed)
+        for el in reversed(removed):
+            if el.getparent() not in removed_set:
                 self.parser.remove(el)
 
     def remove_trailing_media_div(self):
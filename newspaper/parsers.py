@@ -6,14 +6,19 @@ https://github.com/codelucas/newspaper/blob/master/GOOSE-LICENSE.txt
 Parser objects will only contain operations that manipulate
 or query an lxml or soup dom object generated from an article's html.
 """
+import codecs
 import logging
+import lxml.cssselect
 import lxml.etree
 import lxml.html
 import lxml.html.clean
 import re
+import threading
+import weakref
 from html import unescape
 import string
 
+from array import array
 from bs4 import UnicodeDammit
 from copy import deepcopy
 
@@ -21,14 +26,336 @@ from . import text
 
 log = logging.getLogger(__name__)
 
+# charset of a <meta charset=..> or <meta http-equiv=.. content=..> tag
+META_CHARSET = re.compile(
+    rb'<meta[^>]+charset\s*=\s*["\']?\s*([a-zA-Z0-9_:.-]+)', re.I)
+# lxml parsers must not be shared between threads, so each thread keeps
+# its own, one per encoding
+_local = threading.local()
+
+
+def get_html_parser(encoding):
+    parsers = _local.__dict__.setdefault('parsers', {})
+    parser = parsers.get(encoding)
+    if parser is None:
+        parser = parsers[encoding] = lxml.html.HTMLParser(encoding=encoding)
+    return parser
+
+
+def evaluate(compiled, node, method='xpath'):
+    """Runs a compiled expression on `node`. A None node raises the
+    AttributeError `node.xpath(...)` / `node.cssselect(...)` raised before
+    expressions were compiled, which callers rely on
+    """
+    if node is None:
+        raise AttributeError(
+            "'NoneType' object has no attribute '%s'" % method)
+    return compiled(node)
+
+
+REGEXP_NAMESPACE = {'re': 'http://exslt.org/regular-expressions'}
+# max compiled expressions kept per thread
+XPATH_CACHE_SIZE = 512
+_xpath_caches = weakref.WeakSet()
+
+
+class XPathCache(object):
+    """Compiled `lxml.etree.XPath` objects keyed by what they were built
+    from, so an expression used on every article is compiled once. Each
+    thread has its own, see `get_xpath_cache`
+    """
+    def __init__(self):
+        self.compiled = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, compile):
+        """Returns the expression cached under `key`, `compile()` builds
+        it on a miss
+        """
+        xpath = self.compiled.get(key)
+        if xpath is not None:
+            self.hits += 1
+            return xpath
+        self.misses += 1
+        if len(self.compiled) >= XPATH_CACHE_SIZE:
+            self.compiled.clear()
+        xpath = self.compiled[key] = compile()
+        return xpath
+
+
+def get_xpath_cache():
+    """The calling thread's `XPathCache`
+    """
+    cache = getattr(_local, 'xpath_cache', None)
+    if cache is None:
+        cache = _local.xpath_cache = XPathCache()
+        _xpath_caches.add(cache)
+    return cache
+
+
+def xpath_cache_stats():
+    """Returns {'hits', 'misses', 'size'} summed over the live threads
+    """
+    caches = list(_xpath_caches)
+    return {'hits': sum(c.hits for c in caches),
+            'misses': sum(c.misses for c in caches),
+            'size': sum(len(c.compiled) for c in caches)}
+
+
+class DocumentIndex(object):
+    """Elements of one document by tag and by their id, class and name
+    attributes, collected in a single walk of the tree so cleaning and
+    extraction steps don't each scan the whole document.
+
+    Removals must go through `remove` and `drop_tag`, results never
+    include a removed element. Steps which add or rename elements call
+    `invalidate`, the index is then rebuilt on its next query.
+    """
+    ATTRIBUTES = ('id', 'class', 'name')
+    # what CSS `~=` splits attribute values on
+    TOKEN_SEPARATORS = re.compile(r'[ \t\r\n]+')
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.build()
+
+    def build(self):
+        self.by_tag = {}
+        self.by_attribute = {attr: [] for attr in self.ATTRIBUTES}
+        # attribute -> token -> elements, e.g. class -> 'byline' -> [..]
+        self.by_token = {attr: {} for attr in self.ATTRIBUTES}
+        self.comments = []
+        self.position = {}
+        self.dead = set()
+        self.stale = False
+        for position, node in enumerate(self.doc.iter()):
+            tag = node.tag
+            if not isinstance(tag, str):
+                if tag is lxml.etree.Comment:
+                    self.comments.append(node)
+                continue
+            self.position[node] = position
+            self.by_tag.setdefault(tag, []).append(node)
+            attrib = node.attrib
+            for attr in self.ATTRIBUTES:
+                value = attrib.get(attr)
+                if value is None:
+                    continue
+                self.by_attribute[attr].append(node)
+                tokens = self.by_token[attr]
+                for token in set(self.TOKEN_SEPARATORS.split(value)):
+                    if token:
+                        tokens.setdefault(token, []).append(node)
+
+    def invalidate(self):
+        self.stale = True
+
+    def _refresh(self):
+        if self.stale:
+            self.build()
+
+    def is_live(self, node):
+        return node not in self.dead and (
+            node is self.doc or node.getparent() is not None)
+
+    def elements(self, tag):
+        """Elements with `tag` under the document root, in document order
+        """
+        self._refresh()
+        return [node for node in self.by_tag.get(tag, ())
+                if node is not self.doc and node.tag == tag and
+                self.is_live(node)]
+
+    def with_attribute(self, attr, regex=None):
+        """Elements whose `attr` (id, class or name) matches the compiled
+        `regex` anywhere, or which have `attr` at all when there is no
+        `regex`, in document order
+        """
+        self._refresh()
+        found = []
+        for node in self.by_attribute[attr]:
+            value = node.get(attr)
+            if value is not None and (regex is None or regex.search(value)) \
+                    and self.is_live(node):
+                found.append(node)
+        return found
+
+    def with_token(self, attr, *tokens):
+        """Elements which have any of `tokens` among the whitespace
+        separated words of their `attr`, in document order
+        """
+        self._refresh()
+        candidates = set()
+        for token in tokens:
+            candidates.update(self.by_token[attr].get(token, ()))
+        found = []
+        for node in sorted(candidates, key=self.position.get):
+            value = node.get(attr)
+            if value is not None and self.is_live(node) and \
+                    set(tokens).intersection(
+                        self.TOKEN_SEPARATORS.split(value)):
+                found.append(node)
+        return found
+
+    def get_comments(self):
+        self._refresh()
+        return [node for node in self.comments if self.is_live(node)]
+
+    def remove(self, node):
+        """`Parser.remove`, the node and everything under it is dead
+        """
+        if node.getparent() is not None:
+            self.dead.update(node.iter())
+        Parser.remove(node)
+
+    def drop_tag(self, node):
+        """`Parser.drop_tag`, the node is dead but its children live on
+        """
+        Parser.drop_tag(node)
+        self.dead.add(node)
+
+
+class TextStats(object):
+    """Per element figures about the text `Parser.getText` would return
+    for it, filled for a whole subtree by one post-order walk so scoring
+    heuristics don't extract the text of overlapping subtrees again and
+    again. Rows live in flat arrays, `rows` maps elements to them.
+
+    An element not seen yet is added, with its subtree, on first query.
+    The figures of an element whose subtree has changed since are stale.
+    """
+
+    def __init__(self, stopwords):
+        self.stopwords = stopwords
+        # stopword counts add up over pieces of text only when words are
+        # whatever is between spaces, other languages count per element
+        self.additive = type(stopwords).candidate_words is \
+            text.StopWords.candidate_words
+        self.rows = {}
+        # total length of the words, the text adds a space between each
+        self.chars = array('l')
+        self.words = array('l')
+        # words which are alphanumeric only
+        self.alnum_words = array('l')
+        self.stopwords_count = array('l')
+        # <a> elements below, their words and how many have any text
+        self.links = array('l')
+        self.link_words = array('l')
+        self.links_with_text = array('l')
+
+    def add(self, node):
+        """Fills the rows of `node` and everything under it
+        """
+        rows = self.rows
+        for _, el in lxml.etree.iterwalk(node, events=('end',)):
+            # words of the element's own text and of its children's tails
+            own = el.text.split() if el.text else []
+            words = chars = alnum_words = stopwords = 0
+            links = link_words = links_with_text = 0
+            for child in el:
+                if child.tail:
+                    own.extend(child.tail.split())
+                if not isinstance(child.tag, str):
+                    continue
+                row = rows[child]
+                words += self.words[row]
+                chars += self.chars[row]
+                alnum_words += self.alnum_words[row]
+                stopwords += self.stopwords_count[row]
+                links += self.links[row]
+                link_words += self.link_words[row]
+                links_with_text += self.links_with_text[row]
+                if child.tag == 'a':
+                    links += 1
+                    link_words += self.words[row]
+                    if self.words[row]:
+                        links_with_text += 1
+            if own:
+                words += len(own)
+                chars += sum(map(len, own))
+                alnum_words += sum(1 for word in own if word.isalnum())
+                if self.additive:
+                    stopwords += self.stopwords.count_stopwords(
+                        ' '.join(own))
+            rows[el] = len(self.words)
+            self.words.append(words)
+            self.chars.append(chars)
+            self.alnum_words.append(alnum_words)
+            self.stopwords_count.append(stopwords if self.additive else -1)
+            self.links.append(links)
+            self.link_words.append(link_words)
+            self.links_with_text.append(links_with_text)
+        return self
+
+    def row(self, node):
+        row = self.rows.get(node)
+        if row is None:
+            self.add(node)
+            row = self.rows[node]
+        return row
+
+    def word_count(self, node):
+        return self.words[self.row(node)]
+
+    def text_length(self, node):
+        row = self.row(node)
+        words = self.words[row]
+        return self.chars[row] + words - 1 if words else 0
+
+    def alnum_word_count(self, node):
+        return self.alnum_words[self.row(node)]
+
+    def stopword_count(self, node):
+        row = self.row(node)
+        count = self.stopwords_count[row]
+        if count < 0:
+            count = self.stopwords_count[row] = \
+                self.stopwords.count_stopwords(Parser.getText(node))
+        return count
+
+    def link_count(self, node):
+        """<a> elements below `node`, not counting `node` itself
+        """
+        return self.links[self.row(node)]
+
+    def link_word_count(self, node):
+        """Words of the text of the links below `node`, each link's
+        counted on its own
+        """
+        return self.link_words[self.row(node)]
+
+    def links_with_text_count(self, node):
+        return self.links_with_text[self.row(node)]
+
 
 class Parser(object):
+    """Stateless, every method works only on what it is passed, so
+    documents can be parsed from many threads at once
+    """
+
+    @classmethod
+    def build_index(cls, doc):
+        """Returns a `DocumentIndex` of `doc`
+        """
+        return DocumentIndex(doc)
+
+    @classmethod
+    def build_text_stats(cls, stopwords, node=None):
+        """Returns a `TextStats` counting stopwords with the `stopwords`
+        instance, filled for the subtree of `node` if there is one
+        """
+        stats = TextStats(stopwords)
+        if node is not None:
+            stats.add(node)
+        return stats
 
     @classmethod
     def xpath_re(cls, node, expression):
-        regexp_namespace = "http://exslt.org/regular-expressions"
-        items = node.xpath(expression, namespaces={'re': regexp_namespace})
-        return items
+        xpath = get_xpath_cache().get(
+            ('re', expression),
+            lambda: lxml.etree.XPath(expression, namespaces=REGEXP_NAMESPACE))
+        return evaluate(xpath, node)
 
     @classmethod
     def drop_tag(cls, nodes):
@@ -40,14 +367,44 @@ class Parser(object):
 
     @classmethod
     def css_select(cls, node, selector):
-        return node.cssselect(selector)
+        xpath = get_xpath_cache().get(
+            ('css', selector),
+            lambda: lxml.cssselect.CSSSelector(selector, translator='html'))
+        return evaluate(xpath, node, 'cssselect')
+
+    @classmethod
+    def get_declared_encoding(cls, html):
+        """Returns the python name of the charset declared by a <meta> tag
+        near the top of the `html` bytes, None if there is no known one
+        """
+        if html.startswith((codecs.BOM_UTF8, codecs.BOM_UTF16_LE,
+                            codecs.BOM_UTF16_BE)):
+            # byte order marks are left to the encoding detection
+            return None
+        match = META_CHARSET.search(html, 0, 4096)
+        if match is None:
+            return None
+        try:
+            return codecs.lookup(match.group(1).decode('ascii')).name
+        except LookupError:
+            return None
 
     @classmethod
-    def get_unicode_html(cls, html):
+    def get_unicode_html(cls, html, encoding=None):
+        """Decodes `html` bytes with `encoding` (e.g. the charset of the
+        Content-Type header) or the charset its <meta> tags declare, and
+        only falls back to detecting the encoding if neither is known
+        """
         if isinstance(html, str):
             return html
         if not html:
             return html
+        encoding = encoding or cls.get_declared_encoding(html)
+        if encoding:
+            try:
+                return html.decode(encoding)
+            except (LookupError, UnicodeDecodeError):
+                log.debug('html is not %s, detecting its encoding', encoding)
         converted = UnicodeDammit(html, is_html=True)
         if not converted.unicode_markup:
             raise Exception(
@@ -57,7 +414,14 @@ class Parser(object):
         return html
 
     @classmethod
-    def fromstring(cls, html):
+    def fromstring(cls, html, encoding=None):
+        """Parses `html`, str or bytes. Bytes are handed to lxml undecoded
+        with `encoding`, or the charset declared in the html, as a hint
+        """
+        if isinstance(html, bytes):
+            doc = cls.fromstring_bytes(html, encoding)
+            if doc is not None:
+                return doc
         html = cls.get_unicode_html(html)
         # Enclosed in a `try` to prevent bringing the entire library
         # down due to one article (out of potentially many in a `Source`)
@@ -65,14 +429,47 @@ class Parser(object):
             # lxml does not play well with <? ?> encoding tags
             if html.startswith('<?'):
                 html = re.sub(r'^\<\?.*?\?\>', '', html, flags=re.DOTALL)
-            cls.doc = lxml.html.fromstring(html)
-            return cls.doc
+            return lxml.html.fromstring(html)
         except Exception:
             log.warn('fromstring() returned an invalid string: %s...', html[:20])
             return
 
     @classmethod
-    def clean_article_html(cls, node):
+    def fromstring_bytes(cls, html, encoding=None):
+        """Returns None when the encoding of `html` is unknown or wrong, or
+        the parse fails, so the caller can decode it the slow way. lxml
+        replaces undecodable bytes instead of failing, so the encoding is
+        checked with a strict decode first
+        """
+        encoding = encoding or cls.get_declared_encoding(html)
+        if not encoding:
+            return None
+        try:
+            encoding = codecs.lookup(encoding).name
+            html.decode(encoding)
+        except (LookupError, UnicodeDecodeError):
+            log.debug('html is not %s, detecting its encoding', encoding)
+            return None
+        try:
+            # lxml does not play well with <? ?> encoding tags
+            if html.startswith(b'<?'):
+                html = re.sub(rb'^\<\?.*?\?\>', b'', html, flags=re.DOTALL)
+            return lxml.html.fromstring(html, parser=get_html_parser(encoding))
+        except Exception:
+            log.debug('Parsing html bytes as %s failed', encoding)
+            return None
+
+    @classmethod
+    def clean_article_html(cls, node, article_cleaner=None):
+        """`article_cleaner` is made by `get_article_cleaner` if not given,
+        an extraction context keeps one for reuse
+        """
+        if article_cleaner is None:
+            article_cleaner = cls.get_article_cleaner()
+        return article_cleaner.clean_html(node)
+
+    @classmethod
+    def get_article_cleaner(cls):
         article_cleaner = lxml.html.clean.Cleaner()
         article_cleaner.javascript = True
         article_cleaner.style = True
@@ -82,7 +479,7 @@ class Parser(object):
             'h2', 'h3', 'h4', 'h5', 'h6',
             'ul', 'ol', 'li', 'dl', 'dt', 'dd']
         article_cleaner.remove_unknown_tags = False
-        return article_cleaner.clean_html(node)
+        return article_cleaner
 
     @classmethod
     def nodeToString(cls, node):
@@ -110,22 +507,31 @@ class Parser(object):
     @classmethod
     def getElementsByTag(
             cls, node, tag=None, attr=None, value=None, childs=False, use_regex=False) -> list:
+        if not (attr and value):
+            attr = value = None
+        xpath = get_xpath_cache().get(
+            ('tag', tag, attr, value, use_regex),
+            lambda: cls._tag_xpath(tag, attr, value, use_regex))
+        elems = evaluate(xpath, node)
+        # remove the root node
+        # if we have a selection tag
+        if node in elems and (tag or childs):
+            elems.remove(node)
+        return elems
+
+    @staticmethod
+    def _tag_xpath(tag, attr, value, use_regex):
         NS = None
         # selector = tag or '*'
         selector = 'descendant-or-self::%s' % (tag or '*')
         if attr and value:
             if use_regex:
-                NS = {"re": "http://exslt.org/regular-expressions"}
+                NS = REGEXP_NAMESPACE
                 selector = '%s[re:test(@%s, "%s", "i")]' % (selector, attr, value)
             else:
                 trans = 'translate(@%s, "%s", "%s")' % (attr, string.ascii_uppercase, string.ascii_lowercase)
                 selector = '%s[contains(%s, "%s")]' % (selector, trans, value.lower())
-        elems = node.xpath(selector, namespaces=NS)
-        # remove the root node
-        # if we have a selection tag
-        if node in elems and (tag or childs):
-            elems.remove(node)
-        return elems
+        return lxml.etree.XPath(selector, namespaces=NS)
 
     @classmethod
     def appendChild(cls, node, child):
@@ -147,15 +553,14 @@ class Parser(object):
             root.text = None
             root.insert(0, t)
         # loop childs
-        for c, n in enumerate(list(root)):
-            idx = root.index(n)
+        for n in list(root):
             # don't process texts nodes
             if n.tag == 'text':
                 continue
             # create a text node for tail
             if n.tail:
                 t = cls.createElement(tag='text', text=n.tail, tail=None)
-                root.insert(idx + 1, t)
+                n.addnext(t)
         return list(root)
 
     @classmethod
@@ -168,10 +573,12 @@ class Parser(object):
 
     @classmethod
     def getElementsByTags(cls, node, tags):
-        selector = 'descendant::*[%s]' % (
-            ' or '.join('self::%s' % tag for tag in tags))
-        elems = node.xpath(selector)
-        return elems
+        tags = tuple(tags)
+        xpath = get_xpath_cache().get(
+            ('tags', tags),
+            lambda: lxml.etree.XPath('descendant::*[%s]' % (
+                ' or '.join('self::%s' % tag for tag in tags))))
+        return evaluate(xpath, node)
 
     @classmethod
     def createElement(cls, tag='p', text=None, tail=None):
@@ -191,6 +598,15 @@ class Parser(object):
 
     @classmethod
     def remove(cls, node):
+        if node.getparent() is not None:
+            cls.detach(node)
+            node.clear()
+
+    @classmethod
+    def detach(cls, node):
+        """Takes `node` out of the tree with everything under it, the
+        text of its tail stays behind
+        """
         parent = node.getparent()
         if parent is not None:
             if node.tail:
@@ -203,7 +619,7 @@ class Parser(object):
                     if not prev.tail:
                         prev.tail = ''
                     prev.tail += ' ' + node.tail
-            node.clear()
+                node.tail = None
             parent.remove(node)
 
     @classmethod
@@ -54,4 +54,13 @@ ANCHOR_DIRECTORY = os.path.join(TOP_DIRECTORY, CF_CACHE_DIRECTORY)
 if not os.path.exists(ANCHOR_DIRECTORY):
     os.mkdir(ANCHOR_DIRECTORY)
 
+# conditional-GET cache of source homepages, categories and feeds
+HTTP_CACHE_DIRECTORY = os.path.join(TOP_DIRECTORY, 'http_cache')
+
+if not os.path.exists(HTTP_CACHE_DIRECTORY):
+    os.mkdir(HTTP_CACHE_DIRECTORY)
+
+# collapsed stacks of sampled parses, made when the first one is written
+PROFILE_DIRECTORY = os.path.join(TOP_DIRECTORY, 'profiles')
+
 TRENDING_URL = 'http://www.google.com/trends/hottrends/atom/feed?pn=p1'
@@ -13,12 +13,15 @@ from urllib.parse import urljoin, urlsplit, urlunsplit
 
 from tldextract import tldextract
 
+from . import instrument
+from . import mprocessing
 from . import network
 from . import urls
 from . import utils
-from .article import Article
+from .article import Article, ArticleDownloadState, ArticleException
 from .configuration import Configuration
 from .extractors import ContentExtractor
+from .mthreading import Pipeline
 from .settings import ANCHOR_DIRECTORY
 
 log = logging.getLogger(__name__)
@@ -143,7 +146,8 @@ class Source(object):
         common_feed_urls_as_categories = [Category(url=url) for url in common_feed_urls]
 
         category_urls = [c.url for c in common_feed_urls_as_categories]
-        requests = network.multithread_request(category_urls, self.config)
+        requests = network.multithread_request(category_urls, self.config,
+                                               use_cache=True)
 
         for index, _ in enumerate(common_feed_urls_as_categories):
             response = requests[index].resp
@@ -154,7 +158,7 @@ class Source(object):
         common_feed_urls_as_categories = [c for c in common_feed_urls_as_categories if c.html]
 
         for _ in common_feed_urls_as_categories:
-            doc = self.config.get_parser().fromstring(_.html)
+            doc = network.parse_cached(_.url, _.html, self.config)
             _.doc = doc
 
         common_feed_urls_as_categories = [c for c in common_feed_urls_as_categories if
@@ -174,13 +178,14 @@ class Source(object):
     def download(self):
         """Downloads html of source
         """
-        self.html = network.get_html(self.url, self.config)
+        self.html = network.get_html(self.url, self.config, use_cache=True)
 
     def download_categories(self):
         """Download all category html, can use mthreading
         """
         category_urls = [c.url for c in self.categories]
-        requests = network.multithread_request(category_urls, self.config)
+        requests = network.multithread_request(category_urls, self.config,
+                                               use_cache=True)
 
         for index, _ in enumerate(self.categories):
             req = requests[index]
@@ -197,7 +202,8 @@ class Source(object):
         """Download all feed html, can use mthreading
         """
         feed_urls = [f.url for f in self.feeds]
-        requests = network.multithread_request(feed_urls, self.config)
+        requests = network.multithread_request(feed_urls, self.config,
+                                               use_cache=True)
 
         for index, _ in enumerate(self.feeds):
             req = requests[index]
@@ -215,7 +221,7 @@ class Source(object):
         children links, also sets description
         """
         # TODO: This is a terrible idea, ill try to fix it when i'm more rested
-        self.doc = self.config.get_parser().fromstring(self.html)
+        self.doc = network.parse_cached(self.url, self.html, self.config)
         if self.doc is None:
             if self.config.verbose:
                 print('[Source parse ERR]', self.url)
@@ -228,13 +234,14 @@ class Source(object):
         log.debug('We are extracting from %d categories' %
                   len(self.categories))
         for category in self.categories:
-            doc = self.config.get_parser().fromstring(category.html)
+            doc = network.parse_cached(category.url, category.html,
+                                       self.config)
             category.doc = doc
 
         self.categories = [c for c in self.categories if c.doc is not None]
 
     def _map_title_to_feed(self, feed):
-        doc = self.config.get_parser().fromstring(feed.rss)
+        doc = network.parse_cached(feed.url, feed.rss, self.config)
         if doc is None:
             # http://stackoverflow.com/a/24893800
             return None
@@ -352,35 +359,153 @@ class Source(object):
                 self.articles[index].set_html(html)
                 if not html:
                     failed_articles.append(self.articles[index])
-            self.articles = [a for a in self.articles if a.html]
+            self.articles = [a for a in self.articles if a.has_html()]
         else:
             if threads > 5:
                 print(('Using 5+ threads on a single source '
                        'may get you rate limited!'))
-            filled_requests = network.multithread_request(urls, self.config)
-            # Note that the responses are returned in original order
-            for index, req in enumerate(filled_requests):
-                html = network.get_html(req.url, response=req.resp)
-                self.articles[index].set_html(html)
-                if not req.resp:
-                    failed_articles.append(self.articles[index])
-            self.articles = [a for a in self.articles if a.html]
+            # draining the iterator finishes the download
+            for _ in self.iter_download_articles(threads):
+                pass
+            return
+
+        self._finish_download_articles(failed_articles)
 
+    def iter_download_articles(self, threads=None):
+        """Downloads all articles attached to self via mthreading and
+        yields each one as soon as its html is in, so it can be parsed
+        while the rest are still downloading. Failed articles are dropped
+        """
+        urls = [a.url for a in self.articles]
+        failed_articles = []
+        for req in network.multithread_request_iter(
+                urls, self.config, num_threads=threads):
+            article = self.articles[req.index]
+            if req.error is None and req.resp is not None:
+                article.set_html(*network.get_raw_html_2XX_only(
+                    req.url, response=req.resp))
+            if article.has_html():
+                yield article
+            else:
+                failed_articles.append(article)
+
+        self.articles = [a for a in self.articles if a.has_html()]
+        self._finish_download_articles(failed_articles)
+
+    async def adownload_articles(self):
+        """Coroutine counterpart of `download_articles`, downloads all
+        articles attached to self concurrently on the running event loop
+        """
+        urls = [a.url for a in self.articles]
+        filled_requests = await network.async_request(urls, self.config)
+        failed_articles = self._set_article_responses(filled_requests)
+        self._finish_download_articles(failed_articles)
+
+    def _set_article_responses(self, filled_requests):
+        """Sets article html from requests filled in their original order,
+        drops and returns the articles which failed
+        """
+        failed_articles = []
+        for index, req in enumerate(filled_requests):
+            if req.error is None and req.resp is not None:
+                self.articles[index].set_html(*network.get_raw_html_2XX_only(
+                    req.url, response=req.resp))
+            if not self.articles[index].has_html():
+                failed_articles.append(self.articles[index])
+        self.articles = [a for a in self.articles if a.has_html()]
+        return failed_articles
+
+    def finish_download_articles(self):
+        """Drops the articles which have no html after being downloaded
+        one by one elsewhere, e.g. by a `NewsPool`
+        """
+        failed_articles = [a for a in self.articles if not a.has_html()]
+        self.articles = [a for a in self.articles if a.has_html()]
+        self._finish_download_articles(failed_articles)
+
+    def _finish_download_articles(self, failed_articles):
         self.is_downloaded = True
         if len(failed_articles) > 0:
             if self.config.verbose:
                 print('[ERROR], these article urls failed the download:',
                       [a.url for a in failed_articles])
 
-    def parse_articles(self):
-        """Parse all articles, delete if too small
+    def parse_articles(self, processes=None, chunksize=None):
+        """Parse all articles, delete if too small. With more than one
+        `processes` (default `config.parse_processes`) the articles are
+        parsed in that many worker processes
         """
-        for index, article in enumerate(self.articles):
-            article.parse()
+        processes = processes or self.config.parse_processes
+        if processes > 1:
+            self._parse_articles_in_processes(
+                processes, chunksize or self.config.parse_chunksize)
+        else:
+            for article in self.articles:
+                article.set_text(article.parse() or '')
 
         self.articles = self.purge_articles('body', self.articles)
         self.is_parsed = True
 
+    def _parse_articles_in_processes(self, processes, chunksize):
+        """Ships each article's url and html to `mprocessing` workers and
+        merges the extracted results back into the articles
+        """
+        jobs = [(a.url, a.html if a.raw_html is None else a.raw_html,
+                 a.config, a.html_encoding) for a in self.articles]
+        results = mprocessing.parse_many(jobs, processes, chunksize,
+                                         self.config.get_language())
+        for article, result in zip(self.articles, results):
+            if 'error' in result:
+                log.critical('[PARSE FAILED] %s %s' %
+                             (article.url, result['error']))
+                continue
+            article.link_hash = result['link_hash']
+            article.set_text(result['text'])
+            article.is_parsed = result['is_parsed']
+
+    def process_articles(self, sink=None, nlp=None, download_threads=None,
+                         parse_threads=1, nlp_threads=1, queue_size=None):
+        """Downloads and parses all articles attached to self as a
+        pipeline, so articles are parsed while the rest still download.
+        If given, `nlp(article)` runs as a third stage, reported to
+        `config.stage_hook` as the 'nlp' stage. Each stage has its
+        own number of threads, and at most `queue_size` articles wait
+        between two stages (default twice the next stage's threads).
+
+        `sink(article)` is called as each article comes out of the last
+        stage. Articles which fail a stage are dropped, like those whose
+        body is too small in `parse_articles`. Returns the
+        pipeline, whose `stats()` and `errors` tell what happened.
+        """
+        pipeline = Pipeline(queue_size)
+        pipeline.add_stage('download', download_article,
+                           download_threads or self.config.number_threads)
+        pipeline.add_stage('parse', parse_article, parse_threads)
+        if nlp is not None:
+            hook = self.config.stage_hook
+            if hook is not None:
+                untimed_nlp = nlp
+
+                def nlp(article):
+                    instrument.stage_timer(hook, article.url)(
+                        'nlp', untimed_nlp, article)
+            pipeline.add_stage('nlp', nlp, nlp_threads)
+
+        processed = []
+
+        def finish(article):
+            processed.append(article)
+            if sink is not None:
+                sink(article)
+
+        pipeline.run(list(self.articles), sink=finish)
+        # keep the original order, minus the articles which failed
+        processed = set(id(a) for a in processed)
+        self.articles = [a for a in self.articles if id(a) in processed]
+        self.is_downloaded = True
+        self.is_parsed = True
+        return pipeline
+
     def size(self):
         """Number of articles linked to this news source
         """
@@ -430,3 +555,21 @@ class Source(object):
         print('feed_urls:', self.feed_urls())
         print('\r\n')
         print('category_urls:', self.category_urls())
+
+
+def download_article(article):
+    """Pipeline stage, raises if the article could not be downloaded
+    """
+    article.download()
+    if article.download_state != ArticleDownloadState.SUCCESS:
+        raise ArticleException(article.download_exception_msg)
+
+
+def parse_article(article):
+    """Pipeline stage, parses the article and keeps its text. Raises if
+    the body is too small, as `parse_articles` purges those
+    """
+    article.set_text(article.parse() or '')
+    if not article.is_valid_body():
+        raise ArticleException('Article body of %s is too small' %
+                               article.url)
@@ -53,6 +53,10 @@ setup(
     packages=packages,
     include_package_data=True,
     install_requires=required,
+    extras_require={
+        # the asyncio download engine, `pip install newspaper3k[async]`
+        'async': ['aiohttp>=3.6'],
+    },
     license='MIT',
     zip_safe=False,
     classifiers=[
@@ -5,16 +5,45 @@ Async IO vs multi-threading
 Multi-thread:           5.9 secs (10 threads) for 100 requests
 Async-IO with Gevent:   10.5 secs  for 100 requests
 Single thread:          86.0 secs for 100 requests
+
+Every benchmark here runs against a local `FixtureServer`, never the live
+web, so results are reproducible on a machine with no network:
+
+    $ python -m tests.benchmarks
+    $ python -m tests.benchmarks --latency 0.1 --error-rate 0.05
+
+A crawl recorded with `network.RecordingTransport` can be replayed to
+benchmark `Source.build`:
+
+    $ python -m tests.benchmarks --archive cnn.warc --source http://cnn.com
+
+Counting the stopwords of every scored node of the fixture pages, as
+scoring used to and with one prepared counter:
+
+    $ python -m tests.benchmarks --stopwords
+
+Removing the empty tags of a synthetic 10k node top node, tag by tag with
+XPath as the formatter used to and in one bottom-up walk:
+
+    $ python -m tests.benchmarks --empty-tags
+
+Extracting the html fixtures of tests/data (or any directories of html)
+offline, timed stage by stage. A run can be saved as a JSON baseline and
+later runs compared against it, slower stages are reported as
+regressions and make the run exit with status 1:
+
+    $ python -m tests.benchmarks --corpus --save-baseline before.json
+    $ python -m tests.benchmarks --corpus ~/archive --compare before.json
 """
+import argparse
+import asyncio
+import copy
+import json
+import string
 import sys
 import logging
-import queue
 import os
-
-from threading import activeCount
-from threading import Thread
-from http.cookiejar import CookieJar as cj
-from .unit_tests import read_urls
+import time
 
 try:  # Python 2.7+
     from logging import NullHandler
@@ -23,52 +52,439 @@ except ImportError:
         def emit(self, record):
             pass
 
+try:  # the asyncio download engine is an optional extra
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
 logging.getLogger(__name__).addHandler(NullHandler())
 log = logging.getLogger(__name__)
 
 PARENT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, os.path.join(PARENT_DIR, '..'))
 
-from newspaper.network import multithread_request, sync_request
+HTML_DIR = os.path.join(PARENT_DIR, 'data', 'html')
+
+from newspaper import nlp, Source
+from newspaper.configuration import Configuration
+from newspaper.context import get_context
+from newspaper.extractors import ContentExtractor
+from newspaper.fixture_server import FixtureServer
+from newspaper.outputformatters import OutputFormatter
+from newspaper.network import (async_request, get_html, multithread_request,
+                               ReplayTransport, set_transport)
+from newspaper.parsers import Parser
+from newspaper.text import WordStats
 from newspaper.utils import print_duration
 
 
 @print_duration
-def naive_run(urls):
+def naive_run(urls, config):
     """no multithreading or async io
     """
     resps = []
     for url in urls:
-        resps.append(sync_request(url))
-    print(resps)
+        resps.append(get_html(url, config))
 
 
 @print_duration
-def mthread_run(urls):
+def mthread_run(urls, config):
     """download a bunch of urls via multithreading
     """
-    reqs = multithread_request(urls)
-    resps = [req.resp for req in reqs]
+    multithread_request(urls, config)
 
 
 @print_duration
-def asyncio_run(urls):
+def asyncio_run(urls, config):
     """download a bunch of urls via async io
     """
-    pass
-    # rs = (grequests.request('GET', u, **req_kwargs) for u in urls)
-    # responses = async_request(urls)
-    # print(responses)
+    asyncio.run(async_request(urls, config))
+
+
+@print_duration
+def source_build_run(source_url, config):
+    """build a source from a replayed crawl
+    """
+    s = Source(source_url, config=config)
+    s.build()
+    print('%d categories, %d feeds, %d articles' %
+          (len(s.categories), len(s.feeds), s.size()))
+
+
+def fresh_stopword_count(stopwords_class, language, content):
+    """What scoring did for every node: a new stopwords instance, a new
+    translation table, a utf-8 round trip and a `WordStats`
+    """
+    stopwords = stopwords_class(language=language)
+    content = content.encode('utf-8')
+    trans_table = {ord(c): None for c in string.punctuation}
+    stripped_input = content.decode('utf-8').translate(trans_table)
+    ws = WordStats()
+    overlapping_stopwords = [w for w in stripped_input.lower().split(' ')
+                             if w in stopwords.STOP_WORDS]
+    ws.set_stopword_count(len(overlapping_stopwords))
+    ws.set_stop_words(overlapping_stopwords)
+    return ws.get_stopword_count()
+
+
+def stopwords_run(language='en', rounds=5):
+    """per node cost of counting stopwords, before and after preparing
+    one counter per language
+    """
+    config = Configuration()
+    config.language = language
+    texts = []
+    for name in sorted(os.listdir(HTML_DIR)):
+        with open(os.path.join(HTML_DIR, name), encoding='utf-8') as f:
+            doc = Parser.fromstring(f.read())
+        if doc is not None:
+            texts.extend(Parser.getText(node) for node in
+                         Parser.getElementsByTags(doc, ['p', 'pre', 'td']))
+
+    stopwords = config.stopwords_class(language=language)
+    runs = [('fresh instance', lambda text: fresh_stopword_count(
+                config.stopwords_class, language, text)),
+            ('prepared', stopwords.count_stopwords)]
+    for name, count in runs:
+        best = None
+        for _ in range(rounds):
+            ts = time.perf_counter()
+            for text in texts:
+                count(text)
+            duration = time.perf_counter() - ts
+            best = duration if best is None else min(best, duration)
+        print('%-15s %d nodes, %.2f usec per node' %
+              (name, len(texts), best / len(texts) * 1e6))
+
+
+def remove_empty_tags_by_xpath(top_node):
+    """What the formatter did: text and <object>/<embed> lookups for every
+    tag, each one a walk of the tag's subtree
+    """
+    all_nodes = Parser.getElementsByTags(top_node, ['*'])
+    all_nodes.reverse()
+    for el in all_nodes:
+        if not Parser.getText(el) \
+                and not Parser.getElementsByTag(el, tag='object') \
+                and not Parser.getElementsByTag(el, tag='embed'):
+            Parser.remove(el)
+
+
+def synthetic_top_node(nodes=10000):
+    """A top node of `nodes` tags: paragraphs, empty wrappers and embeds
+    in sections nested up to 40 deep
+    """
+    top_node = Parser.createElement(tag='div')
+    parent, count = top_node, 0
+    while count < nodes:
+        kind = count % 7
+        if count % 140 == 0:
+            parent = Parser.createElement(tag='div', tail='\n')
+            top_node.append(parent)
+        elif kind == 0:
+            div = Parser.createElement(tag='div', tail='\n')
+            parent.append(div)
+            parent = div
+        elif kind in (1, 2):
+            parent.append(Parser.createElement(
+                text='Some words of a paragraph %d' % count, tail=' '))
+        elif kind == 3:
+            parent.append(Parser.createElement(tag='span', tail='\n'))
+        elif kind == 4:
+            embed = Parser.createElement(tag='object')
+            embed.append(Parser.createElement(tag='embed'))
+            parent.append(embed)
+            count += 1
+        else:
+            section = Parser.createElement(tag='section')
+            parent.append(section)
+            parent = section
+        count += 1
+    return top_node
+
+
+def empty_tags_run(nodes=10000, rounds=3):
+    """remove_empty_tags over a synthetic top node, before and after
+    deciding in one bottom-up walk
+    """
+    top_node = synthetic_top_node(nodes)
+    formatter = OutputFormatter(Configuration())
+
+    def bottom_up(node):
+        formatter.top_node = node
+        formatter.remove_empty_tags()
+
+    runs = [('xpath per tag', remove_empty_tags_by_xpath),
+            ('bottom up', bottom_up)]
+    for name, remove_empty_tags in runs:
+        best = None
+        for _ in range(rounds):
+            node = copy.deepcopy(top_node)
+            ts = time.perf_counter()
+            remove_empty_tags(node)
+            duration = time.perf_counter() - ts
+            best = duration if best is None else min(best, duration)
+        print('%-15s %d tags, %.3f sec' % (name, nodes, best))
+
 
+CORPUS_STAGES = ['fromstring', 'get_title', 'get_authors',
+                 'get_publishing_date', 'build_index', 'clean',
+                 'calculate_best_node', 'post_cleanup', 'get_formatted',
+                 'summarize']
 
-def benchmark():
+
+def corpus_files(paths):
+    """The .html/.htm files of `paths`, directories are walked
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            for name in sorted(names):
+                if name.endswith(('.html', '.htm')):
+                    yield os.path.join(root, name)
+
+
+def extract_stages(html, config, timings, summarize=True):
+    """Extracts one page the way `Article.parse` and `nlp` do, appending
+    the seconds of each stage to `timings[stage]`. Stages after one which
+    found nothing are skipped
+    """
+    parser = config.get_parser()
+    extractor = ContentExtractor(config)
+    formatter = OutputFormatter(config)
+    cleaner = get_context(config).document_cleaner
+
+    def timed(stage, func, *args):
+        ts = time.perf_counter()
+        result = func(*args)
+        timings[stage].append(time.perf_counter() - ts)
+        return result
+
+    doc = timed('fromstring', parser.fromstring, html)
+    if doc is None:
+        return
+    title = timed('get_title', extractor.get_title, doc)
+    timed('get_authors', extractor.get_authors, doc)
+    timed('get_publishing_date', extractor.get_publishing_date, '', doc)
+    index = timed('build_index', parser.build_index, doc)
+    doc = timed('clean', cleaner.clean, doc, index)
+    top_node = timed('calculate_best_node', extractor.calculate_best_node,
+                     doc, index)
+    if top_node is None:
+        return
+    top_node = timed('post_cleanup', extractor.post_cleanup, top_node)
+    text, _ = timed('get_formatted', formatter.get_formatted, top_node)
+    if summarize:
+        timed('summarize', nlp.summarize, '', title, text)
+
+
+def percentile(values, p):
+    """Nearest rank `p` percentile of sorted `values`
+    """
+    if not values:
+        return 0.0
+    rank = max(0, int(round(p / 100.0 * len(values))) - 1)
+    return values[min(rank, len(values) - 1)]
+
+
+def peak_memory_mb():
+    """Peak resident memory of this process so far, None where the
+    resource module is missing
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0)
+
+
+def corpus_run(paths, language='en', passes=3):
+    """Extracts every html file of `paths` `passes` times, returns a
+    report of the per stage percentiles in msec, docs/sec and peak memory
+    """
+    config = Configuration()
+    config.language = language
+    summarize = True
+    try:
+        nlp.load_stopwords(language)
+        nlp.split_sentences('Warm up. The tokenizer.')
+    except (IOError, LookupError):
+        print('summarize is not timed, the nlp stopwords or the nltk '
+              'sentence tokenizer are missing')
+        summarize = False
+
+    htmls = []
+    for path in corpus_files(paths):
+        with open(path, 'rb') as f:
+            htmls.append(f.read())
+
+    timings = {stage: [] for stage in CORPUS_STAGES}
+    ts = time.perf_counter()
+    for _ in range(passes):
+        for html in htmls:
+            extract_stages(html, config, timings, summarize)
+    duration = time.perf_counter() - ts
+
+    stages = {}
+    for stage in CORPUS_STAGES:
+        values = sorted(t * 1000.0 for t in timings[stage])
+        stages[stage] = {'count': len(values),
+                         'total': sum(values),
+                         'p50': percentile(values, 50),
+                         'p90': percentile(values, 90),
+                         'p99': percentile(values, 99),
+                         'max': values[-1] if values else 0.0}
+    docs = len(htmls) * passes
+    return {'docs': docs,
+            'seconds': duration,
+            'docs_per_sec': docs / duration if duration else 0.0,
+            'peak_memory_mb': peak_memory_mb(),
+            'stages': stages}
+
+
+def print_corpus_report(report):
+    print('%-20s %7s %9s %9s %9s %9s %9s' %
+          ('stage (msec)', 'count', 'total', 'p50', 'p90', 'p99', 'max'))
+    for stage in CORPUS_STAGES:
+        s = report['stages'].get(stage)
+        if s is None or not s['count']:
+            continue
+        print('%-20s %7d %9.1f %9.3f %9.3f %9.3f %9.3f' %
+              (stage, s['count'], s['total'], s['p50'], s['p90'],
+               s['p99'], s['max']))
+    print('%d docs in %.2f sec, %.1f docs/sec' %
+          (report['docs'], report['seconds'], report['docs_per_sec']))
+    if report['peak_memory_mb'] is not None:
+        print('peak memory %.1f MB' % report['peak_memory_mb'])
+
+
+def compare_corpus_report(report, baseline, tolerance=0.2):
+    """Prints how each stage's p50 and p90 and the docs/sec moved against
+    `baseline`, returns the regressions: (what, baseline, now) of figures
+    more than `tolerance` worse
+    """
+    regressions = []
+    print('%-24s %12s %12s %8s' % ('vs baseline', 'baseline', 'now',
+                                   'change'))
+
+    def check(what, before, now, higher_is_better=False):
+        change = (now - before) / before if before else 0.0
+        worse = -change if higher_is_better else change
+        flag = ' REGRESSION' if worse > tolerance else ''
+        if flag:
+            regressions.append((what, before, now))
+        print('%-24s %12.3f %12.3f %+7.1f%%%s' %
+              (what, before, now, change * 100, flag))
+
+    for stage in CORPUS_STAGES:
+        if not baseline['stages'].get(stage, {}).get('count') or \
+                not report['stages'][stage]['count']:
+            continue
+        for p in ('p50', 'p90'):
+            check('%s %s' % (stage, p), baseline['stages'][stage][p],
+                  report['stages'][stage][p])
+    check('docs/sec', baseline['docs_per_sec'], report['docs_per_sec'],
+          higher_is_better=True)
+    return regressions
+
+
+def corpus_benchmark(args):
+    """offline extraction of a corpus, stage by stage
+    """
+    report = corpus_run(args.corpus or [HTML_DIR], args.language,
+                        args.passes)
+    print_corpus_report(report)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        print('baseline saved to %s' % args.save_baseline)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare_corpus_report(report, baseline, args.tolerance):
+            sys.exit(1)
+
+
+def benchmark(args):
     """multi-threading vs async-io vs regular
     """
-    urls = read_urls(amount=1000)
-    # naive_run(urls)
-    mthread_run(urls)
-    # asyncio_run(urls)
+    if args.stopwords:
+        stopwords_run()
+        return
+    if args.empty_tags:
+        empty_tags_run()
+        return
+    if args.corpus is not None:
+        corpus_benchmark(args)
+        return
+
+    config = Configuration()
+    config.use_http_cache = False
+    config.memoize_articles = False
+    config.request_retries = 0
+
+    fixture = FixtureServer(directory=HTML_DIR, latency=args.latency,
+                            jitter=args.jitter, error_rate=args.error_rate,
+                            bytes_per_second=args.bytes_per_second)
+    with fixture:
+        urls = (fixture.urls() * args.rounds)[:args.amount]
+        print('%d urls, %.3fs latency, %d%% errors' %
+              (len(urls), args.latency, args.error_rate * 100))
+        if args.naive:
+            naive_run(urls, config)
+        mthread_run(urls, config)
+        if aiohttp is not None:
+            asyncio_run(urls, config)
+        else:
+            print("'asyncio_run' skipped, aiohttp is not installed")
+
+    if args.archive:
+        set_transport(ReplayTransport(args.archive))
+        try:
+            source_build_run(args.source, config)
+        finally:
+            set_transport(None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--amount', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=10,
+                        help='times each fixture page is requested')
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.0)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--bytes-per-second', type=int, default=None)
+    parser.add_argument('--naive', action='store_true',
+                        help='also time the single threaded run')
+    parser.add_argument('--archive', help='WARC archive to replay')
+    parser.add_argument('--source', help='source url recorded in --archive')
+    parser.add_argument('--stopwords', action='store_true',
+                        help='only time stopword counting per node')
+    parser.add_argument('--empty-tags', action='store_true',
+                        help='only time removing the empty tags of a '
+                             'synthetic top node')
+    parser.add_argument('--corpus', nargs='*', metavar='PATH',
+                        help='only time offline extraction, stage by '
+                             'stage, of the html fixtures or of PATHs')
+    parser.add_argument('--language', default='en',
+                        help='language of the --corpus pages')
+    parser.add_argument('--passes', type=int, default=3,
+                        help='times each --corpus page is extracted')
+    parser.add_argument('--save-baseline', metavar='FILE',
+                        help='save the --corpus report as a JSON baseline')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the --corpus report to a baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown over the baseline reported as a '
+                             'regression')
+    benchmark(parser.parse_args())
 
 
 if __name__ == '__main__':
-    benchmark()
+    main()
@@ -8,8 +8,11 @@ import unittest
 import time
 import traceback
 import re
+import itertools
 from collections import defaultdict, OrderedDict
 import concurrent.futures
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 TEST_DIR = os.path.abspath(os.path.dirname(__file__))
 PARENT_DIR = os.path.join(TEST_DIR, '..')
@@ -28,6 +31,14 @@ from newspaper import Article, fulltext, Source, ArticleException, news_pool
 from newspaper.configuration import Configuration
 from newspaper.urls import get_domain
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# the asyncio download engine is the optional `async` extra
+requires_aiohttp = unittest.skipUnless(aiohttp, 'aiohttp is not installed')
+
 
 def print_test(method):
     """
@@ -60,6 +71,90 @@ def mock_resource_with(filename, resource_type):
         return f.read()
 
 
+class LocalHandler(BaseHTTPRequestHandler):
+    """Serves a tiny html page for every GET, used to test the network
+    layer without leaving the machine
+    """
+    protocol_version = 'HTTP/1.1'
+    client_ports = []
+    not_modified = []
+    hits = {}
+    cookies = []
+    # /big pages repeat it, enough for an article body which isn't purged
+    sentence = 'The local server returns the same words for every test. '
+
+    def do_GET(self):
+        self.client_ports.append(self.client_address[1])
+        if self.path.startswith('/missing'):
+            self.send_error(404)
+            return
+        if self.path.startswith('/down') or (
+                self.path.startswith('/flaky') and
+                self.hits.setdefault(self.path, 0) < 2):
+            self.hits[self.path] = self.hits.get(self.path, 0) + 1
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path.startswith('/cookie'):
+            self.cookies.append(self.headers.get('Cookie'))
+            self.send_response(200)
+            self.send_header('Set-Cookie', 'visit=1; Path=/')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.path.startswith('/utf16'):
+            body = '<html><body><p>Wide text</p></body></html>'.encode(
+                'utf-16')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-16')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path.startswith('/report.pdf'):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Content-Length', '100000')
+            self.end_headers()
+            self.wfile.write(b'%PDF-1.4' + b'\x00' * 99992)
+            return
+        if self.path.startswith('/etag'):
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.not_modified.append(self.path)
+                self.send_response(304)
+                self.send_header('ETag', '"v1"')
+                self.end_headers()
+                return
+        body = ('<html><body><p>%s</p><p>%s</p></body></html>' % (
+            self.path, self.sentence * 100
+            if self.path.startswith('/big') else '')
+        ).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        if self.path.startswith('/etag'):
+            self.send_header('ETag', '"v1"')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_local_server(handler=LocalHandler):
+    """Starts an HTTP server on a free localhost port in a daemon
+    thread, returns (server, base_url)
+    """
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_port
+
+
 def get_base_domain(url):
     """
     For example, the base url of uk.reuters.com => reuters.com
@@ -350,6 +445,52 @@ class ContentExtractorTestCase(unittest.TestCase):
         html = '<title>{}</title>'.format(title)
         self.assertEqual(self._get_title(html), title)
 
+    def test_scoring_leaves_dom_unchanged(self):
+        from lxml.etree import tostring
+        from newspaper.outputformatters import OutputFormatter
+        doc = self.parser.fromstring(mock_resource_with('cnn_article', 'html'))
+        before = tostring(doc)
+        top_node = self.extractor.calculate_best_node(doc)
+        self.assertEqual(before, tostring(doc))
+        self.assertGreater(self.extractor.get_score(top_node), 0)
+        self.assertEqual(top_node, max(self.extractor.scores,
+                                       key=self.extractor.scores.get))
+        # formatting leaves no score behind either
+        OutputFormatter(Configuration()).get_formatted(top_node)
+        self.assertFalse(doc.xpath('//*[@gravityScore or @gravityNodes]'))
+
+    def test_remove_empty_tags(self):
+        from lxml.etree import tostring
+        from newspaper.outputformatters import OutputFormatter
+        formatter = OutputFormatter(Configuration())
+        formatter.top_node = self.parser.fromstring(
+            '<div><p>text<span> </span></p><div><b></b>tail</div>'
+            '<div><object>video<embed></embed></object></div><div><embed>'
+            '</embed><span><i> </i></span></div></div>')
+        formatter.remove_empty_tags()
+        self.assertEqual(
+            b'<div><p>text</p><div> tail</div>'
+            b'<div><object>video</object></div></div>',
+            tostring(formatter.top_node))
+
+    def test_one_stopwords_counter(self):
+        from newspaper.text import StopWords, StopWordsKorean
+        text = "It's the end of the world, as we know it -- and I feel fine."
+        for stopwords in [StopWords('en'), StopWordsKorean()]:
+            self.assertEqual(
+                stopwords.get_stopword_count(text).get_stopword_count(),
+                stopwords.count_stopwords(text))
+        self.assertEqual(0, StopWords('en').count_stopwords(''))
+
+        doc = self.parser.fromstring(mock_resource_with('cnn_article', 'html'))
+        stopwords = self.extractor.get_stopwords()
+        self.extractor.calculate_best_node(doc)
+        self.assertIs(stopwords, self.extractor.get_stopwords())
+        self.assertIs(stopwords, self.extractor.get_text_stats().stopwords)
+        self.extractor.update_language('es')
+        self.assertIsNot(stopwords, self.extractor.get_stopwords())
+        self.assertIn('el', self.extractor.get_stopwords().STOP_WORDS)
+
     def _get_canonical_link(self, article_url, html):
         doc = self.parser.fromstring(html)
         return self.extractor.get_canonical_link(article_url, doc)
@@ -426,6 +567,32 @@ class SourceTestCase(unittest.TestCase):
         with self.assertRaises(Exception):
             Source(url=None)
 
+    @print_test
+    def test_parse_articles(self):
+        names = ['cnn_article', 'al.com1', 'about.com1']
+        expected = []
+        for name in names:
+            article = Article('http://cnn.com/%s.html' % name)
+            article.download(mock_resource_with(name, 'html'))
+            expected.append(article.parse())
+
+        for processes in [1, 2]:
+            source = Source('http://cnn.com', memoize_articles=False)
+            source.articles = []
+            for name in names + ['short']:
+                article = Article('http://cnn.com/%s.html' % name)
+                article.download(
+                    '<html><body><p>Too short.</p></body></html>'
+                    if name == 'short' else mock_resource_with(name, 'html'))
+                source.articles.append(article)
+
+            source.parse_articles(processes=processes, chunksize=2)
+            # the short article is purged in both modes
+            self.assertEqual(expected, [a.text for a in source.articles])
+            self.assertTrue(all(a.is_parsed for a in source.articles))
+            self.assertTrue(all(a.link_hash for a in source.articles))
+            self.assertTrue(source.is_parsed)
+
     @unittest.skip("Need to mock download")
     @print_test
     def test_source_build(self):
@@ -578,6 +745,162 @@ class APITestCase(unittest.TestCase):
         """
         newspaper.popular_urls()
 
+    @print_test
+    def test_fulltext_many(self):
+        import pathlib
+        import tempfile
+        html = mock_resource_with('cnn_article', 'html')
+        text = fulltext(html)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = pathlib.Path(tmp, 'cnn_article.html')
+            path.write_bytes(html.encode('utf-8'))
+            docs = [html, html.encode('utf-8'), path, str(path),
+                    pathlib.Path(tmp, 'missing.html')] * 3
+            batch = newspaper.fulltext_many(docs, workers=2, chunksize=2)
+            results = list(batch)
+            # counts start over when the batch is iterated again
+            self.assertEqual(results, list(batch))
+            unordered = sorted(newspaper.fulltext_many(
+                docs, workers=2, chunksize=1, ordered=False))
+        expected = [(i, None if i % 5 == 4 else text) for i in range(15)]
+        self.assertEqual(expected, results)
+        self.assertEqual(expected, unordered)
+        stats = batch.stats()
+        self.assertEqual(15, stats['docs'])
+        self.assertEqual(3, stats['failed'])
+        self.assertGreater(stats['docs_per_sec'], 0)
+
+
+class HostSchedulerTestCase(unittest.TestCase):
+    @print_test
+    def test_per_host_politeness(self):
+        from newspaper.mthreading import HostScheduler
+        lock = threading.Lock()
+        running = defaultdict(int)
+        peak = defaultdict(int)
+        starts = defaultdict(list)
+
+        ticks = itertools.count()
+
+        def clock():
+            # time passes every time the scheduler looks, in steps which
+            # add up exactly in binary floating point
+            return next(ticks) / 1024.0
+
+        class RecordingScheduler(HostScheduler):
+            def _next_task(self):
+                host, task, wait = super()._next_task()
+                if task is not None:
+                    starts[host].append(self.last_start[host])
+                return host, task, wait
+
+        def task(host):
+            with lock:
+                running[host] += 1
+                peak[host] = max(peak[host], running[host])
+            time.sleep(0.01)
+            with lock:
+                running[host] -= 1
+
+        pool = RecordingScheduler(8, per_host=2, host_delay=1 / 64.0,
+                                  clock=clock)
+        for i in range(6):
+            for host in ['a.com', 'b.com', 'c.com']:
+                pool.add_task(host, task, host)
+        self.assertGreater(pool.queue_depth(), 0)
+        pool.wait_completion()
+
+        self.assertEqual(0, pool.queue_depth())
+        self.assertEqual({}, pool.in_flight())
+        for host in ['a.com', 'b.com', 'c.com']:
+            self.assertEqual(6, len(starts[host]))
+            self.assertLessEqual(peak[host], 2)
+            gaps = [b - a for a, b in zip(starts[host], starts[host][1:])]
+            self.assertGreaterEqual(min(gaps), 1 / 64.0)
+
+
+class ExecutorTestCase(unittest.TestCase):
+    @print_test
+    def test_futures_cancellation_and_deadlines(self):
+        from newspaper.mthreading import DeadlineExceeded, Executor
+        executor = Executor(max_workers=1)
+        release = threading.Event()
+        blocker = executor.submit(release.wait)
+        late = executor.submit(lambda: 'late', deadline=0.01)
+        cancelled = executor.submit(lambda: 'never')
+        self.assertTrue(cancelled.cancel())
+        time.sleep(0.05)
+        self.assertEqual(1, executor.stats()['busy'])
+        release.set()
+
+        self.assertTrue(blocker.result())
+        self.assertRaises(DeadlineExceeded, late.result)
+        failing = executor.submit(lambda: 1 / 0)
+        self.assertRaises(ZeroDivisionError, failing.result)
+        self.assertEqual(4, executor.submit(lambda x: x * 2, 2).result())
+        executor.shutdown()
+
+        stats = executor.stats()
+        self.assertEqual(1, stats['workers'])
+        self.assertEqual(0, stats['busy'])
+        self.assertEqual(0, stats['queued'])
+        self.assertEqual(2, stats['completed'])
+        self.assertEqual(1, stats['failed'])
+        self.assertEqual(1, stats['cancelled'])
+        self.assertEqual(1, stats['expired'])
+
+    @print_test
+    def test_nested_requests_do_not_deadlock(self):
+        from newspaper.mthreading import configure_executor
+        from newspaper.network import close_sessions, multithread_request
+        server, base_url = start_local_server()
+        config = Configuration()
+        config.request_retries = 0
+        try:
+            # fewer workers than the tasks and their nested requests
+            executor = configure_executor(2)
+            futures = [executor.submit(
+                multithread_request,
+                ['%s/nested/%d/%d' % (base_url, i, j) for j in range(4)],
+                config) for i in range(2)]
+            done, not_done = concurrent.futures.wait(futures, timeout=30)
+            self.assertFalse(not_done)
+            for future in futures:
+                self.assertEqual([200] * 4, [req.resp.status_code
+                                             for req in future.result()])
+        finally:
+            configure_executor(64)
+            close_sessions()
+            server.shutdown()
+            server.server_close()
+
+    @print_test
+    def test_nested_tasks_use_idle_workers(self):
+        from newspaper.mthreading import Executor
+        executor = Executor(max_workers=4)
+        other = Executor(max_workers=1)
+
+        def outer(pool):
+            started = threading.Barrier(3, timeout=5)
+
+            def inner():
+                started.wait()
+                return threading.current_thread().name
+
+            futures = [pool.submit(inner) for _ in range(3)]
+            return threading.current_thread().name, \
+                [f.result(timeout=10) for f in futures]
+
+        # three idle workers run the nested tasks side by side
+        name, names = executor.submit(outer, executor).result(timeout=10)
+        self.assertEqual(3, len(set(names)))
+        self.assertNotIn(name, names)
+        # a worker of another executor does not count as saturated
+        name, names = other.submit(outer, executor).result(timeout=10)
+        self.assertEqual(3, len(set(names)))
+        executor.shutdown()
+        other.shutdown()
+
 
 @unittest.skip("Need to mock download")
 class MThreadingTestCase(unittest.TestCase):
@@ -605,6 +928,834 @@ class MThreadingTestCase(unittest.TestCase):
               len(tc_paper.articles[1].html))
 
 
+class ParserTestCase(unittest.TestCase):
+    @print_test
+    def test_fromstring_bytes(self):
+        from newspaper.parsers import Parser
+        text = 'Un café très naïf'
+        page = '<html><head>%s</head><body><p>%s</p></body></html>'
+        hinted = Parser.fromstring(
+            (page % ('', text)).encode('latin-1'), 'ISO-8859-1')
+        self.assertEqual(text, Parser.getText(hinted.body))
+
+        meta = '<meta http-equiv="Content-Type" ' \
+               'content="text/html; charset=windows-1252">'
+        declared = (page % (meta, text)).encode('cp1252')
+        self.assertEqual('cp1252', Parser.get_declared_encoding(declared))
+        self.assertEqual(text, Parser.getText(Parser.fromstring(declared).body))
+
+        undeclared = ('<?xml version="1.0" encoding="utf-8"?>' +
+                      page % ('', text)).encode('utf-8')
+        self.assertIsNone(Parser.get_declared_encoding(undeclared))
+        doc = Parser.fromstring(undeclared)
+        self.assertEqual('html', doc.tag)
+        self.assertEqual(text, Parser.getText(doc.body))
+
+        # a wrong hint is detected instead of turned into U+FFFD
+        wrong = (page % ('<meta charset="utf-8">', 'café one')).encode(
+            'cp1252')
+        self.assertEqual('café one',
+                         Parser.getText(Parser.fromstring(wrong).body))
+        self.assertEqual('café one', Parser.getText(
+            Parser.fromstring(wrong, 'utf-8').body))
+        self.assertIn('café one', Parser.get_unicode_html(wrong))
+
+    @print_test
+    def test_compiled_xpath_cache(self):
+        from newspaper.parsers import Parser, xpath_cache_stats
+        doc = Parser.fromstring(
+            '<html><body><div class="Story-Body"><p>a</p><p>b</p></div>'
+            '<span id="x">c</span></body></html>')
+        before = xpath_cache_stats()
+        for _ in range(3):
+            self.assertEqual(1, len(Parser.getElementsByTag(
+                doc, tag='div', attr='class', value='story-body')))
+            self.assertEqual(1, len(Parser.getElementsByTag(
+                doc, attr='class', value='^story', use_regex=True)))
+            self.assertEqual(2, len(Parser.css_select(doc, 'div > p')))
+            self.assertEqual(3, len(Parser.getElementsByTags(
+                doc, ['p', 'span'])))
+            self.assertEqual(['x'], Parser.xpath_re(
+                doc, '//*[re:test(@id, "^x$")]/@id'))
+        after = xpath_cache_stats()
+        self.assertLessEqual(after['misses'] - before['misses'], 5)
+        self.assertGreaterEqual(after['hits'] - before['hits'], 10)
+
+    @print_test
+    def test_document_index(self):
+        from newspaper.parsers import Parser
+        doc = Parser.fromstring(
+            '<html><body><div id="main" class="story body">'
+            '<p>one <em>two</em></p><!-- note --><p class="Byline">by</p>'
+            '<div class="footer"><p>three</p></div></div></body></html>')
+        index = Parser.build_index(doc)
+        self.assertEqual(3, len(index.elements('p')))
+        self.assertEqual(['main'], [n.get('id') for n in
+                                    index.with_token('class', 'story')])
+        byline = re.compile('byline', re.I)
+        self.assertEqual(1, len(index.with_attribute('class', byline)))
+        self.assertEqual(1, len(index.get_comments()))
+
+        footer = index.with_attribute('class', re.compile('^footer$'))[0]
+        index.remove(footer)
+        index.drop_tag(index.elements('em')[0])
+        self.assertEqual(2, len(index.elements('p')))
+        self.assertEqual([], index.elements('em'))
+        self.assertEqual(1, len(index.elements('div')))
+
+        index.elements('p')[0].tag = 'span'
+        index.invalidate()
+        self.assertEqual(1, len(index.elements('p')))
+        self.assertEqual(1, len(index.elements('span')))
+
+    @print_test
+    def test_fused_node_removal(self):
+        from lxml.etree import tostring
+        from newspaper.cleaners import DocumentCleaner
+        from newspaper.parsers import Parser
+        cleaner = DocumentCleaner(Configuration())
+        contains_article = ('.//article|.//*[@id="article"]|'
+                            './/*[@itemprop="articleBody"]')
+
+        def remove_matching(doc, attrs, pattern, keep_articles=False):
+            # the XPath scans remove_bad_nodes replaced, one per attribute
+            for attr in attrs:
+                for node in Parser.xpath_re(
+                        doc, "//*[re:test(@%s, '%s', 'i')]" % (attr, pattern)):
+                    if not (keep_articles and node.xpath(contains_article)):
+                        Parser.remove(node)
+
+        sequential = [lambda doc: remove_matching(
+            doc, ['id', 'class', 'name'], cleaner.remove_nodes_re, True)]
+        sequential.extend(
+            lambda doc, pattern=pattern: remove_matching(
+                doc, ['id', 'class'], pattern)
+            for pattern in [cleaner.caption_re, cleaner.google_re,
+                            cleaner.entries_re, cleaner.facebook_re,
+                            cleaner.facebook_braodcasting_re,
+                            cleaner.twitter_re])
+        # the footer keeps its article until the id rule has removed it
+        html = ('<html><body><div class="footer">a<div id="comments" '
+                'itemprop="articleBody">b</div>c</div><div id="sidebar" '
+                'class="x"><article>d</article></div>e<p class="caption">'
+                'f</p>g<p class="tags">h</p>i</body></html>')
+        htmls = [html] + [mock_resource_with(name, 'html') for name in
+                          ('cnn_article', 'al.com1', 'about.com1')]
+        for html in htmls:
+            expected = Parser.fromstring(html)
+            for step in sequential:
+                step(expected)
+            doc = Parser.fromstring(html)
+            cleaner.remove_bad_nodes(doc)
+            self.assertEqual(tostring(expected), tostring(doc))
+
+    @print_test
+    def test_div_to_para_moves_links(self):
+        from lxml.etree import tostring
+        from newspaper.cleaners import DocumentCleaner
+        from newspaper.parsers import Parser
+        cleaner = DocumentCleaner(Configuration())
+        doc = Parser.fromstring(
+            '<html><body><div class="x">Intro &amp; more <a href="/a">'
+            '<b>link</b></a> after<p>para</p>tail text</div></body></html>')
+        link = doc.xpath('//a')[0]
+        cleaner.div_to_para(doc, 'div')
+        self.assertEqual(
+            b'<div class="x"><a/><span>Intro &amp; more <a href="/a"><b>'
+            b'link</b></a> after</span><p>para</p>tail text<span>tail text'
+            b'</span></div>', tostring(doc.xpath('//div')[0]))
+        # moved, not serialized and parsed again
+        self.assertIs(link, doc.xpath('//span/a')[0])
+
+    @print_test
+    def test_text_stats(self):
+        from newspaper.parsers import Parser
+        from newspaper.text import StopWords
+        stopwords = StopWords(language='en')
+        doc = Parser.fromstring(mock_resource_with('cnn_article', 'html'))
+        stats = Parser.build_text_stats(stopwords, doc)
+        for node in doc.iter():
+            if not isinstance(node.tag, str):
+                continue
+            text = Parser.getText(node)
+            self.assertEqual(len(text), stats.text_length(node))
+            self.assertEqual(len(text.split()), stats.word_count(node))
+            self.assertEqual(
+                stopwords.get_stopword_count(text).get_stopword_count(),
+                stats.stopword_count(node))
+            links = Parser.getElementsByTag(node, tag='a')
+            link_text = ''.join(Parser.getText(link) for link in links)
+            self.assertEqual(len(links), stats.link_count(node))
+            self.assertEqual(len(link_text.split()), stats.link_word_count(
+                node) - max(stats.links_with_text_count(node) - 1, 0))
+
+    @print_test
+    def test_article_keeps_bytes_undecoded(self):
+        html = mock_resource_with('cnn_article', 'html')
+        expected = Article('http://cnn.com/a.html')
+        expected.download(html)
+        article = Article('http://cnn.com/a.html')
+        article.set_html(html.encode('utf-8'), 'utf-8')
+        self.assertIsNone(article._html)
+        self.assertTrue(article.has_html())
+        self.assertEqual(expected.parse(), article.parse())
+        self.assertIsNone(article._html)
+        self.assertEqual(html, article.html)
+
+
+class ParserThreadSafetyTestCase(unittest.TestCase):
+    @print_test
+    def test_parallel_fromstring(self):
+        from newspaper.mthreading import Executor
+        from newspaper.parsers import Parser
+        html = ('<html><head><title>doc %d</title></head><body>'
+                '<div id="d%d"><p>paragraph %d</p></div></body></html>')
+
+        def parse(i):
+            doc = Parser.fromstring(html % (i, i, i))
+            return (Parser.getElementsByTag(doc, tag='title')[0].text,
+                    Parser.getElementById(doc, 'd%d' % i) is not None,
+                    Parser.getText(doc.body))
+
+        executor = Executor(max_workers=16)
+        futures = executor.map(parse, range(3000))
+        for i, future in enumerate(futures):
+            self.assertEqual(('doc %d' % i, True, 'paragraph %d' % i),
+                             future.result())
+        executor.shutdown()
+        self.assertFalse(hasattr(Parser, 'doc'))
+
+    @print_test
+    def test_parallel_article_parse(self):
+        from newspaper.mthreading import Executor
+        names = sorted(os.listdir(HTML_FN))[:24]
+        htmls = []
+        for name in names:
+            with open(os.path.join(HTML_FN, name), encoding='utf-8') as f:
+                htmls.append(f.read())
+
+        def parse(html):
+            article = Article('http://example.com/a.html')
+            article.download(html)
+            return article.parse()
+
+        expected = [parse(html) for html in htmls]
+        executor = Executor(max_workers=8)
+        results = [f.result() for f in executor.map(parse, htmls * 4)]
+        executor.shutdown()
+        self.assertEqual(expected * 4, results)
+
+
+class InstrumentTestCase(unittest.TestCase):
+    URL = 'http://www.cnn.com/2013/11/27/justice/tucson-arizona-captive-girls/'
+
+    @print_test
+    def test_stage_hook(self):
+        import pickle
+        from newspaper import instrument
+        self.assertIs(instrument.untimed,
+                      instrument.stage_timer(None, self.URL))
+        stats = instrument.StageStats()
+        config = Configuration()
+        config.stage_hook = stats
+        article = Article(self.URL, config=config)
+        article.download(
+            mock_resource_with('cnn_article', 'html').encode('utf-8'))
+        text = article.parse()
+        self.assertEqual(mock_resource_with('cnn', 'txt'), text)
+
+        stages = stats.stats()['www.cnn.com']
+        self.assertEqual(['best_node', 'clean', 'format', 'fromstring',
+                          'index', 'post_cleanup'], sorted(stages))
+        self.assertEqual(1, stages['fromstring']['count'])
+        self.assertEqual(len(article.raw_html), stages['fromstring']['bytes'])
+        self.assertGreater(stages['clean']['nodes'], 0)
+        self.assertEqual(1, sum(stages['clean']['histogram'].values()))
+        self.assertEqual(len(text.encode('utf-8')),
+                         stages['format']['bytes'])
+        article.html
+        self.assertEqual(1, stats.stats()['www.cnn.com']['decode']['count'])
+        self.assertEqual(stats.stats(), pickle.loads(pickle.dumps(stats))
+                         .stats())
+
+    @print_test
+    def test_profile_sampling(self):
+        import tempfile
+        config = Configuration()
+        config.profile_sample_rate = 1.0
+        with tempfile.TemporaryDirectory() as tmp:
+            config.profile_dir = tmp
+            article = Article(self.URL, config=config)
+            article.download(mock_resource_with('cnn_article', 'html'))
+            self.assertEqual(mock_resource_with('cnn', 'txt'),
+                             article.parse())
+            names = os.listdir(tmp)
+            self.assertEqual(['%s.collapsed' % article.link_hash], names)
+            with open(os.path.join(tmp, names[0])) as f:
+                stacks = f.read().splitlines()
+        self.assertTrue(stacks)
+        self.assertTrue(any('calculate_best_node' in line
+                            for line in stacks))
+        for line in stacks:
+            stack, micros = line.rsplit(' ', 1)
+            self.assertTrue(stack)
+            self.assertGreater(int(micros), 0)
+
+        # a profile which can't be written doesn't fail the parse
+        with tempfile.NamedTemporaryFile() as not_a_dir:
+            config.profile_dir = not_a_dir.name
+            article = Article(self.URL, config=config)
+            article.download(mock_resource_with('cnn_article', 'html'))
+            self.assertEqual(mock_resource_with('cnn', 'txt'),
+                             article.parse())
+
+
+class NetworkTestCase(unittest.TestCase):
+    def setUp(self):
+        LocalHandler.client_ports = []
+        LocalHandler.not_modified = []
+        LocalHandler.hits = {}
+        LocalHandler.cookies = []
+        self.server, self.base_url = start_local_server()
+
+    def tearDown(self):
+        newspaper.network.close_sessions()
+        self.server.shutdown()
+        self.server.server_close()
+
+    @print_test
+    def test_latin1_header_on_utf8_page(self):
+        import requests
+        from newspaper.network import get_raw_html_2XX_only
+        from newspaper.parsers import Parser
+        pages = [
+            '<html><head><meta charset="utf-8"></head>'
+            '<body><p>Un café très</p></body></html>',
+            '<html><body><p>Un café très bien, à côté du marché, où '
+            'l\'été dure longtemps</p></body></html>']
+        for page in pages:
+            response = requests.Response()
+            response.status_code = 200
+            response.headers['Content-Type'] = \
+                'text/html; charset=ISO-8859-1'
+            response._content = page.encode('utf-8')
+            html, encoding = get_raw_html_2XX_only(
+                self.base_url, response=response)
+            self.assertIsNone(encoding)
+            doc = Parser.fromstring(html, encoding)
+            self.assertTrue(Parser.getText(
+                Parser.getElementsByTag(doc, tag='p')[0])
+                .startswith('Un café très'))
+
+    @print_test
+    def test_sessions_are_per_host(self):
+        from newspaper.network import get_session
+        config = Configuration()
+        a = get_session(self.base_url + '/a', config)
+        b = get_session(self.base_url + '/b', config)
+        c = get_session('http://example.com/a', config)
+        self.assertIs(a, b)
+        self.assertIsNot(a, c)
+
+        config.max_sessions = 2
+        closed = []
+        a.close = lambda: closed.append(a)
+        d = get_session('http://example.org/a', config)
+        self.assertEqual([a], closed)
+        self.assertIs(c, get_session('http://example.com/b', config))
+        self.assertIs(d, get_session('http://example.org/b', config))
+        self.assertIsNot(a, get_session(self.base_url + '/a', config))
+
+    @print_test
+    def test_download_stage_size(self):
+        from newspaper import instrument
+        from newspaper.urls import get_domain
+        stats = instrument.StageStats()
+        config = Configuration()
+        config.stage_hook = stats
+        article = Article(self.base_url + '/big/article.html', config=config)
+        article.download()
+        download = stats.stats()[get_domain(self.base_url)]['download']
+        self.assertEqual(1, download['count'])
+        self.assertEqual(len(article.raw_html), download['bytes'])
+        self.assertGreater(download['bytes'], 5000)
+
+    @print_test
+    def test_session_cookies_are_opt_in(self):
+        from newspaper.network import get_html
+        config = Configuration()
+        for _ in range(2):
+            get_html(self.base_url + '/cookie', config)
+        self.assertEqual([None, None], LocalHandler.cookies)
+        config.persist_cookies = True
+        for _ in range(2):
+            get_html(self.base_url + '/cookie', config)
+        self.assertEqual([None, None, None, 'visit=1'],
+                         LocalHandler.cookies)
+
+    @print_test
+    def test_connections_are_reused(self):
+        from newspaper.network import get_html, multithread_request
+        config = Configuration()
+        config.number_threads = 1
+        html = get_html(self.base_url + '/first', config)
+        self.assertIn('/first', html)
+        urls = [self.base_url + '/%d' % i for i in range(5)]
+        reqs = multithread_request(urls, config)
+        self.assertEqual(urls, [r.url for r in reqs])
+        self.assertTrue(all(r.resp.ok for r in reqs))
+        # one keep-alive connection served all six requests
+        self.assertEqual(1, len(set(LocalHandler.client_ports)))
+
+
+    @requires_aiohttp
+    @print_test
+    def test_async_request(self):
+        import asyncio
+        from newspaper.network import async_request, get_html
+        urls = [self.base_url + '/%d' % i for i in range(20)]
+        urls.insert(5, self.base_url + '/missing')
+        reqs = asyncio.run(async_request(urls))
+        self.assertEqual(urls, [r.url for r in reqs])
+        self.assertEqual(404, reqs[5].resp.status_code)
+        self.assertIsNotNone(reqs[5].error)
+        for i, req in enumerate(reqs[6:]):
+            self.assertIsNone(req.error)
+            self.assertIn('/%d<' % (i + 5), get_html(req.url, response=req.resp))
+
+    @requires_aiohttp
+    @print_test
+    def test_async_article_download(self):
+        import asyncio
+        from newspaper.network import close_async_session, get_async_session
+        article = Article(self.base_url + '/story.html')
+        missing = Article(self.base_url + '/missing.html')
+        sessions = []
+
+        async def download_both():
+            sessions.append(get_async_session())
+            await asyncio.gather(article.adownload(), missing.adownload())
+            # both downloads went through the loop's one session
+            sessions.append(get_async_session())
+            await close_async_session()
+
+        asyncio.run(download_both())
+        self.assertIs(sessions[0], sessions[1])
+        self.assertTrue(sessions[0].closed)
+        self.assertIn('/story.html', article.html)
+        self.assertEqual(newspaper.article.ArticleDownloadState.FAILED_RESPONSE,
+                         missing.download_state)
+
+    @print_test
+    def test_streaming_byte_cap(self):
+        from newspaper.network import get_html
+        config = Configuration()
+        config.MAX_HTML_BYTES = 1000
+        html = get_html(self.base_url + '/big.html', config)
+        self.assertEqual(1000, len(html))
+        self.assertTrue(html.startswith('<html><body><p>/big.html</p>'))
+
+    @print_test
+    def test_streaming_skips_binary(self):
+        from newspaper.network import multithread_request
+        req = multithread_request([self.base_url + '/report.pdf'])[0]
+        self.assertIsNone(req.resp)
+        self.assertIsInstance(req.error, newspaper.network.SkippedContent)
+
+    @print_test
+    def test_streaming_keeps_wide_text(self):
+        from newspaper.network import check_first_chunk, get_html
+        html = '<html><body><p>Wide text</p></body></html>'
+        for encoding in ['utf-16', 'utf-32', 'utf-16-le']:
+            check_first_chunk('http://x.com', html.encode(encoding))
+        check_first_chunk('http://x.com', html.encode('utf-32-le')[4:],
+                          {'content-type': 'text/html; charset=UTF-32LE'})
+        self.assertRaises(newspaper.network.SkippedContent,
+                          check_first_chunk, 'http://x.com',
+                          b'\x7fELF\x02\x01\x01\x00\x00\x00',
+                          {'content-type': 'text/html; charset=utf-8'})
+        self.assertIn('Wide text', get_html(self.base_url + '/utf16.html'))
+
+    @requires_aiohttp
+    @print_test
+    def test_async_streaming_skips_binary(self):
+        import asyncio
+        from newspaper.network import async_request
+        req = asyncio.run(async_request([self.base_url + '/report.pdf']))[0]
+        self.assertIsInstance(req.error, newspaper.network.SkippedContent)
+
+    @print_test
+    def test_retry_transient_errors(self):
+        from newspaper.network import multithread_request
+        config = Configuration()
+        config.retry_backoff_seconds = 0.01
+        req = multithread_request([self.base_url + '/flaky/1'], config)[0]
+        self.assertIsNone(req.error)
+        self.assertEqual(200, req.resp.status_code)
+        self.assertEqual({'/flaky/1': 2}, LocalHandler.hits)
+
+    @requires_aiohttp
+    @print_test
+    def test_async_retry_transient_errors(self):
+        import asyncio
+        from newspaper.network import async_request
+        config = Configuration()
+        config.retry_backoff_seconds = 0.01
+        req = asyncio.run(async_request([self.base_url + '/flaky/2'], config))[0]
+        self.assertIsNone(req.error)
+        self.assertEqual(200, req.resp.status_code)
+        self.assertEqual({'/flaky/2': 2}, LocalHandler.hits)
+
+    @print_test
+    def test_circuit_breaker(self):
+        from newspaper.network import (CircuitOpen, circuit_breaker,
+                                       multithread_request)
+        config = Configuration()
+        config.request_retries = 0
+        config.breaker_failure_threshold = 3
+        config.number_threads = 1
+        urls = [self.base_url + '/down/%d' % i for i in range(10)]
+        try:
+            reqs = multithread_request(urls, config)
+            self.assertEqual(3, len(LocalHandler.hits))
+            self.assertTrue(all(isinstance(r.error, CircuitOpen)
+                                for r in reqs[3:]))
+
+            # after the cooldown a single probe is let through
+            config.breaker_cooldown_seconds = 0
+            multithread_request(urls[:1], config)
+            self.assertEqual(2, LocalHandler.hits['/down/0'])
+        finally:
+            circuit_breaker.reset()
+
+    @print_test
+    def test_conditional_get_cache(self):
+        import tempfile
+        from newspaper import network
+        config = Configuration()
+        url = self.base_url + '/etag/category'
+        saved_cache = network.http_cache
+        with tempfile.TemporaryDirectory() as directory:
+            network.http_cache = network.HTTPCache(directory)
+            try:
+                first = network.get_html(url, config, use_cache=True)
+                doc = network.parse_cached(url, first, config)
+                second = network.get_html(url, config, use_cache=True)
+                self.assertEqual(first, second)
+                self.assertEqual(['/etag/category'], LocalHandler.not_modified)
+                self.assertIs(doc, network.parse_cached(url, second, config))
+
+                # plain downloads never send conditional requests
+                self.assertEqual(first, network.get_html(url, config))
+                self.assertEqual(1, len(LocalHandler.not_modified))
+            finally:
+                network.http_cache = saved_cache
+
+    @print_test
+    def test_http_cache_is_bounded(self):
+        import json
+        import tempfile
+        from newspaper import network
+        config = Configuration()
+        config.MAX_HTTP_CACHE_ENTRIES = 4
+        saved_cache = network.http_cache
+        with tempfile.TemporaryDirectory() as directory:
+            network.http_cache = network.HTTPCache(directory)
+            try:
+                for i in range(6):
+                    network.get_html(self.base_url + '/etag/%d' % i, config,
+                                     use_cache=True)
+                    time.sleep(0.01)
+                names = os.listdir(directory)
+                metas = [n for n in names if n.endswith('.json')]
+                self.assertLessEqual(len(metas), 4)
+                self.assertEqual(2 * len(metas), len(names))
+                for name in metas:
+                    with open(os.path.join(directory, name)) as f:
+                        self.assertIn('/etag/', json.load(f)['url'])
+                # the most recent pages are still revalidated
+                network.get_html(self.base_url + '/etag/5', config,
+                                 use_cache=True)
+                self.assertEqual(['/etag/5'], LocalHandler.not_modified)
+            finally:
+                network.http_cache = saved_cache
+
+    @print_test
+    def test_record_revalidated_pages(self):
+        import tempfile
+        from newspaper import network
+        config = Configuration()
+        config.use_http_cache = True
+        config.request_retries = 3
+        config.retry_backoff_seconds = 5
+        url = self.base_url + '/etag/feed'
+        saved_cache = network.http_cache
+        network.circuit_breaker.reset()
+        with tempfile.TemporaryDirectory() as directory:
+            network.http_cache = network.HTTPCache(directory)
+            path = os.path.join(directory, 'crawl.warc')
+            try:
+                html = network.get_html(url, config, use_cache=True)
+                network.set_transport(network.RecordingTransport(path))
+                recorded = network.get_html(url, config, use_cache=True)
+                self.assertEqual(['/etag/feed'], LocalHandler.not_modified)
+                # replayed elsewhere, with nothing in the http cache
+                network.http_cache = network.HTTPCache(
+                    tempfile.mkdtemp(dir=directory))
+                network.set_transport(network.ReplayTransport(path))
+                self.assertEqual(html, recorded)
+                self.assertEqual(html, network.get_html(url, config,
+                                                        use_cache=True))
+
+                started = time.time()
+                self.assertRaises(network.NotInArchive, network.retrying_get,
+                                  self.base_url + '/unknown', config)
+                self.assertLess(time.time() - started, 1)
+                self.assertEqual({}, network.circuit_breaker.failures)
+            finally:
+                network.set_transport(None)
+                network.http_cache = saved_cache
+                network.circuit_breaker.reset()
+
+    @print_test
+    def test_record_and_replay(self):
+        import asyncio
+        import tempfile
+        from newspaper import network
+        urls = [self.base_url + '/%d.html' % i for i in range(3)]
+        urls.append(self.base_url + '/missing.html')
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'crawl.warc.gz')
+            network.set_transport(network.RecordingTransport(path))
+            try:
+                recorded = network.multithread_request(urls)
+            finally:
+                network.set_transport(None)
+            self.server.shutdown()
+
+            network.set_transport(network.ReplayTransport(path))
+            try:
+                replays = [network.multithread_request(urls)]
+                if aiohttp is not None:
+                    replays.append(asyncio.run(network.async_request(urls)))
+                unknown = network.get_html(self.base_url + '/unknown.html')
+            finally:
+                network.set_transport(None)
+
+        for reqs in replays:
+            self.assertEqual([r.resp.status_code for r in recorded],
+                             [r.resp.status_code for r in reqs])
+            self.assertEqual([r.resp.text for r in recorded],
+                             [r.resp.text for r in reqs])
+        self.assertEqual('', unknown)
+
+    @print_test
+    def test_replayed_errors_are_final(self):
+        import tempfile
+        from newspaper import network
+        config = Configuration()
+        config.request_retries = 0
+        url = self.base_url + '/down/replayed'
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'crawl.warc')
+            network.set_transport(network.RecordingTransport(path))
+            try:
+                self.assertEqual(503, network.retrying_get(
+                    url, config).status_code)
+            finally:
+                network.set_transport(None)
+            network.circuit_breaker.reset()
+
+            config.request_retries = 3
+            config.retry_backoff_seconds = 5
+            network.set_transport(network.ReplayTransport(path))
+            try:
+                started = time.time()
+                self.assertEqual(503, network.retrying_get(
+                    url, config).status_code)
+                self.assertLess(time.time() - started, 1)
+                self.assertEqual({}, network.circuit_breaker.failures)
+            finally:
+                network.set_transport(None)
+                network.circuit_breaker.reset()
+        self.assertEqual(1, LocalHandler.hits['/down/replayed'])
+
+    @print_test
+    def test_fixture_server(self):
+        from newspaper.fixture_server import FixtureServer
+        from newspaper.network import get_html, multithread_request
+        config = Configuration()
+        config.request_retries = 0
+        with open(os.path.join(HTML_FN, 'cnn_article.html'), 'rb') as f:
+            cnn_html = f.read().decode('utf-8')
+        with FixtureServer(directory=HTML_FN, page_bytes=2000) as fixture:
+            html = get_html(fixture.url('cnn_article.html'), config)
+            self.assertEqual(cnn_html, html)
+            generated = get_html(fixture.url('not/a/fixture'), config)
+            self.assertGreaterEqual(len(generated), 2000)
+            self.assertEqual(generated,
+                             get_html(fixture.url('not/a/fixture'), config))
+
+            # the fixture server also stands in as an http proxy
+            config.proxies = {'http': fixture.base_url}
+            html = get_html('http://example.com/cnn_article.html', config)
+            self.assertEqual(cnn_html, html)
+
+        config.proxies = {}
+        with FixtureServer(directory=HTML_FN, error_rate=1,
+                           latency=0.05) as fixture:
+            start = time.time()
+            req = multithread_request([fixture.url('cnn_article.html')],
+                                      config)[0]
+            self.assertGreaterEqual(time.time() - start, 0.05)
+            self.assertEqual(503, req.resp.status_code)
+
+    @print_test
+    def test_multithread_request_iter(self):
+        from newspaper.network import multithread_request_iter
+        urls = [self.base_url + '/%d' % i for i in range(30)]
+        reqs = multithread_request_iter(urls, num_threads=4, window=6)
+        first = next(reqs)
+        time.sleep(0.2)
+        # the request being consumed counts in the window, nothing past
+        # it was requested
+        self.assertEqual(6, len(LocalHandler.client_ports))
+        reqs = [first] + list(reqs)
+        self.assertEqual(list(range(30)), sorted(r.index for r in reqs))
+        for req in reqs:
+            self.assertEqual(urls[req.index], req.url)
+            self.assertTrue(req.resp.ok)
+
+    @print_test
+    def test_source_iter_download_articles(self):
+        source = Source(self.base_url, memoize_articles=False)
+        source.articles = [Article(self.base_url + '/%d.html' % i)
+                           for i in range(8)]
+        source.articles.insert(3, Article(self.base_url + '/missing.html'))
+        downloaded = list(source.iter_download_articles(threads=3))
+        self.assertEqual(8, len(downloaded))
+        self.assertTrue(all(a.html for a in downloaded))
+        self.assertEqual(8, source.size())
+        self.assertTrue(source.is_downloaded)
+
+    @print_test
+    def test_news_pool(self):
+        from newspaper.mthreading import NewsPool
+        source = Source(self.base_url, memoize_articles=False)
+        source.articles = [Article(self.base_url + '/%d.html' % i)
+                           for i in range(5)]
+        source.articles.append(Article(self.base_url + '/missing.html'))
+        article = Article(self.base_url + '/lone.html')
+        pool = NewsPool()
+        pool.set([source, article], threads_per_source=2)
+        pool.join()
+        self.assertEqual(5, source.size())
+        self.assertTrue(source.is_downloaded)
+        self.assertIn('/lone.html', article.html)
+
+    @print_test
+    def test_source_process_articles(self):
+        source = Source(self.base_url, memoize_articles=False)
+        source.articles = [Article(self.base_url + '/big/%d.html' % i)
+                           for i in range(6)]
+        source.articles.insert(2, Article(self.base_url + '/missing.html'))
+        source.articles.insert(4, Article(self.base_url + '/short.html'))
+        seen = []
+
+        def nlp(article):
+            article.nlp_done = article.is_parsed
+
+        pipeline = source.process_articles(sink=seen.append, nlp=nlp,
+                                           download_threads=3)
+        self.assertEqual(6, len(seen))
+        self.assertEqual(6, source.size())
+        self.assertTrue(all(a.nlp_done for a in source.articles))
+        # the short article is purged like in parse_articles
+        self.assertEqual(['/missing.html', '/short.html'],
+                         sorted(a.url[len(self.base_url):]
+                                for _, a, _ in pipeline.errors))
+        stats = pipeline.stats()
+        self.assertEqual(6, stats['nlp']['processed'])
+        self.assertEqual(1, stats['download']['failed'])
+        self.assertEqual(1, stats['parse']['failed'])
+
+
+class PipelineTestCase(unittest.TestCase):
+    @print_test
+    def test_stages_overlap_with_backpressure(self):
+        from newspaper.mthreading import Pipeline
+        lock = threading.Lock()
+        events = []
+        waiting = []
+
+        def fetch(item):
+            time.sleep(0.005)
+            with lock:
+                events.append(('fetch', item))
+                waiting.append(pipeline.stats()['parse']['queued'])
+
+        def parse(item):
+            if item == 3:
+                raise ValueError(item)
+            time.sleep(0.01)
+            with lock:
+                events.append(('parse', item))
+
+        pipeline = Pipeline(queue_size=2)
+        pipeline.add_stage('fetch', fetch, workers=4)
+        pipeline.add_stage('parse', parse, workers=1)
+        done = []
+        self.assertEqual(19, pipeline.run(range(20), sink=done.append))
+
+        self.assertEqual(sorted(done), [i for i in range(20) if i != 3])
+        self.assertLessEqual(max(waiting), 2)
+        # parsing started long before the last fetch
+        first_parse = events.index(('parse', done[0]))
+        self.assertLess(first_parse, events.index(('fetch', 19)))
+        self.assertEqual([('parse', 3)],
+                         [(name, item) for name, item, _ in pipeline.errors])
+
+        # counters start over with every run
+        self.assertEqual(2, pipeline.run(range(2)))
+        self.assertEqual({'processed': 2, 'failed': 0, 'queued': 0},
+                         pipeline.stats()['parse'])
+
+        fed = []
+
+        def items():
+            for i in range(1000):
+                fed.append(i)
+                yield i
+
+        gen = pipeline.iter(items())
+        self.assertIn(next(gen), range(1000))
+        gen.close()
+        time.sleep(0.5)
+        stopped_at = len(fed)
+        time.sleep(0.3)
+        # the feeder stopped pulling items, the queues bound how far it got
+        self.assertEqual(stopped_at, len(fed))
+        self.assertLess(stopped_at, 50)
+
+    @print_test
+    def test_failing_items_iterator(self):
+        from newspaper.mthreading import Pipeline
+
+        def items():
+            yield 1
+            yield 2
+            raise IOError('feed broke')
+
+        pipeline = Pipeline()
+        pipeline.add_stage('noop', lambda item: None, workers=2)
+        done = []
+        with self.assertRaises(IOError):
+            pipeline.run(items(), sink=done.append)
+        # what was fed before the error still went through
+        self.assertEqual([1, 2], sorted(done))
+        self.assertEqual(2, pipeline.stats()['noop']['processed'])
+
+
 class ConfigBuildTestCase(unittest.TestCase):
     """Test if our **kwargs to config building setup actually works.
     NOTE: No need to mock responses as we are just initializing the
@@ -645,6 +1796,24 @@ class ConfigBuildTestCase(unittest.TestCase):
         self.assertEqual('en', s.config.language)
         self.assertFalse(s.config.use_meta_language)
 
+    @print_test
+    def test_shared_extraction_context(self):
+        from newspaper.context import get_context
+        a = Article(url='http://www.cnn.com/2013/11/27/travel/'
+                        'weather-thanksgiving/index.html')
+        b = Article(url='http://www.cnn.com/2013/11/28/travel/'
+                        'weather-thanksgiving/index.html')
+        self.assertIsNone(a._extractor)
+        context = get_context(a.config)
+        self.assertIs(context, get_context(b.config))
+        self.assertIs(context.stopwords, a.extractor.get_stopwords())
+        self.assertIs(context.stopwords, b.extractor.get_stopwords())
+        zh = get_context(a.config, 'zh')
+        self.assertIsNot(context, zh)
+        self.assertEqual('zh', zh.language)
+        self.assertIs(Configuration.get_stopwords_class('zh'),
+                      zh.stopwords_class)
+
 
 class MultiLanguageTestCase(unittest.TestCase):
     @print_test